@@ -0,0 +1,866 @@
+import copy
+import heapq
+import json
+import threading
+import weakref
+from contextlib import nullcontext
+from django.db import connections, transaction
+from django.db.models import F, Func, Case, When, Value, CharField, IntegerField
+from django.db.models.constants import OnConflict
+from django.db.models.lookups import LessThanOrEqual
+from django.db.models.sql import InsertQuery
+from BackgroundTask.queue_stats import get_queue_stats
+from BackgroundTask.payload import is_payload_blob, decode_payload
+
+"""
+Queue backends, picked with `queue_backend` of the task class.
+django - the queue table of the task class (default)
+memory - a queue in the memory of the process, for tests and benchmarks,
+    add_task() and the workers must share the process (run_loop() in a thread)
+redis - sorted sets in Redis, for the hottest queues, every operation is one atomic Lua script
+Tasks are added as dicts with the fields of the queue table, whatever the backend,
+the data is either in data_json, or encoded in data_blob (see payload.py).
+Claims return TaskRecord-s, with only what working on a task needs.
+Recurring tasks (with a schedule) keep their dedupe_key when claimed, and are rescheduled instead of deleted.
+A claim leases tasks to the lease_token of the worker, retry(), reschedule() and delete() with a token
+only touch the tasks the worker still holds, extend() pushes the leases of a heartbeat forward.
+Logs always go to the logs table.
+"""
+
+
+class TaskRecord:
+    """ A claimed task, `errors` is the number of failed attempts before this one, data_json is always decoded """
+
+    __slots__ = ('task_id', 'errors', 'data_json', 'date_added', 'schedule')
+
+    def __init__(self, task_id, errors, data_json, date_added=None, schedule=None):
+        self.task_id = task_id
+        self.errors = errors
+        self.data_json = data_json
+        self.date_added = date_added
+        self.schedule = schedule
+
+    # claimed tasks used to be dicts, task['data_json'] keeps working
+    def __getitem__(self, name):
+
+        if name not in self.__slots__:
+            raise KeyError(name)
+
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def __repr__(self):
+        return 'TaskRecord(task_id=%r, errors=%r)' % (self.task_id, self.errors)
+
+
+def new_task_record(task_id, errors, data_json, data_blob=None, date_added=None, schedule=None) -> TaskRecord:
+
+    if data_blob is not None:
+        data_json = decode_payload(data_blob)
+
+    return TaskRecord(task_id, errors, data_json, date_added, schedule)
+
+
+def get_queue_backend(task_class):
+
+    if task_class.queue_backend == 'django':
+        return DjangoQueueBackend(task_class)
+
+    if task_class.queue_backend == 'memory':
+        return MemoryQueueBackend(task_class.table_name)
+
+    if task_class.queue_backend == 'redis':
+        return RedisQueueBackend(task_class.get_redis_client(), task_class.table_name)
+
+    raise ValueError("Unknown queue_backend [%s], use django, memory or redis" % task_class.queue_backend)
+
+
+class DjangoQueueBackend:
+
+    def __init__(self, task_class):
+        self.model = task_class._get_db_model()
+        self.alias = task_class._get_db_alias()
+        self.queue_stats = get_queue_stats(task_class)
+        # only the counter needs to know if a deduplicated task was inserted
+        self.count_added = task_class.queue_size_method == 'counter'
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    # returns task_id-s of the added tasks
+    # (None-s if the database can't return rows from bulk inserts, or the task was deduplicated)
+    def add(self, task_list, dedupe_refresh=False) -> list:
+
+        objects = self.model.objects.using(self.alias)
+        row_list = [self.model(**task) for task in task_list]
+
+        if len(row_list) == 1 and row_list[0].dedupe_key is not None:
+            added_count = self._insert_with_dedupe_key(objects, row_list[0], dedupe_refresh)
+        else:
+            objects.bulk_create(row_list, batch_size=len(row_list))
+            added_count = len(row_list)
+
+        # for queue_size_method = 'counter', tasks of a rolled back transaction are not counted
+        if added_count > 0:
+            self.on_commit(lambda: self.queue_stats.on_added(added_count))
+
+        return [row.task_id for row in row_list]
+
+    def claim(self, now, lease_until, limit, lease_token=None) -> list:
+
+        connection = connections[self.alias]
+
+        if connection.vendor == 'postgresql':
+            return self._claim_update_returning(connection, now, lease_until, limit, lease_token)
+
+        if connection.features.has_select_for_update_skip_locked:
+            return self._claim_skip_locked(now, lease_until, limit, lease_token)
+
+        return self._claim_conditional_update(now, lease_until, limit, lease_token)
+
+    # claim_order is counted from the retry, as if the task was added then, so retries don't jump the queue
+    def retry(self, task_ids, need_work, priority_aging, lease_token=None):
+        self._filter_leased(task_ids, lease_token).update(
+            need_work=need_work,
+            claim_order=need_work - F('priority') * priority_aging,
+            claimed_at=0,
+            lease_token=None
+        )
+
+    # next_runs - task_id => need_work of the next run, tasks due at the same time are updated together
+    # claim_order is counted from the next run, as if the task was added then
+    def reschedule(self, next_runs, priority_aging, lease_token=None):
+
+        task_ids_by_run = {}
+        for task_id, need_work in next_runs.items():
+            task_ids_by_run.setdefault(need_work, []).append(task_id)
+
+        for need_work, task_ids in task_ids_by_run.items():
+            self._filter_leased(task_ids, lease_token).update(
+                need_work=need_work,
+                claim_order=need_work - F('priority') * priority_aging,
+                errors=0,
+                claimed_at=0,
+                lease_token=None
+            )
+
+    def delete(self, task_ids, lease_token=None):
+        deleted_count, _ = self._filter_leased(task_ids, lease_token).delete()
+        self.queue_stats.on_deleted(deleted_count)
+
+    # returns how many of the leases were still held
+    def extend(self, task_ids, lease_until, lease_token) -> int:
+        return self._filter_leased(task_ids, lease_token).update(need_work=lease_until)
+
+    # returns (size, is_exact), see `queue_size_method`
+    def size(self):
+        return self.queue_stats.size()
+
+    # every count is bounded by `limit`, None - exact
+    def get_split_counts(self, now, limit) -> dict:
+
+        objects = self.model.objects.using(self.alias)
+        query_list = {
+            'ready': objects.filter(need_work__lte=now),
+            'scheduled': objects.filter(need_work__gt=now, claimed_at=0),
+            'in_flight': objects.filter(need_work__gt=now, claimed_at__gt=0),
+        }
+
+        split_counts = {}
+        for name, queryset in query_list.items():
+            split_counts[name] = queryset.count() if limit is None else queryset[:limit].count()
+
+        return split_counts
+
+    def atomic(self):
+        return transaction.atomic(using=self.alias)
+
+    def on_commit(self, callback):
+        transaction.on_commit(callback, using=self.alias)
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    # the tasks, only the ones still leased to `lease_token` if it's given
+    def _filter_leased(self, task_ids, lease_token):
+
+        queryset = self.model.objects.using(self.alias).filter(pk__in=task_ids)
+        if lease_token is not None:
+            queryset = queryset.filter(lease_token=lease_token)
+
+        return queryset
+
+    # one statement on the unique dedupe_key: INSERT .. ON CONFLICT DO NOTHING / DO UPDATE
+    # (INSERT IGNORE / ON DUPLICATE KEY UPDATE on MySQL)
+    # returns 1 if the row was inserted, 0 if its dedupe_key was taken and the existing task was kept (or refreshed)
+    def _insert_with_dedupe_key(self, objects, row, dedupe_refresh) -> int:
+
+        if row.schedule is not None:
+            return self._insert_recurring(objects, row, dedupe_refresh)
+
+        if not dedupe_refresh:
+            return self._insert_row(row, OnConflict.IGNORE)
+
+        return self._insert_refreshed(objects, row)
+
+    # an upsert changes one row either way, PostgreSQL tells an inserted one by xmax = 0,
+    # elsewhere the key is looked up before, and only for the counter: with it a concurrent add of the key is counted twice
+    def _insert_refreshed(self, objects, row) -> int:
+
+        connection = connections[self.alias]
+        update_fields = [self.model._meta.get_field('need_work'), self.model._meta.get_field('claim_order')]
+
+        # MySQL can't name the conflicting column, it's the only unique one besides the primary key anyway
+        if connection.features.supports_update_conflicts_with_target:
+            unique_fields = [self.model._meta.get_field('dedupe_key')]
+        else:
+            unique_fields = None
+
+        if connection.vendor == 'postgresql':
+            return self._insert_row(row, OnConflict.UPDATE, update_fields, unique_fields, ' RETURNING (xmax = 0)')
+
+        existed = self.count_added and objects.filter(dedupe_key=row.dedupe_key).exists()
+        self._insert_row(row, OnConflict.UPDATE, update_fields, unique_fields)
+
+        return 0 if existed else 1
+
+    # a recurring task keeps its dedupe_key while it runs, so there is one row per job however often it's added,
+    # dedupe_refresh moves the job to its new schedule, unless it's running right now
+    def _insert_recurring(self, objects, row, dedupe_refresh) -> int:
+
+        inserted_count = self._insert_row(row, OnConflict.IGNORE)
+        if dedupe_refresh and inserted_count == 0:
+            objects.filter(dedupe_key=row.dedupe_key, claimed_at=0).update(
+                need_work=row.need_work, claim_order=row.claim_order, schedule=row.schedule
+            )
+
+        return inserted_count
+
+    # the INSERT of bulk_create() for one row, which doesn't tell what it inserted on a conflict:
+    # returns the row count of the statement, or the value of `returning_sql` appended to it
+    def _insert_row(self, row, on_conflict, update_fields=None, unique_fields=None, returning_sql=None) -> int:
+
+        opts = self.model._meta
+        query = InsertQuery(self.model, on_conflict=on_conflict, update_fields=update_fields, unique_fields=unique_fields)
+        query.insert_values([field for field in opts.concrete_fields if field is not opts.auto_field], [row])
+        (sql, params), = query.get_compiler(using=self.alias).as_sql()
+
+        with connections[self.alias].cursor() as cursor:
+            if returning_sql is None:
+                cursor.execute(sql, params)
+                return cursor.rowcount
+
+            cursor.execute(sql + returning_sql, params)
+            return int(cursor.fetchone()[0])
+
+    # PostgreSQL: one round trip, locked rows of other workers are skipped
+    def _claim_update_returning(self, connection, now, lease_until, limit, lease_token):
+
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        data_field = self.model._meta.get_field('data_json')
+
+        sql = (
+            "UPDATE " + table + " SET need_work = %s, errors = errors + 1, claimed_at = %s, lease_token = %s, "
+            "dedupe_key = CASE WHEN schedule IS NULL THEN NULL ELSE dedupe_key END "
+            "WHERE task_id IN ("
+            "SELECT task_id FROM " + table + " WHERE need_work <= %s "
+            "ORDER BY claim_order LIMIT %s FOR UPDATE SKIP LOCKED"
+            ") RETURNING task_id, errors - 1, data_json, data_blob, date_added, schedule, claim_order"
+        )
+
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [lease_until, now, lease_token, now, limit])
+                rows = cursor.fetchall()
+
+        # the order of RETURNING is not guaranteed, the batch is worked on in the order of the claim
+        rows.sort(key=lambda row: (row[6], row[0]))
+
+        return [
+            new_task_record(task_id, errors, data_field.from_db_value(data_json, None, connection), data_blob, date_added, schedule)
+            for task_id, errors, data_json, data_blob, date_added, schedule, claim_order in rows
+        ]
+
+    # MySQL 8+, MariaDB 10.6+, Oracle: rows locked by other workers are skipped
+    def _claim_skip_locked(self, now, lease_until, limit, lease_token):
+
+        objects = self.model.objects.using(self.alias)
+
+        with transaction.atomic(using=self.alias):
+            row_list = list(
+                objects.select_for_update(skip_locked=True)
+                .filter(need_work__lte=now)
+                .order_by('claim_order')
+                .values_list('task_id', 'errors', 'data_json', 'data_blob', 'date_added', 'schedule')[:limit]
+            )
+
+            if len(row_list) < 1:
+                return []
+
+            objects.filter(pk__in=[row[0] for row in row_list]).update(
+                need_work=lease_until,
+                errors=F('errors') + 1,
+                dedupe_key=self._claimed_dedupe_key(),
+                claimed_at=now,
+                lease_token=lease_token
+            )
+
+        return [new_task_record(*row) for row in row_list]
+
+    # SQLite and older MySQL: a task is ours only if nobody has moved its need_work since we've read it
+    # every conditional update is atomic on its own, wrapping them into a transaction would only make
+    # SQLite readers deadlock while upgrading their lock to a write lock
+    def _claim_conditional_update(self, now, lease_until, limit, lease_token):
+
+        objects = self.model.objects.using(self.alias)
+        row_list = list(
+            objects.filter(self._due_filter(now))
+            .order_by('claim_order')
+            .values_list('task_id', 'need_work', 'errors', 'data_json', 'data_blob', 'date_added', 'schedule')[:limit]
+        )
+
+        result_task_list = []
+        for task_id, need_work, errors, data_json, data_blob, date_added, schedule in row_list:
+            claimed = objects.filter(pk=task_id, need_work=need_work).update(
+                need_work=lease_until,
+                errors=F('errors') + 1,
+                dedupe_key=self._claimed_dedupe_key(),
+                claimed_at=now,
+                lease_token=lease_token
+            )
+            if claimed:
+                result_task_list.append(new_task_record(task_id, errors, data_json, data_blob, date_added, schedule))
+
+        return result_task_list
+
+    # sqlite picks the range on need_work and sorts all the due tasks, however many, a unary + on the column
+    # keeps it on the claim_order index instead: read in order, need_work checked in the index, stops at `limit`
+    def _due_filter(self, now):
+
+        if connections[self.alias].vendor != 'sqlite':
+            return LessThanOrEqual(F('need_work'), now)
+
+        return LessThanOrEqual(Func(F('need_work'), template='+%(expressions)s', output_field=IntegerField()), now)
+
+    # one-off tasks release their dedupe_key when claimed, recurring ones keep it
+    def _claimed_dedupe_key(self):
+        return Case(When(schedule__isnull=True, then=Value(None)), default=F('dedupe_key'), output_field=CharField())
+
+
+class _MemoryQueue:
+    """
+    Tasks are in one of three heaps: scheduled (by need_work), ready (by claim_order) and leased (by need_work).
+    Moving a task to another heap bumps its version, entries with an old version are skipped when popped
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.task_rows = {}
+        self.versions = {}
+        self.dedupe_ids = {}
+        self.heaps = {'scheduled': [], 'ready': [], 'leased': []}
+
+    def push(self, heap_name, score, task_id):
+        self.versions[task_id] = self.versions.get(task_id, 0) + 1
+        heapq.heappush(self.heaps[heap_name], (score, task_id, self.versions[task_id]))
+
+    # pops entries scored up to `score_max` (any score with None), up to `limit` of them
+    def pop(self, heap_name, score_max, limit) -> list:
+
+        heap = self.heaps[heap_name]
+        task_id_list = []
+        while heap and len(task_id_list) < limit and (score_max is None or heap[0][0] <= score_max):
+            score, task_id, version = heapq.heappop(heap)
+            if task_id in self.task_rows and self.versions[task_id] == version:
+                task_id_list.append(task_id)
+
+        return task_id_list
+
+    def place(self, task_row, now):
+
+        if task_row['need_work'] <= now:
+            self.push('ready', task_row['claim_order'], task_row['task_id'])
+        else:
+            self.push('scheduled', task_row['need_work'], task_row['task_id'])
+
+    # the task, if it's still leased to `lease_token` (whatever the lease, without it)
+    def get_leased(self, task_id, lease_token):
+
+        task_row = self.task_rows.get(task_id)
+        if task_row is None or (lease_token is not None and task_row.get('lease_token') != lease_token):
+            return None
+
+        return task_row
+
+    def release_dedupe_key(self, task_row):
+
+        if task_row['dedupe_key'] is not None and self.dedupe_ids.get(task_row['dedupe_key']) == task_row['task_id']:
+            del self.dedupe_ids[task_row['dedupe_key']]
+
+        task_row['dedupe_key'] = None
+
+
+# queues of the memory backend by table name, shared by all instances of the task class in the process
+_memory_queues = {}
+_memory_queues_lock = threading.Lock()
+
+
+class MemoryQueueBackend:
+
+    def __init__(self, name):
+
+        with _memory_queues_lock:
+            if name not in _memory_queues:
+                _memory_queues[name] = _MemoryQueue()
+
+        self.queue = _memory_queues[name]
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def add(self, task_list, dedupe_refresh=False) -> list:
+
+        queue = self.queue
+        task_ids = []
+        with queue.lock:
+            for task in task_list:
+
+                dedupe_key = task['dedupe_key']
+                if dedupe_key is not None and dedupe_key in queue.dedupe_ids:
+                    task_row = queue.task_rows[queue.dedupe_ids[dedupe_key]]
+                    # a running task isn't moved
+                    if dedupe_refresh and task_row['claimed_at'] == 0:
+                        task_row.update({
+                            'need_work': task['need_work'], 'claim_order': task['claim_order'], 'schedule': task.get('schedule')
+                        })
+                        queue.place(task_row, task['date_added'])
+                    task_ids.append(None)
+                    continue
+
+                # a copy, like a row in a table, the caller's dict can change afterwards
+                task_row = copy.deepcopy(task)
+                task_row.update({'task_id': queue.next_id, 'errors': 0, 'claimed_at': 0})
+                queue.next_id = queue.next_id + 1
+
+                queue.task_rows[task_row['task_id']] = task_row
+                if dedupe_key is not None:
+                    queue.dedupe_ids[dedupe_key] = task_row['task_id']
+
+                queue.place(task_row, task['date_added'])
+                task_ids.append(task_row['task_id'])
+
+        return task_ids
+
+    def claim(self, now, lease_until, limit, lease_token=None) -> list:
+
+        queue = self.queue
+        with queue.lock:
+
+            # tasks that became due and leases that ran out
+            for heap_name in ('scheduled', 'leased'):
+                for task_id in queue.pop(heap_name, now, len(queue.heaps[heap_name])):
+                    queue.push('ready', queue.task_rows[task_id]['claim_order'], task_id)
+
+            claimed_list = []
+            for task_id in queue.pop('ready', None, limit):
+                task_row = queue.task_rows[task_id]
+                claimed_list.append((
+                    task_id, task_row['errors'], task_row['data_json'], task_row['data_blob'], task_row['date_added'],
+                    task_row.get('schedule')
+                ))
+
+                if task_row.get('schedule') is None:
+                    queue.release_dedupe_key(task_row)
+                task_row.update({
+                    'need_work': lease_until, 'errors': task_row['errors'] + 1, 'claimed_at': now, 'lease_token': lease_token
+                })
+                queue.push('leased', lease_until, task_id)
+
+        # a copy, work() may change its data, and a retry has to get it as it was added
+        return [
+            new_task_record(task_id, errors, copy.deepcopy(data_json), data_blob, date_added, schedule)
+            for task_id, errors, data_json, data_blob, date_added, schedule in claimed_list
+        ]
+
+    def retry(self, task_ids, need_work, priority_aging, lease_token=None):
+
+        queue = self.queue
+        with queue.lock:
+            for task_id in task_ids:
+                task_row = queue.get_leased(task_id, lease_token)
+                if task_row is not None:
+                    task_row.update({
+                        'need_work': need_work,
+                        'claim_order': need_work - task_row['priority'] * priority_aging,
+                        'claimed_at': 0,
+                        'lease_token': None,
+                    })
+                    queue.push('scheduled', need_work, task_id)
+
+    def reschedule(self, next_runs, priority_aging, lease_token=None):
+
+        queue = self.queue
+        with queue.lock:
+            for task_id, need_work in next_runs.items():
+                task_row = queue.get_leased(task_id, lease_token)
+                if task_row is not None:
+                    task_row.update({
+                        'need_work': need_work,
+                        'claim_order': need_work - task_row['priority'] * priority_aging,
+                        'errors': 0,
+                        'claimed_at': 0,
+                        'lease_token': None,
+                    })
+                    queue.push('scheduled', need_work, task_id)
+
+    def delete(self, task_ids, lease_token=None):
+
+        queue = self.queue
+        with queue.lock:
+            for task_id in task_ids:
+                task_row = queue.get_leased(task_id, lease_token)
+                if task_row is not None:
+                    del queue.task_rows[task_id]
+                    queue.release_dedupe_key(task_row)
+                    del queue.versions[task_id]
+
+    def extend(self, task_ids, lease_until, lease_token) -> int:
+
+        queue = self.queue
+        extended_count = 0
+        with queue.lock:
+            for task_id in task_ids:
+                task_row = queue.get_leased(task_id, lease_token)
+                if task_row is not None:
+                    task_row['need_work'] = lease_until
+                    queue.push('leased', lease_until, task_id)
+                    extended_count = extended_count + 1
+
+        return extended_count
+
+    def size(self):
+        return len(self.queue.task_rows), True
+
+    def get_split_counts(self, now, limit) -> dict:
+
+        split_counts = {'ready': 0, 'scheduled': 0, 'in_flight': 0}
+        with self.queue.lock:
+            for task_row in self.queue.task_rows.values():
+                if task_row['need_work'] <= now:
+                    split_counts['ready'] = split_counts['ready'] + 1
+                elif task_row['claimed_at'] == 0:
+                    split_counts['scheduled'] = split_counts['scheduled'] + 1
+                else:
+                    split_counts['in_flight'] = split_counts['in_flight'] + 1
+
+        return split_counts
+
+    def atomic(self):
+        return nullcontext()
+
+    def on_commit(self, callback):
+        callback()
+
+
+# scripts of the redis backend by client, a Script hashes its text when it's registered
+_redis_scripts = weakref.WeakKeyDictionary()
+_redis_scripts_lock = threading.Lock()
+
+
+class RedisQueueBackend:
+    """
+    Keys of a queue (the hash tag keeps them in one slot of a Redis Cluster):
+    background_task:{table}:meta - hash, task_id => JSON of the task fields except data_json
+    background_task:{table}:data - hash, task_id => data_json as JSON, or data_blob, never decoded by the scripts
+    background_task:{table}:scheduled - sorted set of tasks waiting for their need_work, by need_work
+    background_task:{table}:ready - sorted set of tasks that can be claimed, by claim_order
+    background_task:{table}:leased - sorted set of claimed tasks, by the end of their lease (visibility timeout)
+    background_task:{table}:dedupe - hash, dedupe_key => task_id
+    background_task:{table}:next_id - task_id counter
+    """
+
+    # how many due or expired tasks a claim moves into ready at most, so a huge batch of them doesn't block Redis
+    move_limit = 1000
+
+    key_names = ('meta', 'data', 'scheduled', 'ready', 'leased', 'dedupe', 'next_id')
+
+    script_names = ('add', 'claim', 'retry', 'reschedule', 'extend', 'delete')
+
+    # places a task into ready or scheduled by its need_work, ARGV[1] is now
+    _lua_place = """
+        local function place(task_id, meta, now)
+            if meta.need_work <= now then
+                redis.call('ZREM', KEYS[3], task_id)
+                redis.call('ZADD', KEYS[4], meta.claim_order, task_id)
+            else
+                redis.call('ZREM', KEYS[4], task_id)
+                redis.call('ZADD', KEYS[3], meta.need_work, task_id)
+            end
+        end
+    """
+
+    # ARGV: now, dedupe_refresh, then meta JSON and data JSON of every task
+    _lua_add = _lua_place + """
+        local now = tonumber(ARGV[1])
+        local task_ids = {}
+        for i = 3, #ARGV, 2 do
+            local meta = cjson.decode(ARGV[i])
+            local existing_id = false
+            if meta.dedupe_key ~= cjson.null then
+                existing_id = redis.call('HGET', KEYS[6], meta.dedupe_key)
+            end
+
+            if existing_id then
+                if ARGV[2] == '1' then
+                    -- a running task isn't moved
+                    local existing = cjson.decode(redis.call('HGET', KEYS[1], existing_id))
+                    if existing.claimed_at == 0 then
+                        existing.need_work = meta.need_work
+                        existing.claim_order = meta.claim_order
+                        existing.schedule = meta.schedule
+                        redis.call('HSET', KEYS[1], existing_id, cjson.encode(existing))
+                        place(existing_id, existing, now)
+                    end
+                end
+                task_ids[#task_ids + 1] = false
+            else
+                local task_id = redis.call('INCR', KEYS[7])
+                meta.task_id = task_id
+                redis.call('HSET', KEYS[1], task_id, cjson.encode(meta))
+                redis.call('HSET', KEYS[2], task_id, ARGV[i + 1])
+                if meta.dedupe_key ~= cjson.null then
+                    redis.call('HSET', KEYS[6], meta.dedupe_key, task_id)
+                end
+                place(task_id, meta, now)
+                task_ids[#task_ids + 1] = task_id
+            end
+        end
+        return task_ids
+    """
+
+    # meta of a task that is still leased to lease_token ('' - whatever the lease), nil otherwise
+    _lua_get_leased = """
+        local function get_leased(task_id, lease_token)
+            local meta_json = redis.call('HGET', KEYS[1], task_id)
+            if not meta_json then
+                return nil
+            end
+
+            local meta = cjson.decode(meta_json)
+            if lease_token ~= '' and meta.lease_token ~= lease_token then
+                return nil
+            end
+            return meta
+        end
+    """
+
+    # ARGV: now, lease_until, limit, move_limit, lease_token
+    # returns meta (before the claim) and data of every claimed task
+    _lua_claim = """
+        local now = tonumber(ARGV[1])
+        local lease_until = tonumber(ARGV[2])
+
+        for _, source_key in ipairs({KEYS[3], KEYS[5]}) do
+            for _, task_id in ipairs(redis.call('ZRANGEBYSCORE', source_key, '-inf', now, 'LIMIT', 0, tonumber(ARGV[4]))) do
+                local meta = cjson.decode(redis.call('HGET', KEYS[1], task_id))
+                redis.call('ZREM', source_key, task_id)
+                redis.call('ZADD', KEYS[4], meta.claim_order, task_id)
+            end
+        end
+
+        local result = {}
+        for _, task_id in ipairs(redis.call('ZRANGE', KEYS[4], 0, tonumber(ARGV[3]) - 1)) do
+            local meta_json = redis.call('HGET', KEYS[1], task_id)
+            result[#result + 1] = {meta_json, redis.call('HGET', KEYS[2], task_id)}
+
+            local meta = cjson.decode(meta_json)
+            if meta.dedupe_key ~= cjson.null and (meta.schedule == nil or meta.schedule == cjson.null) then
+                if redis.call('HGET', KEYS[6], meta.dedupe_key) == task_id then
+                    redis.call('HDEL', KEYS[6], meta.dedupe_key)
+                end
+                meta.dedupe_key = cjson.null
+            end
+            meta.need_work = lease_until
+            meta.errors = meta.errors + 1
+            meta.claimed_at = now
+            meta.lease_token = ARGV[5]
+
+            redis.call('HSET', KEYS[1], task_id, cjson.encode(meta))
+            redis.call('ZREM', KEYS[4], task_id)
+            redis.call('ZADD', KEYS[5], lease_until, task_id)
+        end
+        return result
+    """
+
+    # ARGV: need_work, priority_aging, lease_token, then task_id-s
+    # a lease that ran out may have been moved into ready by a claim
+    _lua_retry = _lua_get_leased + """
+        for i = 4, #ARGV do
+            local meta = get_leased(ARGV[i], ARGV[3])
+            if meta then
+                meta.need_work = tonumber(ARGV[1])
+                meta.claim_order = meta.need_work - meta.priority * tonumber(ARGV[2])
+                meta.claimed_at = 0
+                meta.lease_token = cjson.null
+                redis.call('HSET', KEYS[1], ARGV[i], cjson.encode(meta))
+                redis.call('ZREM', KEYS[4], ARGV[i])
+                redis.call('ZREM', KEYS[5], ARGV[i])
+                redis.call('ZADD', KEYS[3], meta.need_work, ARGV[i])
+            end
+        end
+    """
+
+    # ARGV: priority_aging, lease_token, then task_id and need_work of every task
+    _lua_reschedule = _lua_get_leased + """
+        for i = 3, #ARGV, 2 do
+            local meta = get_leased(ARGV[i], ARGV[2])
+            if meta then
+                meta.need_work = tonumber(ARGV[i + 1])
+                meta.claim_order = meta.need_work - meta.priority * tonumber(ARGV[1])
+                meta.errors = 0
+                meta.claimed_at = 0
+                meta.lease_token = cjson.null
+                redis.call('HSET', KEYS[1], ARGV[i], cjson.encode(meta))
+                redis.call('ZREM', KEYS[4], ARGV[i])
+                redis.call('ZREM', KEYS[5], ARGV[i])
+                redis.call('ZADD', KEYS[3], meta.need_work, ARGV[i])
+            end
+        end
+    """
+
+    # ARGV: lease_until, lease_token, then task_id-s
+    # returns how many of the leases were still held
+    _lua_extend = _lua_get_leased + """
+        local extended_count = 0
+        for i = 3, #ARGV do
+            local meta = get_leased(ARGV[i], ARGV[2])
+            if meta then
+                meta.need_work = tonumber(ARGV[1])
+                redis.call('HSET', KEYS[1], ARGV[i], cjson.encode(meta))
+                redis.call('ZREM', KEYS[4], ARGV[i])
+                redis.call('ZADD', KEYS[5], meta.need_work, ARGV[i])
+                extended_count = extended_count + 1
+            end
+        end
+        return extended_count
+    """
+
+    # ARGV: lease_token, then task_id-s
+    _lua_delete = _lua_get_leased + """
+        for i = 2, #ARGV do
+            local meta = get_leased(ARGV[i], ARGV[1])
+            if meta then
+                if meta.dedupe_key ~= cjson.null and redis.call('HGET', KEYS[6], meta.dedupe_key) == ARGV[i] then
+                    redis.call('HDEL', KEYS[6], meta.dedupe_key)
+                end
+                redis.call('HDEL', KEYS[1], ARGV[i])
+                redis.call('HDEL', KEYS[2], ARGV[i])
+                redis.call('ZREM', KEYS[3], ARGV[i])
+                redis.call('ZREM', KEYS[4], ARGV[i])
+                redis.call('ZREM', KEYS[5], ARGV[i])
+            end
+        end
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.keys = ['background_task:{%s}:%s' % (name, key_name) for key_name in self.key_names]
+
+        # the scripts are registered once per client, handlers (and so backends) are created for every task class instance
+        with _redis_scripts_lock:
+            if client not in _redis_scripts:
+                _redis_scripts[client] = {
+                    name: client.register_script(getattr(self, '_lua_' + name)) for name in self.script_names
+                }
+            script_list = _redis_scripts[client]
+
+        self._add_script = script_list['add']
+        self._claim_script = script_list['claim']
+        self._retry_script = script_list['retry']
+        self._reschedule_script = script_list['reschedule']
+        self._extend_script = script_list['extend']
+        self._delete_script = script_list['delete']
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def add(self, task_list, dedupe_refresh=False) -> list:
+
+        if len(task_list) < 1:
+            return []
+
+        args = [max([task['date_added'] for task in task_list]), '1' if dedupe_refresh else '0']
+        for task in task_list:
+            meta = {name: value for name, value in task.items() if name not in ('data_json', 'data_blob')}
+            meta.update({'errors': 0, 'claimed_at': 0})
+
+            # a JSON text never starts with a payload tag byte
+            if task.get('data_blob') is not None:
+                args.extend([json.dumps(meta), task['data_blob']])
+            else:
+                args.extend([json.dumps(meta), json.dumps(task['data_json'])])
+
+        return [task_id if task_id else None for task_id in self._add_script(keys=self.keys, args=args)]
+
+    def claim(self, now, lease_until, limit, lease_token=None) -> list:
+
+        result_task_list = []
+        args = [now, lease_until, limit, self.move_limit, lease_token or '']
+        for meta_json, data_json in self._claim_script(keys=self.keys, args=args):
+            meta = json.loads(meta_json)
+            if is_payload_blob(data_json):
+                result_task_list.append(new_task_record(
+                    meta['task_id'], meta['errors'], None, data_json, meta.get('date_added'), meta.get('schedule')
+                ))
+            else:
+                result_task_list.append(new_task_record(
+                    meta['task_id'], meta['errors'], json.loads(data_json), None, meta.get('date_added'), meta.get('schedule')
+                ))
+
+        return result_task_list
+
+    def retry(self, task_ids, need_work, priority_aging, lease_token=None):
+        self._retry_script(keys=self.keys, args=[need_work, priority_aging, lease_token or ''] + list(task_ids))
+
+    def reschedule(self, next_runs, priority_aging, lease_token=None):
+
+        args = [priority_aging, lease_token or '']
+        for task_id, need_work in next_runs.items():
+            args.extend([task_id, need_work])
+
+        self._reschedule_script(keys=self.keys, args=args)
+
+    def delete(self, task_ids, lease_token=None):
+        self._delete_script(keys=self.keys, args=[lease_token or ''] + list(task_ids))
+
+    def extend(self, task_ids, lease_until, lease_token) -> int:
+        return self._extend_script(keys=self.keys, args=[lease_until, lease_token] + list(task_ids))
+
+    def size(self):
+        return self.client.hlen(self.keys[0]), True
+
+    # exact, a few O(log n) calls
+    def get_split_counts(self, now, limit) -> dict:
+
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.zcard(self.keys[3])
+        pipeline.zcount(self.keys[2], '-inf', now)
+        pipeline.zcount(self.keys[4], '-inf', now)
+        pipeline.zcount(self.keys[2], '(%d' % now, '+inf')
+        pipeline.zcount(self.keys[4], '(%d' % now, '+inf')
+        ready, scheduled_due, leased_expired, scheduled, in_flight = pipeline.execute()
+
+        return {'ready': ready + scheduled_due + leased_expired, 'scheduled': scheduled, 'in_flight': in_flight}
+
+    def atomic(self):
+        return nullcontext()
+
+    def on_commit(self, callback):
+        callback()
@@ -0,0 +1,952 @@
+import os
+import json
+import importlib.util
+import math
+import random
+import signal
+import sys
+import multiprocessing
+import time
+import warnings
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext
+from BackgroundTask.interface import BackgroundTaskInterface
+from BackgroundTask.logger import BackgroundTaskLogger
+from BackgroundTask.run import BackgroundTaskRunner
+from BackgroundTask.execution import SerialExecution
+from django.forms.models import model_to_dict
+from BackgroundTask import registry
+from BackgroundTask.backends import RedisQueueBackend, new_task_record
+from BackgroundTask.payload import PAYLOAD_CODECS, encode_payload, decode_payload
+
+"""
+Benchmarks for the queue.
+Run with `./manage.py background_task --bench <scenario>`,
+every scenario works on its own throwaway queue table which is dropped at the end,
+results are printed as JSON so they can be stored for regression tracking
+"""
+
+BENCH_TABLE_NAME = 'background_task_bench'
+
+
+def percentile(value_list, percent):
+
+    if len(value_list) < 1:
+        return None
+
+    value_list = sorted(value_list)
+    index = max(0, int(math.ceil(percent / 100 * len(value_list))) - 1)
+
+    return value_list[index]
+
+
+class BenchTask(BackgroundTaskInterface):
+    table_name = BENCH_TABLE_NAME
+    logs_on = False
+    need_check_overflow = False
+    task_limit_per_execution = 10
+    queue_size_method = 'count'
+    work_cost = 0
+
+    def __init__(self):
+        super().__init__()
+
+        # seconds between add_task() and the start of work(), for tasks that carry `enqueued_at`
+        self.latency_list = []
+
+    def work(self, data):
+
+        if 'enqueued_at' in data:
+            self.latency_list.append(time.time() - data['enqueued_at'])
+
+        # the pipeline scenario's cost of a task, as of a call to another service
+        if self.work_cost > 0:
+            time.sleep(self.work_cost)
+
+        return True
+
+
+class BackgroundTaskBench:
+
+    # vars
+    db_alias = 'default'
+    task_count = 2000
+    worker_counts = (1, 2, 4, 8)
+
+    # polling scenario
+    throughput_seconds = 5
+    latency_sample_count = 10
+    latency_gap_max = 3
+
+    # dedupe scenario, how many different keys the enqueued tasks are spread over
+    dedupe_key_count = 20
+
+    # payload and records scenarios, how long every case is timed (seconds)
+    payload_seconds = 0.5
+
+    # logs scenario, latency added to every INSERT into the logs table, as of a remote or busy log database
+    log_insert_delays = (0, 0.005)
+
+    # pipeline scenario: processes adding tasks, seconds every task takes, how long to wait for the queue to drain
+    producer_count = 2
+    work_cost = 0.001
+    pipeline_timeout = 300
+
+    # log_read scenario, rows in the logs table, and how many of them the export reads.
+    # 500k rows take about half a minute on sqlite, a table of 10M (--bench-log-rows) is for a real server
+    log_row_count = 500000
+    log_export_count = 100000
+
+    scenarios = ('claim', 'enqueue', 'explain', 'polling', 'completion', 'priority', 'dedupe', 'backends', 'payload', 'records', 'add_task', 'logs', 'log_read', 'log_format', 'pipeline')
+
+    # task_settings - attributes of the benchmark's task class, to compare tunings (task_limit_per_execution, busy_interval..)
+    def __init__(self, db_alias='default', task_count=None, worker_counts=None, log_row_count=None,
+                 producer_count=None, work_cost=None, task_settings=None):
+
+        self.db_alias = db_alias
+
+        if task_count is not None:
+            self.task_count = task_count
+
+        if worker_counts is not None:
+            self.worker_counts = worker_counts
+
+        if log_row_count is not None:
+            self.log_row_count = log_row_count
+
+        if producer_count is not None:
+            self.producer_count = producer_count
+
+        if work_cost is not None:
+            self.work_cost = work_cost
+
+        self.task_class = type('BenchTask', (BenchTask,), {'db_app_label': db_alias})()
+        self.task_settings = task_settings or {}
+        for name, value in self.task_settings.items():
+            setattr(self.task_class, name, value)
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def run(self, scenario) -> str:
+
+        if scenario not in self.scenarios:
+            raise ValueError("Unknown scenario [%s], available: %s" % (scenario, ', '.join(self.scenarios)))
+
+        self._create_table()
+        try:
+            result = getattr(self, 'bench_' + scenario)()
+        finally:
+            self._drop_table()
+
+        return json.dumps({
+            'scenario': scenario,
+            'vendor': connections[self.db_alias].vendor,
+            'task_count': self.task_count,
+            'task_settings': self.task_settings,
+            'result': result,
+        }, indent=2)
+
+    # --------------------------------------------------
+    # SCENARIOS
+    # --------------------------------------------------
+
+    """ claims/sec of get_new_task_list() for concurrent workers, and whether their batches were disjoint """
+    def bench_claim(self):
+
+        result = []
+        for worker_count in self.worker_counts:
+
+            self._fill_queue(self.task_count)
+
+            # children must not share the parent's connection
+            connections.close_all()
+
+            context = multiprocessing.get_context('fork')
+            start_event = context.Event()
+            id_queue = context.Queue()
+            process_list = [
+                context.Process(target=self._claim_worker, args=(start_event, id_queue))
+                for _ in range(worker_count)
+            ]
+            for process in process_list:
+                process.start()
+
+            time_start = time.perf_counter()
+            start_event.set()
+
+            claimed_ids = []
+            for _ in process_list:
+                claimed_ids.extend(id_queue.get())
+
+            elapsed = time.perf_counter() - time_start
+            for process in process_list:
+                process.join()
+
+            result.append({
+                'worker_count': worker_count,
+                'claimed': len(claimed_ids),
+                'duplicates': len(claimed_ids) - len(set(claimed_ids)),
+                'seconds': round(elapsed, 4),
+                'claims_per_sec': round(len(claimed_ids) / elapsed, 1),
+            })
+
+        return result
+
+    """ enqueue throughput of add_task() row by row against add_tasks() batches """
+    def bench_enqueue(self):
+
+        model = self.task_class._get_db_model()
+        result = []
+
+        model.objects.all().delete()
+        time_start = time.perf_counter()
+        for i in range(self.task_count):
+            self.task_class.add_task({'n': i})
+        result.append(self._enqueue_result('add_task', time.perf_counter() - time_start))
+
+        for batch_size in (100, 500, 1000):
+            model.objects.all().delete()
+            time_start = time.perf_counter()
+            self.task_class.add_tasks(({'n': i} for i in range(self.task_count)), batch_size=batch_size)
+            result.append(self._enqueue_result('add_tasks(batch_size=%d)' % batch_size, time.perf_counter() - time_start))
+
+        return result
+
+    """ query plans of the poll and the claim, they have to be served by indexes and not by full table scans """
+    def bench_explain(self):
+
+        model = self.task_class._get_db_model()
+        now = int(time.time())
+
+        # a realistic backlog: a few tasks are due, the rest are scheduled or leased
+        model.objects.all().delete()
+        model.objects.bulk_create(
+            [
+                model(**self.task_class._new_task_row({'n': i}, 0 if i % 100 == 0 else now + i, i % 3, now))
+                for i in range(self.task_count)
+            ],
+            batch_size=500
+        )
+
+        query_list = [
+            ('poll', model.objects.filter(need_work__lte=now).order_by('need_work')),
+            ('claim', model.objects.filter(self.task_class._get_queue_backend()._due_filter(now)).order_by('claim_order')),
+        ]
+
+        result = []
+        for query_name, queryset in query_list:
+            plan = queryset[:self.task_class.get_batch_limit()].explain()
+            result.append({
+                'query': query_name,
+                'index_used': [index.name for index in model._meta.indexes if index.name in plan],
+                'plan': plan,
+            })
+
+        return result
+
+    """ enqueue-to-start latency of high priority tasks while workers are saturated by a low priority backlog """
+    def bench_priority(self):
+
+        result = []
+        for priority in (0, 10):
+
+            self._fill_queue(self.task_count)
+            worker = self._start_loop_worker({})
+            for _ in range(self.latency_sample_count):
+                time.sleep(random.uniform(0, self.latency_gap_max) / 10)
+                self.task_class.add_task({'enqueued_at': time.time()}, priority=priority)
+
+            # the backlog must still be there, otherwise the worker wasn't saturated
+            backlog_left = self.task_class.get_queue_size()
+            self._wait_queue_empty(60)
+            latency_list = self._stop_loop_worker(worker)['latency_list']
+
+            result.append({
+                'priority': priority,
+                'backlog_left_after_enqueue': backlog_left,
+                'latency_samples': len(latency_list),
+                'latency_p50': self._round(percentile(latency_list, 50)),
+                'latency_p99': self._round(percentile(latency_list, 99)),
+            })
+
+        return result
+
+    """ the same work enqueued over and over: queue rows and enqueue time with and without dedupe_key """
+    def bench_dedupe(self):
+
+        model = self.task_class._get_db_model()
+        mode_list = [
+            ('plain', {}),
+            ('dedupe_key', {'dedupe': True}),
+            ('dedupe_key+refresh', {'dedupe': True, 'dedupe_refresh': True}),
+        ]
+
+        result = []
+        for mode_name, mode_settings in mode_list:
+            model.objects.all().delete()
+
+            time_start = time.perf_counter()
+            for i in range(self.task_count):
+                user_id = i % self.dedupe_key_count
+                self.task_class.add_task(
+                    {'user_id': user_id},
+                    need_work=int(time.time()) + 60,
+                    dedupe_key='user_%d' % user_id if mode_settings.get('dedupe') else None,
+                    dedupe_refresh=mode_settings.get('dedupe_refresh', False)
+                )
+            elapsed = time.perf_counter() - time_start
+
+            result.append({
+                'mode': mode_name,
+                'add_task_calls': self.task_count,
+                'tasks_in_queue': self.task_class.get_queue_size(),
+                'seconds': round(elapsed, 4),
+                'calls_per_sec': round(self.task_count / elapsed, 1),
+            })
+
+        return result
+
+    """ fixed busy_interval / empty_interval sleeps against adaptive polling: throughput and enqueue-to-start latency """
+    def bench_polling(self):
+
+        policy_list = [
+            ('fixed', {'adaptive_polling_on': False}),
+            ('adaptive', {'adaptive_polling_on': True}),
+            ('adaptive+wakeup', {'adaptive_polling_on': True, 'wakeup_on': True}),
+        ]
+
+        result = []
+        for policy_name, policy_settings in policy_list:
+
+            # throughput on a deep queue
+            self._fill_queue(self.task_count)
+            worker = self._start_loop_worker(policy_settings)
+            time.sleep(self.throughput_seconds)
+            processed = self._stop_loop_worker(worker)['processed']
+
+            # latency of an idle worker, tasks trickle in
+            self._fill_queue(0)
+            worker = self._start_loop_worker(policy_settings)
+            for _ in range(self.latency_sample_count):
+                time.sleep(random.uniform(0, self.latency_gap_max))
+                self.task_class.add_task({'enqueued_at': time.time()})
+            self._wait_queue_empty(self.task_class.max_latency + self.task_class.empty_interval)
+            latency_list = self._stop_loop_worker(worker)['latency_list']
+
+            result.append({
+                'policy': policy_name,
+                'tasks_per_sec': round(processed / self.throughput_seconds, 1),
+                'latency_samples': len(latency_list),
+                'latency_p50': self._round(percentile(latency_list, 50)),
+                'latency_p95': self._round(percentile(latency_list, 95)),
+                'latency_max': self._round(percentile(latency_list, 100)),
+            })
+
+        return result
+
+    """ db statements per 1000 tasks (claims, deletes, logs) with and without batched completion """
+    def bench_completion(self):
+
+        execution = SerialExecution(self.task_class)
+        connection = connections[self.task_class._get_db_alias()]
+        self.task_class.logs_on = True
+        self.task_class._logger_instance = None
+
+        result = []
+        try:
+            for batched in (False, True):
+                self._fill_queue(self.task_count)
+
+                time_start = time.perf_counter()
+                with CaptureQueriesContext(connection) as captured:
+                    while True:
+                        task_list = self.task_class.get_new_task_list()
+                        if len(task_list) < 1:
+                            break
+
+                        with self.task_class.completion_batch() if batched else nullcontext():
+                            execution.run_batch(task_list)
+                elapsed = time.perf_counter() - time_start
+
+                result.append({
+                    'batched': batched,
+                    'batch_size': self.task_class.get_batch_limit(),
+                    'statements_per_1000_tasks': round(len(captured.captured_queries) * 1000 / self.task_count, 1),
+                    'tasks_per_sec': round(self.task_count / elapsed, 1),
+                    'left_in_queue': self.task_class.get_queue_size(),
+                })
+        finally:
+            self.task_class.logs_on = False
+            self.task_class._logger_instance = None
+
+        return result
+
+    """ enqueue and drain throughput of one worker with every queue backend, redis is the server at `queue_redis_url`, or fakeredis when it's not reachable """
+    def bench_backends(self):
+
+        execution = SerialExecution(self.task_class)
+
+        result = []
+        for backend_name in ('django', 'memory', 'redis'):
+
+            self.task_class.queue_backend = backend_name
+            self.task_class._queue_backend_instance = None
+            try:
+                if backend_name == 'redis':
+                    self.task_class.get_redis_client = self._get_bench_redis_client()
+                    if self.task_class.get_redis_client is None:
+                        result.append({'backend': backend_name, 'skipped': "neither a redis server nor fakeredis is available"})
+                        continue
+
+                time_start = time.perf_counter()
+                self.task_class.add_tasks({'n': i} for i in range(self.task_count))
+                enqueue_elapsed = time.perf_counter() - time_start
+
+                time_start = time.perf_counter()
+                while True:
+                    task_list = self.task_class.get_new_task_list()
+                    if len(task_list) < 1:
+                        break
+
+                    with self.task_class.completion_batch():
+                        execution.run_batch(task_list)
+                drain_elapsed = time.perf_counter() - time_start
+
+                result.append({
+                    'backend': backend_name,
+                    'enqueue_tasks_per_sec': round(self.task_count / enqueue_elapsed, 1),
+                    'drain_tasks_per_sec': round(self.task_count / drain_elapsed, 1),
+                    'left_in_queue': self.task_class.get_queue_size(),
+                })
+            finally:
+                self.task_class.queue_backend = 'django'
+                self.task_class._queue_backend_instance = None
+                self.task_class.__dict__.pop('get_redis_client', None)
+
+        return result
+
+    """ stored size and encode/decode speed of every payload_codec on small, medium and large payloads """
+    def bench_payload(self):
+
+        payload_list = [
+            ('small', {'user_id': 123456, 'email': 'user@example.com', 'subject': 'Login to myawesomesite.com', 'code': '482913'}),
+            ('medium', {'order_id': 98765, 'items': [
+                {'sku': 'SKU-%05d' % i, 'quantity': i % 5 + 1, 'price': 19.99 + i, 'tags': ['sale', 'new']} for i in range(100)
+            ]}),
+            ('large', {'email': 'user@example.com', 'html': ''.join([
+                '<tr><td class="name">Item %d</td><td class="price">%d.99</td></tr>' % (i, i % 50) for i in range(300)
+            ])}),
+        ]
+
+        result = []
+        for payload_name, payload in payload_list:
+            for codec in PAYLOAD_CODECS:
+
+                if codec.startswith('msgpack') and importlib.util.find_spec('msgpack') is None:
+                    result.append({'payload': payload_name, 'codec': codec, 'skipped': "msgpack is not installed"})
+                    continue
+
+                # json is what the data_json column gets
+                if codec == 'json':
+                    encode = lambda: json.dumps(payload).encode()
+                    decode = json.loads
+                else:
+                    encode = lambda: encode_payload(codec, payload)
+                    decode = decode_payload
+
+                encoded = encode()
+                result.append({
+                    'payload': payload_name,
+                    'codec': codec,
+                    'bytes': len(encoded),
+                    'encode_per_sec': self._calls_per_sec(encode),
+                    'decode_per_sec': self._calls_per_sec(lambda: decode(encoded)),
+                })
+
+        return result
+
+    """ per-row cost of reading a claimed batch: model instances + model_to_dict() against values_list() + TaskRecord """
+    def bench_records(self):
+
+        self._fill_queue(max(self.task_count, 100))
+
+        now = int(time.time())
+        queryset = self.task_class._get_db_model().objects.filter(need_work__lte=now).order_by('claim_order')
+
+        read_list = [
+            ('model_to_dict', lambda limit: [model_to_dict(row) for row in queryset[:limit]]),
+            ('task_record', lambda limit: [
+                new_task_record(*row) for row in queryset.values_list('task_id', 'errors', 'data_json', 'data_blob')[:limit]
+            ]),
+        ]
+
+        result = []
+        for batch_size in (1, 10, 100):
+            for read_name, read in read_list:
+                calls_per_sec = self._calls_per_sec(lambda: read(batch_size))
+                result.append({
+                    'batch_size': batch_size,
+                    'read': read_name,
+                    'rows_per_sec': round(calls_per_sec * batch_size, 1),
+                    'usec_per_row': round(1000000 / (calls_per_sec * batch_size), 2),
+                })
+
+        return result
+
+    """ cost of a QueueSendEmail().add_task(...) call: with the models rebuilt for every new instance (as before the registry),
+        built once per process, and with one instance for all calls """
+    def bench_add_task(self):
+
+        task_type = type(self.task_class)
+
+        result = []
+        for mode in ('rebuilt_models', 'registry', 'one_instance'):
+            self._fill_queue(0)
+            task_class = task_type()
+
+            time_start = time.perf_counter()
+            with warnings.catch_warnings():
+                # rebuilding a registered model is warned about
+                warnings.simplefilter('ignore', RuntimeWarning)
+
+                for i in range(self.task_count):
+                    if mode == 'rebuilt_models':
+                        registry._model_registry.clear()
+                    if mode != 'one_instance':
+                        task_class = task_type()
+                    task_class.add_task({'n': i})
+            elapsed = time.perf_counter() - time_start
+
+            result.append({
+                'mode': mode,
+                'usec_per_call': round(elapsed * 1000000 / self.task_count, 1),
+                'calls_per_sec': round(self.task_count / elapsed, 1),
+            })
+
+        return result
+
+    """ tasks/sec of one worker with logs written in its completion batches and by the async writer, with and without a slow logs table """
+    def bench_logs(self):
+
+        execution = SerialExecution(self.task_class)
+        logs_model = self._get_model_list()[1]
+        self.task_class.logs_on = True
+
+        result = []
+        try:
+            for log_insert_delay in self.log_insert_delays:
+                for logs_async_on in (False, True):
+                    self.task_class.logs_async_on = logs_async_on
+                    self.task_class._logger_instance = None
+                    self._fill_queue(self.task_count)
+                    logs_model.objects.all().delete()
+
+                    with self._slow_log_inserts(log_insert_delay):
+                        time_start = time.perf_counter()
+                        while True:
+                            task_list = self.task_class.get_new_task_list()
+                            if len(task_list) < 1:
+                                break
+
+                            with self.task_class.completion_batch():
+                                execution.run_batch(task_list)
+                        elapsed = time.perf_counter() - time_start
+
+                        time_start = time.perf_counter()
+                        self.task_class.flush_logs()
+                        flush_elapsed = time.perf_counter() - time_start
+
+                    result.append({
+                        'log_insert_delay': log_insert_delay,
+                        'logs_async_on': logs_async_on,
+                        'tasks_per_sec': round(self.task_count / elapsed, 1),
+                        'final_flush_seconds': round(flush_elapsed, 4),
+                        'log_rows_written': logs_model.objects.count(),
+                    })
+        finally:
+            self.task_class.logs_on = False
+            self.task_class.logs_async_on = False
+            self.task_class._logger_instance = None
+
+        return result
+
+    """ seconds per page of get_last_logs() (offset) and get_logs() (keyset) at growing depths, of the filters, and rows/sec of the export """
+    def bench_log_read(self):
+
+        logger = BackgroundTaskLogger(self.task_class.logs_table_name, self.task_class.logs_db_app_name)
+        table_name = self._get_model_list()[1]._meta.db_table
+
+        time_start = time.perf_counter()
+        self._fill_logs(self.log_row_count)
+        result = {'log_rows': self.log_row_count, 'fill_seconds': round(time.perf_counter() - time_start, 1), 'pages': [], 'filters': []}
+
+        # ids go from 1 to log_row_count, the page at `depth` starts below the id log_row_count - depth + 1
+        page_size = 20
+        for depth in sorted(set([0, 1000, 100000, 1000000, self.log_row_count - page_size])):
+            if depth > self.log_row_count - page_size:
+                continue
+
+            cursor = None if depth == 0 else '%s:%d' % (table_name, self.log_row_count - depth + 1)
+            result['pages'].append({
+                'depth': depth,
+                'offset_seconds': self._seconds_per_call(lambda: logger.get_last_logs(page_size, depth)),
+                'keyset_seconds': self._seconds_per_call(lambda: logger.get_logs(page_size, cursor)),
+            })
+
+        middle_cursor = '%s:%d' % (table_name, self.log_row_count // 2)
+        date_middle = int(time.time()) - self.log_row_count // 2 // 100
+        for name, callback in (
+            ('task_id', lambda: logger.get_logs(page_size, task_id=self.log_row_count // 6)),
+            ('message_type=error', lambda: logger.get_logs(page_size, message_type=BackgroundTaskLogger._MESSAGE_TYPE_ERROR)),
+            ('message_type=error, middle', lambda: logger.get_logs(page_size, middle_cursor, message_type=BackgroundTaskLogger._MESSAGE_TYPE_ERROR)),
+            ('date range, middle', lambda: logger.get_logs(page_size, date_from=date_middle - 3600, date_to=date_middle)),
+        ):
+            result['filters'].append({'filter': name, 'seconds': self._seconds_per_call(callback)})
+
+        export_count = min(self.log_export_count, self.log_row_count)
+        time_start = time.perf_counter()
+        for _ in islice(logger.iter_logs(), export_count):
+            pass
+        result['export_rows_per_sec'] = round(export_count / (time.perf_counter() - time_start), 1)
+
+        return result
+
+    """ the whole way of a task: `producer_count` processes add tasks one by one while every worker count of `worker_counts` drains them,
+    with real worker loops; throughput, latency from add_task() to work(), and statements per task of the producers and the workers """
+    def bench_pipeline(self):
+
+        self.task_class.work_cost = self.work_cost
+
+        result = []
+        for worker_count in self.worker_counts:
+            self._fill_queue(0)
+
+            worker_list = [self._start_loop_worker({}) for _ in range(worker_count)]
+
+            context = multiprocessing.get_context('fork')
+            start_event = context.Event()
+            producer_queue = context.Queue()
+            producer_list = [
+                context.Process(target=self._producer, args=(start_event, producer_queue, task_count))
+                for task_count in self._split(self.task_count, self.producer_count)
+            ]
+            for process in producer_list:
+                process.start()
+
+            time_start = time.perf_counter()
+            start_event.set()
+
+            producer_result_list = [producer_queue.get() for _ in producer_list]
+            for process in producer_list:
+                process.join()
+            enqueue_elapsed = time.perf_counter() - time_start
+
+            self._wait_queue_empty(self.pipeline_timeout)
+            elapsed = time.perf_counter() - time_start
+
+            worker_result_list = [self._stop_loop_worker(worker) for worker in reversed(worker_list)]
+            processed = sum([worker_result['processed'] for worker_result in worker_result_list])
+            latency_list = [latency for worker_result in worker_result_list for latency in worker_result['latency_list']]
+
+            result.append({
+                'producer_count': self.producer_count,
+                'worker_count': worker_count,
+                'work_cost': self.work_cost,
+                'processed': processed,
+                'left_in_queue': self.task_class.get_queue_size(),
+                'enqueue_per_sec': round(self.task_count / enqueue_elapsed, 1),
+                'tasks_per_sec': round(processed / elapsed, 1),
+                'latency_p50': self._round(percentile(latency_list, 50)),
+                'latency_p95': self._round(percentile(latency_list, 95)),
+                'latency_p99': self._round(percentile(latency_list, 99)),
+                'producer_statements_per_task': self._per_task(producer_result_list, self.task_count),
+                'worker_statements_per_task': self._per_task(worker_result_list, processed),
+            })
+
+        return result
+
+    """ microseconds per message of the logger's sanitization of the text and of the extra data, and of a whole info() call,
+    for typical and pathological messages """
+    def bench_log_format(self):
+
+        logger = BackgroundTaskLogger(self.task_class.logs_table_name, self.task_class.logs_db_app_name)
+        traceback_text = ''.join(['  File "/app/tasks.py", line %d, in work\n    result = self.step_%d(data)\n' % (i, i) for i in range(20)])
+
+        result = []
+        for name, message_text, data in (
+            ('short', 'Starting to work on task: [123456], attempt: [1]', None),
+            ('short with task data', 'Starting to work on task: [123456], attempt: [1]', {'task_data': {'email': 'user@example.com', 'n': 1}}),
+            ('traceback', traceback_text, None),
+            ('undecodable bytes', b'bad \xff\xfe input'.decode('utf-8', 'surrogateescape'), None),
+            ('1MB, cut', 'x' * 1000000, None),
+            ('1MB extra data, cut', 'Big task', {'task_data': 'x' * 1000000}),
+            ('1MB of quotes in extra data, cut', 'Big task', {'task_data': '"' * 1000000}),
+            ('1M items of extra data, cut', 'Big task', {'task_data': list(range(1000000))}),
+        ):
+            def log():
+                logger.info(message_text, data)
+                logger.pop_messages()
+
+            result.append({
+                'message': name,
+                'format_us': round(1000000 / self._calls_per_sec(lambda: logger._format_string(message_text)), 3),
+                'format_data_us': round(1000000 / self._calls_per_sec(lambda: logger._format_data(data or {})), 3),
+                'info_us': round(1000000 / self._calls_per_sec(log), 3),
+            })
+
+        return result
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    # every INSERT into the logs table takes `delay` seconds longer, on the connections of every thread
+    @contextmanager
+    def _slow_log_inserts(self, delay):
+
+        def slow_execute(execute, sql, params, many, context):
+            if delay > 0 and sql.startswith('INSERT') and self.task_class.logs_table_name in sql:
+                time.sleep(delay)
+            return execute(sql, params, many, context)
+
+        def on_connection_created(sender, connection, **kwargs):
+            connection.execute_wrappers.append(slow_execute)
+
+        connection_created.connect(on_connection_created)
+        try:
+            with connections[self.db_alias].execute_wrapper(slow_execute):
+                yield
+        finally:
+            connection_created.disconnect(on_connection_created)
+
+    # the best of a few calls, the first one also warms the cache up
+    def _seconds_per_call(self, callback, repeat=3):
+
+        time_list = []
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            callback()
+            time_list.append(time.perf_counter() - time_start)
+
+        return round(min(time_list), 6)
+
+    def _calls_per_sec(self, callback):
+
+        call_count = 0
+        time_start = time.perf_counter()
+        while time.perf_counter() - time_start < self.payload_seconds:
+            for _ in range(10):
+                callback()
+            call_count = call_count + 10
+
+        return round(call_count / (time.perf_counter() - time_start), 1)
+
+    # the benchmark works on its own keys, they are dropped right away
+    def _get_bench_redis_client(self):
+
+        try:
+            import redis
+            client = redis.Redis.from_url(self.task_class.queue_redis_url)
+            client.ping()
+        except Exception:
+            try:
+                import fakeredis
+            except ImportError:
+                return None
+            client = fakeredis.FakeRedis()
+
+        client.delete(*['background_task:{%s}:%s' % (BENCH_TABLE_NAME, key_name) for key_name in RedisQueueBackend.key_names])
+
+        return lambda: client
+
+    # a real worker loop in a child process, with the task class tuned by `settings`
+    # (both for the worker and for add_task() calls of this process, until the worker is stopped)
+    def _start_loop_worker(self, settings):
+
+        previous_settings = {name: getattr(self.task_class, name) for name in settings}
+        for name, value in settings.items():
+            setattr(self.task_class, name, value)
+
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        result_queue = context.Queue()
+        process = context.Process(target=self._loop_worker, args=(result_queue,))
+        process.start()
+
+        # giving the worker a moment to start listening
+        time.sleep(0.5)
+
+        return process, result_queue, previous_settings
+
+    def _stop_loop_worker(self, worker):
+
+        process, result_queue, previous_settings = worker
+        os.kill(process.pid, signal.SIGTERM)
+        result = result_queue.get()
+        process.join()
+
+        for name, value in previous_settings.items():
+            setattr(self.task_class, name, value)
+
+        return result
+
+    def _loop_worker(self, result_queue):
+
+        # the worker's own output would get mixed into the JSON
+        sys.stdout = open(os.devnull, 'w')
+
+        runner = BackgroundTaskRunner(BENCH_TABLE_NAME, 0)
+        signal.signal(signal.SIGTERM, lambda signum, frame: runner.shutdown())
+
+        statement_counter = _StatementCounter()
+        try:
+            with connections[self.task_class._get_db_alias()].execute_wrapper(statement_counter):
+                runner.run_loop(self.task_class)
+        finally:
+            result_queue.put({
+                'processed': runner.task_count,
+                'latency_list': self.task_class.latency_list,
+                'statement_count': statement_counter.count,
+            })
+            connections.close_all()
+
+    def _producer(self, start_event, result_queue, task_count):
+
+        start_event.wait()
+
+        statement_counter = _StatementCounter()
+        try:
+            with connections[self.task_class._get_db_alias()].execute_wrapper(statement_counter):
+                for _ in range(task_count):
+                    self.task_class.add_task({'enqueued_at': time.time()})
+        finally:
+            result_queue.put({'statement_count': statement_counter.count})
+            connections.close_all()
+
+    # `total` spread over `count` parts, as evenly as it goes
+    def _split(self, total, count):
+        return [total // count + (1 if i < total % count else 0) for i in range(count)]
+
+    def _per_task(self, result_list, task_count):
+
+        if task_count < 1:
+            return None
+
+        return round(sum([result['statement_count'] for result in result_list]) / task_count, 2)
+
+    def _wait_queue_empty(self, timeout):
+
+        deadline = time.time() + timeout
+        while self.task_class.get_queue_size() > 0 and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _round(self, value):
+
+        if value is None:
+            return None
+
+        return round(value, 4)
+
+    def _enqueue_result(self, method, elapsed):
+        return {
+            'method': method,
+            'enqueued': self.task_class.get_queue_size(),
+            'seconds': round(elapsed, 4),
+            'tasks_per_sec': round(self.task_count / elapsed, 1),
+        }
+
+    def _claim_worker(self, start_event, id_queue):
+
+        start_event.wait()
+
+        claimed_ids = []
+        try:
+            while True:
+                task_list = self.task_class.get_new_task_list()
+
+                if len(task_list) < 1 and not self._has_ready_tasks():
+                    break
+
+                claimed_ids.extend([task.task_id for task in task_list])
+        finally:
+            # the parent waits for every worker to report
+            id_queue.put(claimed_ids)
+            connections.close_all()
+
+    def _has_ready_tasks(self):
+        return self.task_class._get_db_model().objects.filter(need_work__lte=int(time.time())).exists()
+
+    def _fill_queue(self, task_count):
+
+        model = self.task_class._get_db_model()
+        model.objects.all().delete()
+        model.objects.bulk_create(
+            [model(**self.task_class._new_task_row({'n': i}, 0, 0, int(time.time()))) for i in range(task_count)],
+            batch_size=500
+        )
+
+    # rows as the workers write them: 3 rows per task, the last of them a success or (every 100th task) an error,
+    # 100 rows a second up to now, inserted with plain INSERTs, the models would be the slowest part
+    def _fill_logs(self, row_count, chunk_size=10000):
+
+        connection = connections[self.db_alias]
+        quote_name = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)" % (
+            quote_name(self._get_model_list()[1]._meta.db_table),
+            ', '.join([quote_name(column) for column in ('date_added', 'task_id', 'message_type', 'message_json')]),
+        )
+
+        date_start = int(time.time()) - row_count // 100
+        for chunk_start in range(0, row_count, chunk_size):
+            row_list = []
+            for i in range(chunk_start, min(row_count, chunk_start + chunk_size)):
+                task_id = i // 3
+                if i % 3 < 2:
+                    message_type = BackgroundTaskLogger._MESSAGE_TYPE_INFO
+                elif task_id % 100 == 0:
+                    message_type = BackgroundTaskLogger._MESSAGE_TYPE_ERROR
+                else:
+                    message_type = BackgroundTaskLogger._MESSAGE_TYPE_SUCCESS
+                row_list.append((date_start + i // 100, task_id, message_type, json.dumps([{'message_type': message_type, 'message_text': 'message %d' % i}])))
+
+            with transaction.atomic(using=self.db_alias), connection.cursor() as cursor:
+                cursor.executemany(sql, row_list)
+
+    # the queue table, and the logs table for the scenarios that turn logs on
+    def _get_model_list(self):
+        return [
+            self.task_class._get_db_model(),
+            BackgroundTaskLogger(self.task_class.logs_table_name, self.task_class.logs_db_app_name)._get_db_model(),
+        ]
+
+    def _create_table(self):
+
+        self._drop_table()
+        with connections[self.db_alias].schema_editor() as schema_editor:
+            for model in self._get_model_list():
+                schema_editor.create_model(model)
+
+    def _drop_table(self):
+
+        table_names = connections[self.db_alias].introspection.table_names()
+        with connections[self.db_alias].schema_editor() as schema_editor:
+            for model in self._get_model_list():
+                if model._meta.db_table in table_names:
+                    schema_editor.delete_model(model)
+
+
+class _StatementCounter:
+    """ An execute wrapper counting the statements of a connection """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count = self.count + 1
+        return execute(sql, params, many, context)
@@ -0,0 +1,186 @@
+import time
+import signal
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+"""
+Execution modes of a worker: how a claimed batch of tasks is worked on.
+serial - one task after another (default)
+threads - up to `concurrency` tasks at once in a thread pool, for I/O-bound work()
+asyncio - up to `concurrency` tasks at once on an event loop, for `async def work()`
+process_pool - up to `concurrency` tasks at once in forked processes, for CPU-bound work(),
+    only work() itself runs there, claiming and completing stays in the worker process
+Task classes with work_batch() get the whole batch in one call, whatever the mode.
+Every mode finishes the whole batch before returning,
+the runner wraps it into completion_batch() so the batch is completed with a few queries
+"""
+
+
+def get_execution(task_class):
+
+    if task_class.has_work_batch():
+        return BatchExecution(task_class)
+
+    if task_class.execution_mode == 'serial':
+        return SerialExecution(task_class)
+
+    if task_class.execution_mode == 'threads':
+        return ThreadExecution(task_class)
+
+    if task_class.execution_mode == 'asyncio':
+        return AsyncioExecution(task_class)
+
+    if task_class.execution_mode == 'process_pool':
+        return ProcessExecution(task_class)
+
+    raise ValueError("Unknown execution_mode [%s], use serial, threads, asyncio or process_pool" % task_class.execution_mode)
+
+
+class SerialExecution:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+
+    def run_batch(self, task_list):
+        for task in task_list:
+            self.task_class.do_work(task)
+
+    def close(self):
+        pass
+
+
+class BatchExecution:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+
+    def run_batch(self, task_list):
+        self.task_class.do_work_batch(task_list)
+
+    def close(self):
+        pass
+
+
+class ThreadExecution:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+        self.concurrency = task_class.concurrency
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='background_task')
+
+    def run_batch(self, task_list):
+
+        future_list = [self._executor.submit(self.task_class.do_work, task) for task in task_list]
+        wait(future_list)
+
+        # do_work() handles exceptions of work(), anything else is a bug worth crashing the worker on
+        for future in future_list:
+            future.result()
+
+    # every pool thread has its own db connections, a barrier makes sure each thread closes its own
+    def close(self):
+
+        barrier = threading.Barrier(self.concurrency)
+
+        def close_thread_connections():
+            barrier.wait()
+            connections.close_all()
+
+        wait([self._executor.submit(close_thread_connections) for _ in range(self.concurrency)])
+        self._executor.shutdown()
+
+
+class AsyncioExecution:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+        self.concurrency = task_class.concurrency
+        self._loop = asyncio.new_event_loop()
+
+    def run_batch(self, task_list):
+        self._loop.run_until_complete(self._run_batch(task_list))
+
+    def close(self):
+
+        # db work of the tasks runs in asgiref's thread, which has its own connections
+        self._loop.run_until_complete(sync_to_async(connections.close_all)())
+        self._loop.close()
+
+    async def _run_batch(self, task_list):
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_task(task):
+            async with semaphore:
+                await self.task_class.do_work_async(task)
+
+        await asyncio.gather(*[run_task(task) for task in task_list])
+
+
+# the task class of a process_pool child, inherited from the worker process on fork
+_process_task_class = None
+_process_close_barrier = None
+
+
+def _init_process(task_class, close_barrier):
+    global _process_task_class, _process_close_barrier
+
+    _process_task_class = task_class
+    _process_close_barrier = close_barrier
+
+    # ctrl+c goes to the whole process group, stopping is the worker's decision
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _work_in_process(task_row):
+    return _process_task_class._work_in_process(task_row)
+
+
+def _close_process_connections():
+    _process_close_barrier.wait()
+    connections.close_all()
+
+
+class ProcessExecution:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+        self.concurrency = task_class.concurrency
+
+        # the children are forked right away, Django is already set up in them,
+        # and they must not inherit open connections
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        self._executor = ProcessPoolExecutor(
+            self.concurrency,
+            mp_context=context,
+            initializer=_init_process,
+            initargs=(task_class, context.Barrier(self.concurrency))
+        )
+        wait([self._executor.submit(int) for _ in range(self.concurrency)])
+
+    def run_batch(self, task_list):
+
+        pending_list = []
+        for task in task_list:
+            task_state = self.task_class._new_task_state(task)
+            if self.task_class._run_task_step(task_state, self.task_class._start_task, task):
+                pending_list.append((task_state, self._executor.submit(_work_in_process, task)))
+
+        for task_state, future in pending_list:
+            result, error_traceback, message_list, work_seconds = future.result()
+
+            # work_seconds of the metrics is the time of work() in the child, not of waiting for a free one
+            task_state['started_at'] = time.perf_counter() - work_seconds
+            task_state['logger'].add_messages(message_list)
+            self.task_class._run_task_step(task_state, self.task_class._finish_task, result, error_traceback)
+
+    def close(self):
+        wait([self._executor.submit(_close_process_connections) for _ in range(self.concurrency)])
+        self._executor.shutdown()
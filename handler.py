@@ -1,13 +1,34 @@
 import os
+import uuid
+import socket
+import datetime
+import hashlib
+import inspect
+import contextvars
 import time
 import traceback
+from contextlib import contextmanager, nullcontext
+from itertools import islice
 from sys import executable
+from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
-from django.db import models
-from django.forms.models import model_to_dict
-from django.utils.module_loading import import_string
+from django.db import models, router, transaction
+from django.utils import timezone
 from abc import abstractmethod
-from BackgroundTask.logger import BackgroundTaskLogger
+from BackgroundTask.logger import BackgroundTaskLogger, bulk_create_log_rows
+from BackgroundTask.log_writer import get_log_writer
+from BackgroundTask.metrics import NULL_METRICS
+from BackgroundTask.wakeup import get_wakeup
+from BackgroundTask.backends import TaskRecord, get_queue_backend
+from BackgroundTask.payload import encode_payload
+from BackgroundTask.schedule import get_schedule, get_first_run, get_next_run
+from BackgroundTask.registry import get_registered_model, get_model_name, get_index_name, get_task_class
+
+# state of the task that is being worked on: its id and logger
+_current_task = contextvars.ContextVar('background_task_current_task', default=None)
+
+# redis clients of queue_backend = 'redis' by url
+_redis_clients = {}
 
 SCRIPT_PATH = executable + " " + str(settings.BASE_DIR) + "/manage.py"
 RUN_SCRIPT_PATH = SCRIPT_PATH + " background_task_run"
@@ -28,17 +49,31 @@ def get_task_class_list():
 
 
 def get_task_class_instance(task_class_string):
-    task_class = import_string(task_class_string)
+    task_class = get_task_class(task_class_string)
     return task_class()
 
 
+# built once per process, see registry.py
 def get_task_class_db_model(module, db_app_label, table_name) -> models.Model:
+    return get_registered_model('queue', module, db_app_label, table_name, _create_task_class_db_model)
+
+
+def _create_task_class_db_model(module, db_app_label, table_name) -> models.Model:
     class Meta:
         pass
 
     setattr(Meta, 'app_label', db_app_label)
     setattr(Meta, 'db_table', table_name)
 
+    # the poll looks for `need_work <= now`, task_id makes the index covering
+    # the claim takes ready tasks in claim_order, need_work is checked right in the index
+    # the split counts of the monitor tell scheduled tasks from leased ones by claimed_at, then need_work > now
+    setattr(Meta, 'indexes', [
+        models.Index(fields=['need_work', 'task_id'], name=get_index_name(table_name, 'need_work')),
+        models.Index(fields=['claim_order', 'need_work'], name=get_index_name(table_name, 'claim_order')),
+        models.Index(fields=['claimed_at', 'need_work'], name=get_index_name(table_name, 'claimed_at')),
+    ])
+
     # Set up a dictionary to simulate declarations within a class
     attrs = {
         '__module__': module,
@@ -47,11 +82,18 @@ def get_task_class_db_model(module, db_app_label, table_name) -> models.Model:
         'need_work': models.IntegerField(default=0),
         'errors': models.IntegerField(default=0),
         'date_added': models.IntegerField(default=0),
-        'data_json': models.JSONField(),
+        'data_json': models.JSONField(null=True),
+        'data_blob': models.BinaryField(null=True, editable=True),
+        'priority': models.IntegerField(default=0),
+        'claim_order': models.BigIntegerField(default=0),
+        'dedupe_key': models.CharField(max_length=255, null=True, unique=True),
+        'claimed_at': models.IntegerField(default=0),
+        'schedule': models.CharField(max_length=255, null=True),
+        'lease_token': models.CharField(max_length=64, null=True),
     }
 
     # Create the class, which automatically triggers ModelBase processing
-    model = type('BackgroundTaskGeneralModel', (models.Model,), attrs)
+    model = type(get_model_name('BackgroundTaskGeneralModel', module, table_name), (models.Model,), attrs)
 
     return model
 
@@ -75,30 +117,66 @@ class BackgroundTaskHandler:
     worker_count = 1
     busy_interval = 1
     empty_interval = 10
+    adaptive_polling_on = True
+    empty_interval_min = 0.1
+    max_latency = 10
+    wakeup_on = False
+    wakeup_transport = 'auto'
+    execution_mode = 'serial'
+    concurrency = 1
     persistent_queue_on = False
+    queue_backend = 'django'
+    queue_redis_url = 'redis://localhost:6379/0'
+    payload_codec = 'json'
 
     #
     task_limit_per_execution = 2
     task_execution_time = 600
+    priority_aging = 60
+    lease_heartbeat_on = False
+    lease_heartbeat_interval: float = None
 
     # logs and stats
     logs_on = True
     logs_db_app_name = 'default'
     logs_table_name: str = None
     logs_rotate_older: int = 30 # days
+    logs_partition_by: str = None
+    logs_partition_ahead: int = 7
+    logs_async_on = False
+    logs_flush_size: int = 500
+    logs_flush_interval: float = 1.0
+    logs_buffer_max: int = 10000
+
+    # metrics
+    metrics_on = False
+    metrics_dir: str = None
+    metrics_interval = 15
 
     # error handling
     retry_count_max = 3
+    retry_delay: int = None
     overflow_alarm = 10
     need_check_overflow = True
+    queue_size_method = 'bounded'
+    queue_count_limit: int = None
+    queue_counter_cache = 'default'
+    queue_counter_ttl = 3600
 
     # --------------------------------------------------
     # SERVICE ATTRIBUTES
     # --------------------------------------------------
 
-    _task_id: int = None
     _db_model_instance: models.Model = None
     _logger_instance: BackgroundTaskLogger = None
+    _wakeup_instance = None
+    _queue_backend_instance = None
+    _completion_buffer: dict = None
+    _lease_token: str = None
+    _lease_token_pid: int = None
+
+    # set by the worker loop when metrics are on
+    _metrics_instance = NULL_METRICS
 
     # --------------------------------------------------
     # MAIN
@@ -108,103 +186,301 @@ class BackgroundTaskHandler:
     def work(self, data):
         pass
 
+    # optional replacement of work() for tasks that are cheaper to do together,
+    # gets data of the whole claimed batch and returns True/False for every item, in the same order
+    def work_batch(self, data_list) -> list:
+        raise NotImplementedError
+
+    def has_work_batch(self) -> bool:
+        from BackgroundTask.interface import BackgroundTaskInterface
+
+        # the interface re-declares the placeholder for documentation, it doesn't count either
+        return type(self).work_batch not in (BackgroundTaskHandler.work_batch, BackgroundTaskInterface.work_batch)
+
     """ This method is wrapping work(), and controlling the flow"""
 
     def do_work(self, task_row):
 
-        self._task_id = task_row['task_id']
+        token = _current_task.set(self._new_task_state(task_row))
+        try:
+            if not self._start_task(task_row):
+                return
 
-        self.logger().worker().info(
-            "Starting to work on task: [%d], attempt: [%d]" % (task_row['task_id'], task_row['errors']+1),
-            {'task_data': task_row['data_json']}
-        )
+            # working..
+            try:
+                result = self._call_work(task_row.data_json)
+            except Exception as e:
+                self._finish_task(False, traceback.format_exc())
+                return
 
-        # first checking how many attempts this task has, should we even do it
-        if task_row['errors'] > self.retry_count_max:
-            self._on_task_complete(False, "Tried and failed for [%d] times" % task_row['errors'])
+            self._finish_task(result)
+        finally:
+            _current_task.reset(token)
+
+    """ The same as do_work(), for a whole batch with work_batch(), retries and callbacks still apply per task """
+
+    def do_work_batch(self, task_list):
+
+        started_list = []
+        for task_row in task_list:
+            task_state = self._new_task_state(task_row)
+            if self._run_task_step(task_state, self._start_task, task_row):
+                started_list.append(task_state)
+
+        if len(started_list) < 1:
             return
 
-        # working..
+        # working.. whatever work_batch() logs goes into the log of every task of the batch
+        batch_state = self._new_task_state(TaskRecord(None, 0, None))
         try:
-            result = self.work(task_row['data_json'])
+            result_list = self._run_task_step(
+                batch_state, self._call_work_batch, [task_state['data_json'] for task_state in started_list]
+            )
+            error_traceback = None
         except Exception as e:
+            result_list = [False] * len(started_list)
+            error_traceback = traceback.format_exc()
 
-            self.logger().worker().error("An exception happened during the task execution. Traceback will be attached.")
-            self._on_task_complete(False, traceback.format_exc())
-            return
-
-        if not result:
-            self.logger().worker().error("The task returned False as a result. It will be retried")
-            self.on_retry()
-            return
+        message_list = batch_state['logger'].pop_messages() if self.logs_on else []
 
-        self._on_task_complete(True, "The task was completed successfully.")
-        return
+        for task_state, result in zip(started_list, result_list):
+            task_state['logger'].add_messages(message_list)
+            self._run_task_step(task_state, self._finish_task, result, error_traceback)
 
-    def get_new_task_list(self, worker_number):
+    """ The same as do_work(), for the asyncio execution mode, awaits `async def work()` """
 
-        # limit for performance, offset insures workers dont overlap
-        limit = self.task_limit_per_execution
-        offset = worker_number * limit
+    async def do_work_async(self, task_row):
 
-        # select tasks
+        token = _current_task.set(self._new_task_state(task_row))
         try:
-            task_list = self._get_db_model().objects.filter(need_work__lte=int(time.time()))[offset:limit].all()
-        except self._get_db_model().DoesNotExist:
-            return []
+            if not await sync_to_async(self._start_task)(task_row):
+                return
+
+            # working..
+            try:
+                if inspect.iscoroutinefunction(self.work):
+                    result = await self.work(task_row.data_json)
+                else:
+                    result = await sync_to_async(self.work)(task_row.data_json)
+            except Exception as e:
+                await sync_to_async(self._finish_task)(False, traceback.format_exc())
+                return
+
+            await sync_to_async(self._finish_task)(result)
+        finally:
+            _current_task.reset(token)
+
+    # how many tasks are claimed at once, concurrent execution modes need at least `concurrency` of them
+    def get_batch_limit(self) -> int:
+
+        if self.execution_mode == 'serial':
+            return self.task_limit_per_execution
 
-        # making it array with dict-s for clarity
-        result_task_list = []
-        for row in task_list:
-            result_task_list.append(model_to_dict(row))
-            row.need_work = int(time.time()) + self.task_execution_time  # setting need_work here
-            row.errors = row.errors + 1
+        return max(self.task_limit_per_execution, self.concurrency)
 
-        # updating need_work so tasks become unavailable for sometime, in which they will hopefully
-        # be completed and deleted from the table
-        self._get_db_model().objects.bulk_update(task_list, ['need_work', 'errors'], batch_size=3)
+    def get_new_task_list(self, worker_number=0):
 
-        return result_task_list
+        # claiming is atomic, so workers never overlap and worker_number is no longer used for partitioning,
+        # it's kept for compatibility with the runner
+        # a claimed task releases its dedupe_key, so the same work added after the claim is queued again
+        now = int(time.time())
+        lease_until = now + self.task_execution_time
+
+        # TaskRecord-s, the data is already decoded whatever the `payload_codec`
+        return self._get_queue_backend().claim(now, lease_until, self.get_batch_limit(), self.get_lease_token())
+
+    # the claims of this instance in this process hold their tasks with it, and a task is retried, rescheduled
+    # or deleted only while it's still held, so a worker whose lease has run out can't touch a task
+    # that another worker has claimed since
+    def get_lease_token(self) -> str:
+
+        if self._lease_token_pid != os.getpid():
+            self._lease_token = '%s:%d:%s' % (socket.gethostname()[:32], os.getpid(), uuid.uuid4().hex[:8])
+            self._lease_token_pid = os.getpid()
+
+        return self._lease_token
+
+    # pushes the leases of the tasks being worked on forward, see heartbeat.py
+    # returns how many of them were still held
+    def extend_leases(self, task_ids) -> int:
+
+        lease_until = int(time.time()) + self.task_execution_time
+
+        return self._get_queue_backend().extend(task_ids, lease_until, self.get_lease_token())
 
     # for adding tasks from anywhere in your code (usually from views)
     # one quick sql insert will be made
     # be conscious about putting lots of data into data, it can impact the amount of memory workers will occupy
     # need_work = is timestamp as int(time.time()) when the task should be run, runs immediately by default
-    def add_task(self, data_dict: dict, need_work: int = 0):
-
-        model = self._get_db_model()
-        model_inst = model(
-            need_work=need_work,
-            date_added=int(time.time()),
-            data_json=data_dict
-        )
-        model_inst.save()
+    # priority = tasks with higher priority are taken first, see `priority_aging`
+    # dedupe_key = while a task with the same key is waiting in the queue no new task is added,
+    # dedupe_refresh = True moves need_work of the waiting task to the new one instead (e.g. for debouncing)
+    # the key is released when a worker takes the task, so work added after that is queued again
+    # run_at = need_work as a timestamp or a datetime (a naive one is in the TIME_ZONE of the settings)
+    # every = seconds, cron = '*/5 * * * *' - a recurring task, one row that is run again and again, see schedule.py
+    # with a dedupe_key a recurring task keeps it for good, so adding it on every deploy leaves one row per job,
+    # and dedupe_refresh = True moves the job to a changed schedule
+    def add_task(self, data_dict: dict, need_work: int = 0, priority: int = 0, dedupe_key: str = None,
+                 dedupe_refresh: bool = False, run_at=None, every: int = None, cron: str = None):
+
+        now = int(time.time())
+        schedule = get_schedule(every, cron)
+
+        if run_at is not None:
+            need_work = self._get_timestamp(run_at)
+        elif schedule is not None:
+            need_work = get_first_run(schedule, now)
+
+        task = self._new_task_row(data_dict, need_work, priority, now, dedupe_key, schedule)
+        self._get_queue_backend().add([task], dedupe_refresh)
+
+        self._wakeup_workers()
+
+    # for enqueueing lots of tasks at once (fan-outs), rows are inserted with multi-row INSERTs of `batch_size`
+    # data_iterable can be a generator, only one batch is kept in memory at a time
+    # atomic = all batches are inserted in a single transaction, either all tasks get into the queue or none
+    # (django backend only, the redis backend adds every batch atomically on its own)
+    # returns the number of added tasks, or their task_id-s with return_ids=True
+    # (the backend must support returning rows from bulk inserts, otherwise ids are None)
+    def add_tasks(self, data_iterable, need_work: int = 0, batch_size: int = 500, atomic: bool = True, return_ids: bool = False,
+                  priority: int = 0):
+
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1, got [%s]" % batch_size)
+
+        backend = self._get_queue_backend()
+        data_iterator = iter(data_iterable)
+
+        task_count = 0
+        task_ids = []
+        with backend.atomic() if atomic else nullcontext():
+            while True:
+                date_added = int(time.time())
+                batch = [
+                    self._new_task_row(data_dict, need_work, priority, date_added)
+                    for data_dict in islice(data_iterator, batch_size)
+                ]
+                if len(batch) < 1:
+                    break
+
+                batch_task_ids = backend.add(batch)
+                task_count = task_count + len(batch)
+
+                if return_ids:
+                    task_ids.extend(batch_task_ids)
+
+        if task_count > 0:
+            self._wakeup_workers()
+
+        if return_ids:
+            return task_ids
+
+        return task_count
+
+    # claim_order is the time the task is served by: the more priority, the earlier,
+    # so a task waiting longer than `priority_aging` seconds per priority level gets ahead of a newer prioritized one.
+    # the wait counts from need_work when it's later, a task scheduled for tomorrow hasn't been waiting since today
+    # with a `payload_codec` other than json the data goes to data_blob, and data_json is NULL
+    def _new_task_row(self, data_dict, need_work, priority, date_added, dedupe_key=None, schedule=None) -> dict:
+
+        data_blob = encode_payload(self.payload_codec, data_dict)
+
+        return {
+            'need_work': need_work,
+            'date_added': date_added,
+            'data_json': data_dict if data_blob is None else None,
+            'data_blob': data_blob,
+            'priority': priority,
+            'claim_order': max(date_added, need_work) - priority * self.priority_aging,
+            'dedupe_key': dedupe_key,
+            'schedule': schedule,
+        }
+
+    def _get_timestamp(self, run_at) -> int:
+
+        if not isinstance(run_at, datetime.datetime):
+            return int(run_at)
+
+        if timezone.is_naive(run_at):
+            run_at = timezone.make_aware(run_at, timezone.get_default_timezone())
+
+        return int(run_at.timestamp())
 
     # through it we write logs into the logs table, if it's on
+    # inside work() it's the logger of the current task
     def logger(self) -> BackgroundTaskLogger:
 
+        task_state = self._get_task_state()
+        if task_state is not None:
+            return task_state['logger']
+
+        return self._get_instance_logger()
+
+    def _get_instance_logger(self) -> BackgroundTaskLogger:
+
         if self._logger_instance is not None:
             return self._logger_instance
 
         # controlling if we need logs
         if self.logs_on:
-            self._logger_instance = BackgroundTaskLogger(self.logs_table_name, self.logs_db_app_name)
+            self._logger_instance = BackgroundTaskLogger(
+                self.logs_table_name, self.logs_db_app_name, self.logs_partition_by, self.logs_partition_ahead
+            )
+            if self.logs_async_on:
+                self._logger_instance.writer = get_log_writer(
+                    self._logger_instance._get_db_model(), self.logs_flush_size, self.logs_flush_interval, self.logs_buffer_max
+                )
         else:
             from unittest.mock import Mock
             self._logger_instance = Mock()
 
         return self._logger_instance
 
-    #
-    def get_queue_size(self):
+    # for queue_backend = 'redis', can be overridden to use a stand-in like fakeredis
+    # one client (and its connection pool) per url in the process
+    def get_redis_client(self):
+        import redis
 
-        # select tasks
-        try:
-            tasks_count = self._get_db_model().objects.count()
-        except self._get_db_model().DoesNotExist:
-            return 0
+        if self.queue_redis_url not in _redis_clients:
+            _redis_clients[self.queue_redis_url] = redis.Redis.from_url(self.queue_redis_url)
+
+        return _redis_clients[self.queue_redis_url]
+
+    # name of the channel workers of this queue are woken up through
+    def get_wakeup_channel(self) -> str:
+        return 'bt_%s_wakeup' % hashlib.md5(self.table_name.encode()).hexdigest()[:10]
+
+    # the way it's counted depends on `queue_size_method`, by default it's exact up to `overflow_alarm`
+    # (always exact with the memory and redis backends)
+    def get_queue_size(self) -> int:
+
+        queue_size, is_exact = self._get_queue_backend().size()
+
+        return queue_size
 
-        return tasks_count
+    # the queue size and what its tasks are doing, every split count is bounded by get_queue_count_limit()
+    # (exact with queue_size_method = 'count'):
+    # ready - can be claimed right now, including tasks of dead workers whose lease has run out
+    # scheduled - waiting for their need_work, added for later or failed and waiting for `retry_delay`
+    # in_flight - claimed by workers and not finished yet, failed ones without `retry_delay` wait here till the lease ends
+    def get_queue_stats(self) -> dict:
+
+        backend = self._get_queue_backend()
+        queue_size, is_exact = backend.size()
+
+        limit = None if self.queue_size_method == 'count' else self.get_queue_count_limit()
+
+        queue_stats = {'size': queue_size, 'size_exact': is_exact}
+        queue_stats.update(backend.get_split_counts(int(time.time()), limit))
+
+        return queue_stats
+
+    def get_queue_count_limit(self) -> int:
+
+        if self.queue_count_limit is not None:
+            return self.queue_count_limit
+
+        return self.overflow_alarm + 1
 
     # --------------------------------------------------
     # USER-CUSTOM MISCELLANEOUS
@@ -237,24 +513,254 @@ class BackgroundTaskHandler:
         if is_success:
             if message is not None:
                 self.logger().worker().success(message)
+            self._metrics_instance.count_task('ok')
             self.on_ok()
         else:
             if message is not None:
                 self.logger().worker().error(message)
+            self._metrics_instance.count_task('fail')
             self.on_fail()
 
 
+        # a recurring task stays in the queue till its next run
+        if self._get_task_state()['schedule'] is not None:
+            self._reschedule_task()
+            self._save_log()
+            return
+
         # in this mode we keep the tasks running forever
         if self.persistent_queue_on:
-            self.logger().save()
+            self._save_log()
             return
 
         self.logger().worker().info("Deleting the task from the queue table.")
         self._delete_task()
-        self.logger().save()
+        self._save_log()
+
+    # waking idle workers up once the new tasks are committed
+    def _wakeup_workers(self):
+
+        if not self.wakeup_on:
+            return
+
+        if self._wakeup_instance is None:
+            self._wakeup_instance = get_wakeup(self)
+
+        self._get_queue_backend().on_commit(self._wakeup_instance.notify)
+
+    # returns False if the task shouldn't be worked on
+    def _start_task(self, task_row) -> bool:
+
+        self._metrics_instance.observe_wait(task_row)
+
+        self.logger().worker().info(
+            "Starting to work on task: [%d], attempt: [%d]" % (task_row.task_id, task_row.errors+1),
+            {'task_data': task_row.data_json}
+        )
+
+        # first checking how many attempts this task has, should we even do it
+        if task_row.errors > self.retry_count_max:
+            self._on_task_complete(False, "Tried and failed for [%d] times" % task_row.errors)
+            return False
+
+        return True
+
+    # error_traceback is set when work() has raised an exception
+    def _finish_task(self, result, error_traceback=None):
+
+        self._metrics_instance.observe_work(time.perf_counter() - self._get_task_state()['started_at'])
+
+        if error_traceback is not None:
+            self.logger().worker().error("An exception happened during the task execution. Traceback will be attached.")
+            self._on_task_complete(False, error_traceback)
+            return
+
+        if not result:
+            self.logger().worker().error("The task returned False as a result. It will be retried")
+            self._metrics_instance.count_task('retry')
+            self.on_retry()
+            self._schedule_retry()
+            self._save_log()
+            return
+
+        self._on_task_complete(True, "The task was completed successfully.")
+
+    # `async def work()` is also fine in the serial and threads modes, it's just run to completion
+    def _call_work(self, data):
+
+        if inspect.iscoroutinefunction(self.work):
+            return async_to_sync(self.work)(data)
+
+        return self.work(data)
+
+    def _call_work_batch(self, data_list):
+
+        if inspect.iscoroutinefunction(self.work_batch):
+            result_list = async_to_sync(self.work_batch)(data_list)
+        else:
+            result_list = self.work_batch(data_list)
+
+        result_list = list(result_list)
+        if len(result_list) != len(data_list):
+            raise ValueError("work_batch() returned %d results for %d tasks" % (len(result_list), len(data_list)))
+
+        return result_list
+
+    # every task gets its own id and logger, so tasks of one instance can run concurrently
+    def _new_task_state(self, task_row):
+
+        if self.logs_on:
+            task_logger = self._get_instance_logger().for_task(task_row.task_id)
+        else:
+            task_logger = self._get_instance_logger()
+
+        return {
+            'handler': self,
+            'task_id': task_row.task_id,
+            'data_json': task_row.data_json,
+            'logger': task_logger,
+            'started_at': time.perf_counter(),
+            'started_time': int(time.time()),
+            'schedule': task_row.schedule,
+        }
+
+    def _get_task_state(self):
+
+        task_state = _current_task.get()
+        if task_state is None or task_state['handler'] is not self:
+            return None
+
+        return task_state
+
+    @property
+    def _task_id(self):
+
+        task_state = self._get_task_state()
+        if task_state is None:
+            return None
+
+        return task_state['task_id']
 
     def _delete_task(self):
-        self._get_db_model().objects.filter(pk=self._task_id).delete()
+
+        # inside a completion batch the delete is postponed till the batch is flushed
+        if self._completion_buffer is not None:
+            self._completion_buffer['delete_ids'].append(self._task_id)
+            return
+
+        self._get_queue_backend().delete([self._task_id], self.get_lease_token())
+
+    # need_work of the next run, errors start over
+    def _reschedule_task(self):
+
+        task_state = self._get_task_state()
+        next_run = get_next_run(task_state['schedule'], task_state['started_time'], int(time.time()))
+        self.logger().worker().info("Scheduling the next run of the task: [%d]" % next_run)
+
+        if self._completion_buffer is not None:
+            self._completion_buffer['next_runs'][self._task_id] = next_run
+            return
+
+        self._get_queue_backend().reschedule({self._task_id: next_run}, self.priority_aging, self.get_lease_token())
+
+    # without `retry_delay` a failed task is retried when its lease (`task_execution_time`) runs out
+    def _schedule_retry(self):
+
+        if self.retry_delay is None:
+            return
+
+        if self._completion_buffer is not None:
+            self._completion_buffer['retry_ids'].append(self._task_id)
+            return
+
+        self._get_queue_backend().retry(
+            [self._task_id], int(time.time()) + self.retry_delay, self.priority_aging, self.get_lease_token()
+        )
+
+    def _save_log(self):
+
+        if not self.logs_on:
+            return
+
+        # the async writer batches rows itself
+        if self._completion_buffer is not None and not self.logs_async_on:
+            self._completion_buffer['log_rows'].append(self.logger().pop_row())
+            return
+
+        self.logger().save()
+
+    # waits till the logs of the tasks done so far are written, for the async writer
+    def flush_logs(self):
+
+        if self.logs_on and self.logs_async_on:
+            self._get_instance_logger().writer.flush()
+
+    # within the block tasks of a batch are completed all at once: one INSERT for all the logs,
+    # one UPDATE for the retries (and one per next run of recurring tasks) and one DELETE for the finished tasks
+    # logs are committed no later than the deletes, so a task is never deleted without its log
+    @contextmanager
+    def completion_batch(self):
+
+        self._completion_buffer = {'delete_ids': [], 'retry_ids': [], 'next_runs': {}, 'log_rows': []}
+        try:
+            yield
+        finally:
+            # tasks that are already finished must be flushed even if the batch broke on another one
+            completion_buffer = self._completion_buffer
+            self._completion_buffer = None
+            self._flush_completion_buffer(completion_buffer)
+
+    def _flush_completion_buffer(self, completion_buffer):
+
+        if not any(completion_buffer.values()):
+            return
+
+        backend = self._get_queue_backend()
+        lease_token = self.get_lease_token()
+
+        with backend.atomic():
+
+            if completion_buffer['log_rows']:
+                logs_alias = router.db_for_write(completion_buffer['log_rows'][0].__class__)
+                with transaction.atomic(using=logs_alias):
+                    bulk_create_log_rows(completion_buffer['log_rows'])
+
+            if completion_buffer['retry_ids']:
+                backend.retry(completion_buffer['retry_ids'], int(time.time()) + self.retry_delay, self.priority_aging, lease_token)
+
+            if completion_buffer['next_runs']:
+                backend.reschedule(completion_buffer['next_runs'], self.priority_aging, lease_token)
+
+            if completion_buffer['delete_ids']:
+                backend.delete(completion_buffer['delete_ids'], lease_token)
+
+    # process_pool mode: runs in a pool process, the parent process finishes the task with the result
+    # returns (result, error traceback, messages logged by work(), seconds work() took)
+    def _work_in_process(self, task_row):
+
+        task_state = self._new_task_state(task_row)
+        token = _current_task.set(task_state)
+        try:
+            result = bool(self._call_work(task_row.data_json))
+            error_traceback = None
+        except Exception as e:
+            result = False
+            error_traceback = traceback.format_exc()
+        finally:
+            _current_task.reset(token)
+
+        message_list = task_state['logger'].pop_messages() if self.logs_on else []
+
+        return result, error_traceback, message_list, time.perf_counter() - task_state['started_at']
+
+    # runs one step of a task's flow (_start_task, _finish_task) with the task's state
+    def _run_task_step(self, task_state, step, *args):
+
+        token = _current_task.set(task_state)
+        try:
+            return step(*args)
+        finally:
+            _current_task.reset(token)
 
     # --------------------------------------------------
     # PROTECTED UTILS
@@ -269,3 +775,14 @@ class BackgroundTaskHandler:
         self._db_model_instance = get_task_class_db_model(self.__module__, self.db_app_label, self.table_name)
 
         return self._db_model_instance
+
+    def _get_queue_backend(self):
+
+        if self._queue_backend_instance is None:
+            self._queue_backend_instance = get_queue_backend(self)
+
+        return self._queue_backend_instance
+
+    # database alias the queue model reads and writes through
+    def _get_db_alias(self) -> str:
+        return router.db_for_write(self._get_db_model())
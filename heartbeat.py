@@ -0,0 +1,128 @@
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from django.db import connections
+
+"""
+Lease heartbeat of the worker loop, for `lease_heartbeat_on`.
+A claimed task is leased till now + `task_execution_time`, a task that isn't finished by then is claimed again.
+While a batch is worked on, a thread of the worker extends the leases of its tasks every `lease_heartbeat_interval`
+seconds (a third of `task_execution_time` by default) with one UPDATE, or one script on redis.
+So `task_execution_time` can be lowered to seconds: tasks of a crashed worker are back in the queue right away,
+and slow tasks aren't taken twice while they're still being worked on.
+Leases belong to the token of the claiming worker (see get_lease_token()), a worker that has lost one anyway
+(a long GC pause, a dead database connection) can't extend it, and can't delete or retry the task either.
+Turned off, the worker loop gets NULL_HEARTBEAT, whose methods do nothing
+"""
+
+
+def get_heartbeat(task_class):
+
+    if not task_class.lease_heartbeat_on:
+        return NULL_HEARTBEAT
+
+    return LeaseHeartbeat(task_class)
+
+
+class LeaseHeartbeat:
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+        self.interval = task_class.lease_heartbeat_interval
+        if self.interval is None:
+            self.interval = task_class.task_execution_time / 3
+
+        # leases that were found lost, their tasks may be done twice
+        self.lost_lease_count = 0
+
+        self._lock = threading.Lock()
+        self._task_ids = set()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    # the leases of the tasks are extended till the end of the block,
+    # which has to end before the tasks are finished (deleted or retried)
+    @contextmanager
+    def leasing(self, task_list):
+
+        if len(task_list) < 1:
+            yield
+            return
+
+        task_ids = {task_row.task_id for task_row in task_list}
+        with self._lock:
+            self._task_ids.update(task_ids)
+        self._ensure_thread()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._task_ids.difference_update(task_ids)
+
+    def stop(self):
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    def _ensure_thread(self):
+
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='background_task_heartbeat', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+
+        try:
+            while not self._stop_event.wait(self.interval):
+                with self._lock:
+                    task_ids = list(self._task_ids)
+
+                if len(task_ids) > 0:
+                    self._beat(task_ids)
+        finally:
+            # connections of this thread
+            connections.close_all()
+
+    # a failed beat is retried on the next one, the leases are good for two more of them by default
+    def _beat(self, task_ids):
+
+        try:
+            extended_count = self.task_class.extend_leases(task_ids)
+        except Exception:
+            logging.getLogger('background_task').exception("Could not extend the leases of %d tasks" % len(task_ids))
+            connections.close_all()
+            return
+
+        # tasks let go meanwhile may have been finished already, they aren't lost
+        with self._lock:
+            still_leased = all(task_id in self._task_ids for task_id in task_ids)
+        if still_leased and extended_count < len(task_ids):
+            self.lost_lease_count = self.lost_lease_count + len(task_ids) - extended_count
+            logging.getLogger('background_task').warning(
+                "%d of %d leases were lost, their tasks may be done twice, raise `task_execution_time`"
+                % (len(task_ids) - extended_count, len(task_ids))
+            )
+
+
+class NullHeartbeat:
+
+    def leasing(self, task_list):
+        return nullcontext()
+
+    def stop(self):
+        pass
+
+
+NULL_HEARTBEAT = NullHeartbeat()
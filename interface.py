@@ -23,10 +23,56 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
     # sleep interval of the script when there are NO tasks in the queue (seconds)
     empty_interval:int = 10
 
+    # adaptive polling replaces the two intervals above:
+    # while batches come back full the worker doesn't sleep at all,
+    # when the queue is drained it sleeps starting from `empty_interval_min`,
+    # doubling it (with jitter) on every empty poll up to `max_latency`
+    adaptive_polling_on = True
+    empty_interval_min:float = 0.1
+
+    # the longest a new task can wait for an idle worker to notice it (seconds)
+    max_latency:float = 10
+
+    # add_task() wakes idle workers up right away, polling stays as a safety net
+    # transports: 'postgres' (LISTEN/NOTIFY), 'socket' (unix sockets in lockfiles/, workers and
+    # web processes must share the host), 'auto' picks postgres for PostgreSQL and socket for the rest
+    wakeup_on = False
+    wakeup_transport:str = 'auto'
+
+    # where the queue is kept:
+    # 'django' - the queue table in `db_app_label` database
+    # 'redis' - sorted sets in Redis at `queue_redis_url` (needs the redis package), for the hottest queues,
+    #   a lease that runs out (`task_execution_time`) makes the task visible again, like in the table
+    # 'memory' - in the memory of the process, for tests and benchmarks, tasks are lost when it exits
+    # logs go to the logs table whatever the backend
+    queue_backend:str = 'django'
+    queue_redis_url:str = 'redis://localhost:6379/0'
+
+    # how the task data is stored:
+    # 'json' - as JSON in data_json
+    # 'msgpack' - msgpack in data_blob (needs the msgpack package), smaller than JSON and faster to decode
+    # 'json+zlib', 'msgpack+zlib' - compressed, for big payloads (texts, html, long lists)
+    # work() gets the same decoded data whatever the codec, it can be changed with tasks in the queue,
+    # run --migrate after switching from json on an existing table
+    payload_codec:str = 'json'
+
     # when it False tasks are deleted from table on completion
     # if True, then they work forever with a period of `task_execution_time`
+    # for periodic jobs add_task(data, every=3600) or add_task(data, cron='0 3 * * *') is the better fit,
+    # a recurring task is rescheduled on completion whatever this setting (run --migrate first, see schedule.py)
     persistent_queue_on = False
 
+    # how a worker runs its tasks:
+    # 'serial' - one after another
+    # 'threads' - up to `concurrency` tasks at once in threads, for I/O-bound work() (http, smtp, etc.)
+    # 'asyncio' - up to `concurrency` tasks at once on an event loop, write `async def work(self, data)`
+    # 'process_pool' - up to `concurrency` tasks at once in forked processes, for CPU-bound work(),
+    #   only the worker polls the queue, the data and the result of work() must be picklable
+    # in concurrent modes at least `concurrency` tasks are claimed at once,
+    # and the next batch is claimed after the whole batch is done
+    execution_mode:str = 'serial'
+    concurrency:int = 1
+
     # --------------------------------------------------
     # ETC
     # --------------------------------------------------
@@ -35,11 +81,26 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
     # 1 is mostly okay, if the task is light and abundant (and the queue is high with =1) then can be increased up to 10
     task_limit_per_execution:int = 2
 
+    # tasks added with a higher `priority` are taken first, but not forever:
+    # every priority level is worth this many seconds of waiting in the queue,
+    # e.g. with 60 a task with priority=10 is taken before normal tasks added less than 10 minutes before it,
+    # the wait of a scheduled or retried task counts from its need_work
+    # changing it doesn't affect tasks that are already in the queue
+    priority_aging:int = 60
+
     # assumes that your single task doesn't take NO more than 10 min to complete
     # can be changed to anything, this also the time with which tasks will be
     # retried in case of a failure, if you decrease it less than the execution time - bad things will start to happen
+    # (unless `lease_heartbeat_on`)
     task_execution_time:int = 600
 
+    # the worker extends the leases of the tasks it's working on every `lease_heartbeat_interval` seconds
+    # (None - a third of `task_execution_time`), so `task_execution_time` can be a few seconds:
+    # tasks of a crashed worker are back quickly, and slow ones are still never taken twice (see heartbeat.py)
+    # leases are counted in whole seconds, so keep `task_execution_time` at 3 or more, run --migrate first
+    lease_heartbeat_on = False
+    lease_heartbeat_interval:float = None
+
     # --------------------------------------------------
     # LOGS AND STATS
     # --------------------------------------------------
@@ -55,6 +116,35 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
     # how many logs to keep
     logs_rotate_older: int = 30  # days
 
+    # 'day' or 'week' - the logs table is partitioned (see log_partitions.py), and logrotate drops
+    # old partitions instead of deleting rows. Partitions are created `logs_partition_ahead` periods ahead
+    # by --migrate and --logrotate. An existing table isn't converted, --migrate asks to rename it
+    logs_partition_by: str = None
+    logs_partition_ahead: int = 7
+
+    # logs are written by a background thread of the worker, off the path of the tasks (see log_writer.py):
+    # every `logs_flush_size` rows or `logs_flush_interval` seconds, whichever comes first.
+    # When `logs_buffer_max` rows are waiting info messages are dropped, the rest waits for room.
+    # Logs may then be written after their tasks are deleted, and rows waiting when the process is killed are lost
+    logs_async_on = False
+    logs_flush_size: int = 500
+    logs_flush_interval: float = 1.0  # seconds
+    logs_buffer_max: int = 10000
+
+    # --------------------------------------------------
+    # METRICS
+    # --------------------------------------------------
+
+    # counters and histograms of the workers in the Prometheus text format (see metrics.py):
+    # claim time, batch sizes, work() time, queue wait, results, database statements
+    metrics_on = False
+
+    # where every worker writes its <table_name>_<worker_number>.prom file, by default background_task_metrics/ in the temp folder
+    metrics_dir:str = None
+
+    # how often the file is written (seconds)
+    metrics_interval:int = 15
+
     # --------------------------------------------------
     # ERROR HANDLING
     # --------------------------------------------------
@@ -62,6 +152,9 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
     # how many times to retry after a failure (return False by work())
     retry_count_max:int = 3
 
+    # in how many seconds a failed task is retried, by default when `task_execution_time` runs out
+    retry_delay:int = None
+
     # if set to True, every 15 minutes a cron will be checking queue size
     # and if it's exceeds `overflow_alarm` it will fire `on_overflow()`
     need_check_overflow = True
@@ -69,6 +162,19 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
     # max queue size to call the alarm
     overflow_alarm:int = 10
 
+    # how get_queue_size() (and so the overflow check) counts the queue:
+    # 'count' - exact COUNT(*), on big tables it's a full scan
+    # 'bounded' - counts no more than `queue_count_limit` rows, exact while the queue is smaller
+    # 'estimate' - table statistics on PostgreSQL and MySQL (may be off by a lot on small or fresh tables), bounded elsewhere
+    # 'counter' - a counter kept in the `queue_counter_cache` Django cache (must be shared between processes),
+    #   recounted exactly every `queue_counter_ttl` seconds
+    queue_size_method:str = 'bounded'
+
+    # None = `overflow_alarm` + 1, just enough for the alarm
+    queue_count_limit:int = None
+    queue_counter_cache:str = 'default'
+    queue_counter_ttl:int = 3600
+
     def __init__(self):
 
         if self.table_name is None:
@@ -95,6 +201,17 @@ class BackgroundTaskInterface(BackgroundTaskHandler):
         # `retry_count_max` times, set it to 0 if you don't need to
         pass
 
+    """
+        optional, implement it instead of work() when tasks are cheaper to do together
+        (one smtp connection for a batch of emails, one insert for a batch of stats, etc.)
+        data_list - data of every task in the claimed batch, up to `task_limit_per_execution` of them
+        return a list of True/False for every item in the same order, retries work per task as with work()
+        an exception fails the whole batch
+    """
+
+    def work_batch(self, data_list) -> list:
+        raise NotImplementedError
+
     # --------------------------------------------------
     # MISCELLANEOUS
     # --------------------------------------------------
@@ -0,0 +1,323 @@
+import re
+import time
+import calendar
+from django.db import connections, router
+
+"""
+Partitioned logs tables, picked with `logs_partition_by` of the task class ('day' or 'week').
+Rotation drops whole partitions instead of deleting rows, so it takes the same time whatever the volume.
+postgresql - a native partitioned table, PARTITION BY RANGE (date_added), partitions are tables <logs table>_d20261018
+mysql - a native partitioned table, PARTITION BY RANGE (date_added), partitions are named d20261018
+others (sqlite) - a table per period, <logs table>_d20261018, nothing is stored in the logs table itself
+Partitions (w20261012 for weeks, from monday) are created for the current and `ahead` next periods
+by --migrate and by the daily --logrotate, a row of a period without a partition can't be inserted on
+postgresql and mysql, so the cron must not stop for longer than `ahead` periods.
+Periods are in UTC
+"""
+
+PERIOD_SECONDS = {'day': 86400, 'week': 7 * 86400}
+
+# weeks start on mondays, the first one after the epoch is 1970-01-05
+WEEK_OFFSET = 4 * 86400
+
+
+# get_period_model(table_name) returns the logs model of a table, for tables per period
+def get_log_partitions(model, period, ahead, get_period_model):
+
+    if period not in PERIOD_SECONDS:
+        raise ValueError("Unknown logs_partition_by [%s], use day or week" % period)
+
+    alias = router.db_for_write(model)
+    vendor = connections[alias].vendor
+
+    if vendor == 'postgresql':
+        return PostgresLogPartitions(model, alias, period, ahead)
+
+    if vendor == 'mysql':
+        return MysqlLogPartitions(model, alias, period, ahead)
+
+    return TableLogPartitions(model, alias, period, ahead, get_period_model)
+
+
+class LogPartitions:
+
+    def __init__(self, model, alias, period, ahead):
+        self.model = model
+        self.alias = alias
+        self.period = period
+        self.ahead = ahead
+        self.table_name = model._meta.db_table
+        self.period_seconds = PERIOD_SECONDS[period]
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    # the model rows added at `timestamp` are inserted with
+    def get_write_model(self, timestamp):
+        return self.model
+
+    # models to read from, the newest rows first
+    def get_read_model_list(self) -> list:
+        return [self.model]
+
+    # creates what is missing: the table and the partitions of the current and `ahead` next periods
+    # returns the list of changes
+    def migrate(self, now=None) -> list:
+
+        if now is None:
+            now = int(time.time())
+
+        if not self._table_exists():
+            self._create_table(self._get_missing_range_list([], now))
+            return ["created partitioned table [%s]" % self.table_name]
+
+        range_list = self._get_missing_range_list(self._get_partition_list(), now)
+        if len(range_list) > 0:
+            self._add_partitions(range_list)
+
+        return ["added partition [%s]" % name for name, start, end in range_list]
+
+    # drops the partitions which have only rows with date_added <= timestamp, returns their names
+    def drop_older_than(self, timestamp) -> list:
+
+        name_list = [name for name, start, end in self._get_partition_list() if end <= timestamp + 1]
+        if len(name_list) > 0:
+            self._drop_partitions(name_list)
+
+        return name_list
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    def _table_exists(self) -> bool:
+        return self.table_name in connections[self.alias].introspection.table_names()
+
+    # the periods to create partitions for, skipping the ones that overlap existing partitions
+    # (which may be of another period, if logs_partition_by was changed)
+    def _get_missing_range_list(self, partition_list, now) -> list:
+
+        range_list = []
+        start = self._get_period_start(now)
+        for _ in range(self.ahead + 1):
+            end = start + self.period_seconds
+            if not any(start < partition_end and partition_start < end for name, partition_start, partition_end in partition_list):
+                range_list.append((self._get_partition_name(start), start, end))
+            start = end
+
+        return range_list
+
+    def _get_period_start(self, timestamp) -> int:
+
+        offset = WEEK_OFFSET if self.period == 'week' else 0
+
+        return timestamp - (timestamp - offset) % self.period_seconds
+
+    def _get_partition_name(self, start) -> str:
+        return self.period[0] + time.strftime('%Y%m%d', time.gmtime(start))
+
+    # (name, start, end), the name tells the range, None for anything else
+    def _parse_partition_name(self, name):
+
+        match = re.fullmatch(r'([dw])(\d{8})', name)
+        if match is None:
+            return None
+
+        start = calendar.timegm(time.strptime(match.group(2), '%Y%m%d'))
+        period = 'day' if match.group(1) == 'd' else 'week'
+
+        return name, start, start + PERIOD_SECONDS[period]
+
+    # columns of the model, the primary key has to include the partitioning column
+    def _get_column_sql(self, schema_editor, id_sql) -> str:
+
+        quote_name = schema_editor.quote_name
+        column_list = [quote_name('id') + ' ' + id_sql]
+        for field in self.model._meta.local_fields:
+            if field.column == 'id':
+                continue
+            column_list.append(quote_name(field.column) + ' ' + schema_editor.column_sql(self.model, field)[0])
+        column_list.append('PRIMARY KEY (%s, %s)' % (quote_name('id'), quote_name('date_added')))
+
+        return ', '.join(column_list)
+
+
+class PostgresLogPartitions(LogPartitions):
+
+    def _get_partition_list(self) -> list:
+
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [self.table_name])
+            if cursor.fetchone() is None:
+                raise ValueError("Table [%s] is not partitioned, rename it to keep the old logs and run --migrate again" % self.table_name)
+
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+                [self.table_name]
+            )
+            table_name_list = [row[0] for row in cursor.fetchall()]
+
+        partition_list = [self._parse_partition_name(name[len(self.table_name) + 1:]) for name in table_name_list]
+
+        return [partition for partition in partition_list if partition is not None]
+
+    def _create_table(self, range_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            schema_editor.execute("CREATE TABLE %s (%s) PARTITION BY RANGE (%s)" % (
+                schema_editor.quote_name(self.table_name),
+                self._get_column_sql(schema_editor, 'serial NOT NULL'),
+                schema_editor.quote_name('date_added'),
+            ))
+            for index in self.model._meta.indexes:
+                schema_editor.add_index(self.model, index)
+
+        self._add_partitions(range_list)
+
+    def _add_partitions(self, range_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            for name, start, end in range_list:
+                schema_editor.execute("CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%d) TO (%d)" % (
+                    schema_editor.quote_name(self.table_name + '_' + name), schema_editor.quote_name(self.table_name), start, end
+                ))
+
+    def _drop_partitions(self, name_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            schema_editor.execute("DROP TABLE %s" % ', '.join(
+                [schema_editor.quote_name(self.table_name + '_' + name) for name in name_list]
+            ))
+
+
+class MysqlLogPartitions(LogPartitions):
+
+    # the end of a partition is its real upper bound, partitions of mysql have no lower ones
+    def _get_partition_list(self) -> list:
+
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(
+                "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [self.table_name]
+            )
+            row_list = cursor.fetchall()
+
+        if len(row_list) < 1 or row_list[0][0] is None:
+            raise ValueError("Table [%s] is not partitioned, rename it to keep the old logs and run --migrate again" % self.table_name)
+
+        partition_list = []
+        for name, description in row_list:
+            partition = self._parse_partition_name(name)
+            if partition is not None:
+                partition_list.append((name, partition[1], int(description)))
+
+        return partition_list
+
+    # partitions can only be added after the last one
+    def _get_missing_range_list(self, partition_list, now) -> list:
+
+        last_end = max([end for name, start, end in partition_list], default=0)
+
+        return [
+            (name, start, end) for name, start, end in super()._get_missing_range_list(partition_list, now)
+            if start >= last_end
+        ]
+
+    def _create_table(self, range_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            schema_editor.execute("CREATE TABLE %s (%s) PARTITION BY RANGE (%s) (%s)" % (
+                schema_editor.quote_name(self.table_name),
+                self._get_column_sql(schema_editor, 'integer AUTO_INCREMENT NOT NULL'),
+                schema_editor.quote_name('date_added'),
+                self._get_partition_sql(range_list),
+            ))
+            for index in self.model._meta.indexes:
+                schema_editor.add_index(self.model, index)
+
+    def _add_partitions(self, range_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            schema_editor.execute("ALTER TABLE %s ADD PARTITION (%s)" % (
+                schema_editor.quote_name(self.table_name), self._get_partition_sql(range_list)
+            ))
+
+    def _drop_partitions(self, name_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            schema_editor.execute("ALTER TABLE %s DROP PARTITION %s" % (
+                schema_editor.quote_name(self.table_name), ', '.join(name_list)
+            ))
+
+    def _get_partition_sql(self, range_list) -> str:
+        return ', '.join(['PARTITION %s VALUES LESS THAN (%d)' % (name, end) for name, start, end in range_list])
+
+
+class TableLogPartitions(LogPartitions):
+
+    def __init__(self, model, alias, period, ahead, get_period_model):
+        super().__init__(model, alias, period, ahead)
+        self.get_period_model = get_period_model
+
+        # tables known to exist, checked once per process
+        self._existing_table_names = set()
+
+    # the table of a period is created on the first write if the cron didn't do it yet
+    def get_write_model(self, timestamp):
+
+        model = self.get_period_model(self.table_name + '_' + self._get_partition_name(self._get_period_start(timestamp)))
+
+        if model._meta.db_table not in self._existing_table_names:
+            if not self._table_exists_by_name(model._meta.db_table):
+                with connections[self.alias].schema_editor() as schema_editor:
+                    schema_editor.create_model(model)
+            self._existing_table_names.add(model._meta.db_table)
+
+        return model
+
+    def get_read_model_list(self) -> list:
+
+        partition_list = sorted(self._get_partition_list(), key=lambda partition: partition[1], reverse=True)
+
+        return [self.get_period_model(self.table_name + '_' + name) for name, start, end in partition_list]
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    # there is no table of its own, only the tables of the periods
+    def _table_exists(self) -> bool:
+        return True
+
+    def _table_exists_by_name(self, table_name) -> bool:
+        return table_name in connections[self.alias].introspection.table_names()
+
+    # a logs table of its own is one from before partitioning, its rows would never be read nor rotated
+    def _get_partition_list(self) -> list:
+
+        table_name_list = connections[self.alias].introspection.table_names()
+        if self.table_name in table_name_list:
+            raise ValueError("Table [%s] is not partitioned, rename it to keep the old logs and run --migrate again" % self.table_name)
+
+        prefix = self.table_name + '_'
+        partition_list = [
+            self._parse_partition_name(table_name[len(prefix):])
+            for table_name in table_name_list if table_name.startswith(prefix)
+        ]
+
+        return [partition for partition in partition_list if partition is not None]
+
+    def _add_partitions(self, range_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            for name, start, end in range_list:
+                schema_editor.create_model(self.get_period_model(self.table_name + '_' + name))
+
+    def _drop_partitions(self, name_list):
+
+        with connections[self.alias].schema_editor() as schema_editor:
+            for name in name_list:
+                schema_editor.delete_model(self.get_period_model(self.table_name + '_' + name))
+                self._existing_table_names.discard(self.table_name + '_' + name)
@@ -0,0 +1,159 @@
+import os
+import atexit
+import logging
+import threading
+from django.db import connections, router
+from BackgroundTask.logger import BackgroundTaskLogger, bulk_create_log_rows
+
+"""
+Asynchronous writer of log rows, for `logs_async_on`.
+Workers hand their log rows over and go on, a background thread inserts them with bulk_create
+every `flush_size` rows or `flush_interval` seconds, whichever comes first.
+When the log database can't keep up and `buffer_max` rows are waiting, info messages are dropped first,
+rows that still have errors or successes make the worker wait for room (backpressure).
+Rows are flushed on the worker's shutdown and at exit, a killed process loses at most the rows waiting
+"""
+
+# writers by logs model, one thread per logs table in a process
+_log_writers = {}
+_log_writers_lock = threading.Lock()
+
+
+# the settings of the first task class asking for a table's writer are used
+def get_log_writer(model, flush_size, flush_interval, buffer_max):
+
+    with _log_writers_lock:
+        if model not in _log_writers:
+            _log_writers[model] = BackgroundLogWriter(model, flush_size, flush_interval, buffer_max)
+
+        return _log_writers[model]
+
+
+class BackgroundLogWriter:
+
+    def __init__(self, model, flush_size, flush_interval, buffer_max):
+        self.model = model
+        self.alias = router.db_for_write(model)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer_max = buffer_max
+
+        # what had to go because of backpressure
+        self.dropped_row_count = 0
+        self.dropped_message_count = 0
+
+        self._pid = None
+        # a hung log database doesn't hold the exit forever
+        atexit.register(self.flush, 30)
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def put(self, row):
+
+        self._ensure_thread()
+
+        with self._condition:
+            if len(self._row_list) >= self.buffer_max:
+                row = self._drop_info_messages(row)
+                if row is None:
+                    return
+
+                self._condition.wait_for(lambda: len(self._row_list) < self.buffer_max)
+
+            self._row_list.append(row)
+            if len(self._row_list) >= self.flush_size:
+                self._condition.notify_all()
+
+    # waits till every row handed over so far is written
+    def flush(self, timeout=None) -> bool:
+
+        if self._pid != os.getpid():
+            return True
+
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+
+            return self._condition.wait_for(self._is_flushed, timeout)
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    # the thread of a parent process doesn't exist in a forked child, the child starts its own
+    def _ensure_thread(self):
+
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._row_list = []
+        self._writing = False
+        self._flush_requested = False
+
+        thread = threading.Thread(target=self._run, name='background_task_log_writer', daemon=True)
+        thread.start()
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self._row_list) >= self.flush_size or self._flush_requested, self.flush_interval
+                )
+
+                row_list = self._row_list
+                self._row_list = []
+                self._flush_requested = False
+                self._writing = len(row_list) > 0
+
+                # workers waiting for room
+                self._condition.notify_all()
+
+            if len(row_list) < 1:
+                continue
+
+            self._write(row_list)
+
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    # rows put while the thread was writing (workers that waited for room) are asked for again
+    def _is_flushed(self) -> bool:
+
+        if len(self._row_list) > 0 and not self._flush_requested:
+            self._flush_requested = True
+            self._condition.notify_all()
+
+        return len(self._row_list) < 1 and not self._writing
+
+    def _write(self, row_list):
+
+        try:
+            bulk_create_log_rows(row_list, self.flush_size)
+        except Exception:
+            logging.getLogger('background_task').exception("Could not write %d log rows" % len(row_list))
+
+            # a broken connection is replaced on the next write
+            connections[self.alias].close()
+
+    # returns the row without its info messages, or None if nothing is left
+    def _drop_info_messages(self, row):
+
+        message_list = [
+            message for message in row.message_json
+            if message['message_type'] != BackgroundTaskLogger._MESSAGE_TYPE_INFO
+        ]
+        self.dropped_message_count = self.dropped_message_count + len(row.message_json) - len(message_list)
+
+        if len(message_list) < 1:
+            self.dropped_row_count = self.dropped_row_count + 1
+            return None
+
+        row.message_json = message_list
+
+        return row
@@ -1,9 +1,98 @@
-import re
+import itertools
+import json
 import time
-from django.db import models
-from django.forms.models import model_to_dict
-
+from django.db import models, router
+from BackgroundTask.registry import get_registered_model, get_model_name, get_index_name
+from BackgroundTask.log_partitions import get_log_partitions
+
+# control characters but tab, newline and carriage return
+_CONTROL_BYTES = bytes([byte for byte in range(32) if byte not in (9, 10, 13)] + [127])
+
+# cuts extra data, json.dumps() with options builds an encoder every call
+_DATA_ENCODER = json.JSONEncoder(default=str)
+
+_END = object()
+
+# longer lists of these are measured and cut whole, by the encoder, shorter ones are quicker to walk
+_SCALAR_TYPES = {int, float, bool, type(None)}
+_SCALAR_LIST_MIN = 16
+
+# the first items of a list, enough for `length` characters of JSON: every item is 3 of them at least, with ', '
+def _get_list_head(value, length):
+    return value[:max(length, 0) // 3 + 1]
+
+# length of the JSON of `data`, near enough: escapes and separators aren't exact.
+# stops once it's past `limit`, so it costs the same for 20 KB of data as for 20 GB
+def _estimate_json_length(data, limit) -> int:
+
+    length = 0
+    stack = [iter([data])]
+    while len(stack) > 0 and length <= limit:
+        value = next(stack[-1], _END)
+        if value is _END:
+            stack.pop()
+        elif isinstance(value, str):
+            length += len(value) + 3
+        elif isinstance(value, dict):
+            length += 2
+            stack.append(itertools.chain.from_iterable(value.items()))
+        elif isinstance(value, (list, tuple)):
+            head = _get_list_head(value, limit - length)
+            if len(head) >= _SCALAR_LIST_MIN and set(map(type, head)) <= _SCALAR_TYPES:
+                length += len(_DATA_ENCODER.encode(head)) if len(head) == len(value) else limit + 1
+            else:
+                length += 2
+                stack.append(iter(value))
+        else:
+            # numbers, booleans, None, and what default=str makes of the rest
+            length += len(str(value)) + 1
+
+    return length
+
+# a copy of `data` that is cut where its JSON would pass `limit`: long strings are shortened, later items dropped.
+# the JSON is counted as _DATA_ENCODER writes it, short by the escapes of strings and closing brackets, never over,
+# so the JSON of the copy starts as the one of `data` for `limit` characters at least,
+# and encoding it costs about the limit, however big a value of `data` is
+def _cut_data(data, limit):
+
+    remaining = [limit]
+
+    def cut(value):
+        if isinstance(value, (list, tuple)):
+            head = _get_list_head(value, remaining[0])
+            if len(head) >= _SCALAR_LIST_MIN and set(map(type, head)) <= _SCALAR_TYPES:
+                remaining[0] -= len(_DATA_ENCODER.encode(head))
+                return list(head)
+
+        if isinstance(value, (dict, list, tuple)):
+            is_dict = isinstance(value, dict)
+            remaining[0] -= 1
+            cut_list = []
+            for key, item in (value.items() if is_dict else ((None, item) for item in value)):
+                if remaining[0] <= 0:
+                    break
+                # ', ' between the items, ': ' after a key
+                remaining[0] -= (2 if cut_list else 0) + (2 if is_dict else 0)
+                cut_list.append((cut(key) if isinstance(key, str) else key, cut(item)))
+            return dict(cut_list) if is_dict else [item for key, item in cut_list]
+
+        # None and booleans are 4 or 5 characters either way
+        if value is None or isinstance(value, (bool, int, float)):
+            remaining[0] -= len(str(value))
+            return value
+
+        # strings, and what default=str makes of the rest
+        value = str(value)[:max(remaining[0], 0)]
+        remaining[0] -= len(value) + 2
+        return value
+
+    return cut(data)
+
+# built once per process, see registry.py
 def get_logs_class_db_model(module, db_app_label, table_name) -> models.Model:
+    return get_registered_model('logs', module, db_app_label, table_name, _create_logs_class_db_model)
+
+def _create_logs_class_db_model(module, db_app_label, table_name) -> models.Model:
 
     class Meta:
         pass
@@ -11,6 +100,14 @@ def get_logs_class_db_model(module, db_app_label, table_name) -> models.Model:
     setattr(Meta, 'app_label', db_app_label)
     setattr(Meta, 'db_table', table_name)
 
+    # logrotate deletes by date_added
+    # get_logs() pages by id within the filters of task_id and message_type
+    setattr(Meta, 'indexes', [
+        models.Index(fields=['date_added'], name=get_index_name(table_name, 'date_added')),
+        models.Index(fields=['task_id', 'id'], name=get_index_name(table_name, 'task_id')),
+        models.Index(fields=['message_type', 'id'], name=get_index_name(table_name, 'message_type')),
+    ])
+
     # Set up a dictionary to simulate declarations within a class
     attrs = {
         '__module__': module,
@@ -18,18 +115,41 @@ def get_logs_class_db_model(module, db_app_label, table_name) -> models.Model:
         'id': models.AutoField(primary_key=True),
         'date_added': models.IntegerField(default=0),
         'message_json': models.JSONField(),
+        # taken out of message_json for filtering: the task the row is about
+        # and the most severe message type in it (error > success > info)
+        'task_id': models.IntegerField(null=True),
+        'message_type': models.SmallIntegerField(default=0),
     }
 
     # Create the class, which automatically triggers ModelBase processing
-    model = type('BackgroundTaskGeneralLogsModel', (models.Model,), attrs)
+    model = type(get_model_name('BackgroundTaskGeneralLogsModel', module, table_name), (models.Model,), attrs)
 
     return model
 
+# rows of a partitioned logs table may belong to tables of different periods
+def bulk_create_log_rows(row_list, batch_size=None):
+
+    model_row_list = {}
+    for row in row_list:
+        model_row_list.setdefault(row.__class__, []).append(row)
+
+    for model, model_rows in model_row_list.items():
+        model.objects.using(router.db_for_write(model)).bulk_create(model_rows, batch_size=batch_size)
+
 class BackgroundTaskLogger:
 
     #
     logs_db_app_name = 'default'
     logs_table_name: str = None
+    logs_partition_by: str = None
+    logs_partition_ahead: int = 7
+
+    # logrotate of a table that isn't partitioned deletes this many rows per statement
+    delete_chunk_size = 5000
+
+    # longer message texts and extra data (as JSON) are cut, in characters
+    message_max_length = 20000
+    extra_data_max_length = 20000
 
     #
     _message_source = 'worker' # worker or user
@@ -43,11 +163,37 @@ class BackgroundTaskLogger:
 
     #
     _db_model_inst: models.Model = None
-    _message_structure: [dict] = []
+    _partitions_inst = None
+    _message_structure: [dict] = None
+
+    # BackgroundLogWriter, save() hands rows to it instead of inserting them
+    writer = None
 
-    def __init__(self, logs_table_name, logs_db_app_name = 'default'):
+    # the task the logs are about, set for loggers of tasks
+    task_id: int = None
+
+    # columns returned by get_logs()
+    _LOG_FIELDS = ('id', 'date_added', 'task_id', 'message_type', 'message_json')
+
+    def __init__(self, logs_table_name, logs_db_app_name = 'default', logs_partition_by = None, logs_partition_ahead = 7):
         self.logs_table_name = logs_table_name
         self.logs_db_app_name = logs_db_app_name
+        self.logs_partition_by = logs_partition_by
+        self.logs_partition_ahead = logs_partition_ahead
+
+        # per instance, so loggers of concurrently running tasks don't mix their messages
+        self._message_structure = []
+
+    # a logger for one task, sharing the db model with this one
+    def for_task(self, task_id = None):
+
+        task_logger = BackgroundTaskLogger(self.logs_table_name, self.logs_db_app_name, self.logs_partition_by, self.logs_partition_ahead)
+        task_logger._db_model_inst = self._get_db_model()
+        task_logger._partitions_inst = self.get_partitions()
+        task_logger.task_id = task_id
+        task_logger.writer = self.writer
+
+        return task_logger
 
     # --------------------------------------------------
     # Writing logs interface
@@ -72,35 +218,139 @@ class BackgroundTaskLogger:
 
     def save(self):
 
-        model = self._get_db_model()
+        if self.writer is not None:
+            self.writer.put(self.pop_row())
+            return
+
+        self.pop_row().save()
+
+    # an unsaved log row with the messages logged so far, for saving a batch of them at once
+    def pop_row(self) -> models.Model:
+
+        date_added = int(time.time())
+        model = self._get_write_db_model(date_added)
         model_inst = model(
-            date_added=int(time.time()),
-            message_json=self._message_structure
+            date_added=date_added,
+            message_json=self._message_structure,
+            task_id=self.task_id,
+            message_type=max([message['message_type'] for message in self._message_structure], default=self._MESSAGE_TYPE_INFO),
         )
-        model_inst.save()
 
         self._message_structure = []
 
+        return model_inst
+
+    # messages logged so far, taken out of the logger (to be passed to another process)
+    def pop_messages(self):
+
+        message_list = self._message_structure
+        self._message_structure = []
+
+        return message_list
+
+    def add_messages(self, message_list):
+        self._message_structure.extend(message_list)
+
     # --------------------------------------------------
     # Retrieving logs interface
     # --------------------------------------------------
 
+    # offset pagination, every page reads all the rows before it, get_logs() doesn't
     def get_last_logs(self, limit = 20, offset = 0):
-        logs_list = self._get_db_model().objects.order_by('-id')[offset:offset+limit].all()
-
-        # making it array with dict-s for clarity
-        result_list = []
-        for row in logs_list:
-            result_list.append(model_to_dict(row))
 
-        return result_list
+        # tables of periods are read one after another, the newest first
+        logs_list = []
+        for model in self._get_read_db_model_list():
+            logs_list.extend(model.objects.order_by('-id').values(*self._LOG_FIELDS)[:offset + limit - len(logs_list)])
+            if len(logs_list) >= offset + limit:
+                break
+
+        return logs_list[offset:]
+
+    # keyset pagination, the newest first: returns (rows, cursor of the next page or None if it was the last one)
+    # filters: task_id, message_type, date_from <= date_added <= date_to
+    def get_logs(self, limit = 20, cursor = None, task_id = None, message_type = None, date_from = None, date_to = None):
+
+        filters = {}
+        if task_id is not None:
+            filters['task_id'] = task_id
+        if message_type is not None:
+            filters['message_type'] = message_type
+        if date_from is not None:
+            filters['date_added__gte'] = date_from
+        if date_to is not None:
+            filters['date_added__lte'] = date_to
+
+        # the cursor is "<table>:<id>" of the last row, ids are only unique within a table
+        model_list = self._get_read_db_model_list()
+        cursor_id = None
+        if cursor is not None:
+            cursor_table, cursor_id = cursor.rsplit(':', 1)
+            while len(model_list) > 0 and model_list[0]._meta.db_table != cursor_table:
+                model_list = model_list[1:]
+
+        # one row more than asked tells if there is a next page
+        logs_list = []
+        for model in model_list:
+            objects = model.objects.filter(**filters)
+            if cursor_id is not None and model._meta.db_table == cursor_table:
+                objects = objects.filter(id__lt=int(cursor_id))
+
+            row_list = list(objects.order_by('-id').values(*self._LOG_FIELDS)[:limit + 1 - len(logs_list)])
+            logs_list.extend([(model, row) for row in row_list])
+            if len(logs_list) > limit:
+                break
+
+        if len(logs_list) <= limit:
+            return [row for model, row in logs_list], None
+
+        last_model, last_row = logs_list[limit - 1]
+
+        return [row for model, row in logs_list[:limit]], '%s:%d' % (last_model._meta.db_table, last_row['id'])
+
+    # all the logs matching the filters, the newest first, read `chunk_size` rows at a time, for exporting
+    def iter_logs(self, chunk_size = 1000, task_id = None, message_type = None, date_from = None, date_to = None):
+
+        cursor = None
+        while True:
+            logs_list, cursor = self.get_logs(chunk_size, cursor, task_id, message_type, date_from, date_to)
+            yield from logs_list
+
+            if cursor is None:
+                return
 
     # --------------------------------------------------
     # LOGROTATE
     # --------------------------------------------------
 
+    # partitions are dropped whole, once all their rows are older than `timestamp`
+    # otherwise rows are deleted in chunks, so the table is never locked for long
     def delete_logs_older_than(self, timestamp):
-        self._get_db_model().objects.filter(date_added__lte=timestamp).delete()
+
+        if self.get_partitions() is not None:
+            self.get_partitions().drop_older_than(timestamp)
+            return
+
+        objects = self._get_db_model().objects
+        while True:
+            id_list = list(objects.filter(date_added__lte=timestamp).order_by().values_list('id', flat=True)[:self.delete_chunk_size])
+            if len(id_list) < 1:
+                break
+
+            objects.filter(id__in=id_list).delete()
+
+    # None if the logs table isn't partitioned, see log_partitions.py
+    def get_partitions(self):
+
+        if self.logs_partition_by is None:
+            return None
+
+        if self._partitions_inst is None:
+            self._partitions_inst = get_log_partitions(
+                self._get_db_model(), self.logs_partition_by, self.logs_partition_ahead, self._get_period_db_model
+            )
+
+        return self._partitions_inst
 
     # --------------------------------------------------
     # PROTECTED
@@ -117,7 +367,7 @@ class BackgroundTaskLogger:
             'message_type': message_type,
             'message_source': self._message_source,
             'message_text': self._format_string(message_text),
-            'extra_data': data
+            'extra_data': self._format_data(data)
         })
 
     # --------------------------------------------------
@@ -133,17 +383,44 @@ class BackgroundTaskLogger:
 
         return self._db_model_inst
 
+    def _get_write_db_model(self, timestamp) -> models.Model:
+
+        if self.get_partitions() is None:
+            return self._get_db_model()
+
+        return self.get_partitions().get_write_model(timestamp)
+
+    def _get_read_db_model_list(self) -> list:
+
+        if self.get_partitions() is None:
+            return [self._get_db_model()]
+
+        return self.get_partitions().get_read_model_list()
+
+    # the table of one period, when partitions are tables
+    def _get_period_db_model(self, table_name) -> models.Model:
+        return get_logs_class_db_model(self.__module__, self.logs_db_app_name, table_name)
+
+    # text as it can be stored: lone surrogates (undecodable bytes of surrogateescape) are replaced,
+    # control characters but tabs and newlines are dropped (postgres jsonb rejects NUL),
+    # long texts keep their start and end, as tracebacks end with the error
     def _format_string(self, data_string):
-        regex = """
-            /
-  (
-    (?: [\x00-\x7F]                 # single-byte sequences   0xxxxxxx
-    |   [\xC0-\xDF][\x80-\xBF]      # double-byte sequences   110xxxxx 10xxxxxx
-    |   [\xE0-\xEF][\x80-\xBF]{2}   # triple-byte sequences   1110xxxx 10xxxxxx * 2
-    |   [\xF0-\xF7][\x80-\xBF]{3}   # quadruple-byte sequence 11110xxx 10xxxxxx * 3
-    ){1,100}                        # ...one or more times
-  )
-| .                                 # anything else
-/x
-            """
-        return re.sub(regex, '$1', data_string.strip())
\ No newline at end of file
+
+        data_string = str(data_string).strip()
+
+        if len(data_string) > self.message_max_length:
+            half = self.message_max_length // 2
+            data_string = data_string[:half] + '\n... [%d characters cut] ...\n' % (len(data_string) - half * 2) + data_string[-half:]
+
+        return data_string.encode('utf-8', 'replace').translate(None, _CONTROL_BYTES).decode('utf-8')
+
+    # extra data too big to be stored is replaced with the start of its JSON,
+    # data that fits is left to be encoded once, with the row, and data that doesn't is cut before it's encoded
+    def _format_data(self, data):
+
+        if _estimate_json_length(data, self.extra_data_max_length) <= self.extra_data_max_length:
+            return data
+
+        start = _DATA_ENCODER.encode(_cut_data(data, self.extra_data_max_length))
+
+        return {'truncated': True, 'start': start[:self.extra_data_max_length]}
@@ -1,8 +1,9 @@
-import subprocess, re, os
+import subprocess, re, os, json
 from django.core.management.base import BaseCommand, CommandError
-from django.db.utils import ProgrammingError, OperationalError
+from django.db.utils import DatabaseError
 from BackgroundTask import handler
 from BackgroundTask import logger
+from BackgroundTask.supervisor import BackgroundTaskSupervisor
 
 
 class Command(BaseCommand):
@@ -12,7 +13,7 @@ class Command(BaseCommand):
         parser.add_argument(
             '--migrate',
             action='store_true',
-            help="To create tables for queues, after creating new task classes. If you need to rename/change table name, you will have to delete it manually and run --migrate again"
+            help="To create tables for queues, after creating new task classes. Existing tables get missing columns and indexes added. If you need to rename/change table name, you will have to delete it manually and run --migrate again"
             ,
         )
 
@@ -22,6 +23,61 @@ class Command(BaseCommand):
             help='To create start new task queues, after creating new task classes and migrating',
         )
 
+        parser.add_argument(
+            '--supervise',
+            action='store_true',
+            help="Runs all workers of all task classes from one long-lived process, restarting them when they die. An alternative to --activate, meant for systemd/supervisord. SIGTERM stops gracefully, SIGHUP reloads",
+        )
+
+        parser.add_argument(
+            '--bench',
+            metavar='SCENARIO',
+            help="Runs a benchmark on a throwaway queue table and prints results as JSON. Scenarios are the bench_* methods of bench.py",
+        )
+
+        parser.add_argument(
+            '--bench-db',
+            default='default',
+            help="Database alias for --bench",
+        )
+
+        parser.add_argument(
+            '--bench-tasks',
+            type=int,
+            help="How many tasks to put into the queue for --bench",
+        )
+
+        parser.add_argument(
+            '--bench-log-rows',
+            type=int,
+            help="How many rows to put into the logs table for --bench log_read (500000 by default, 10000000 for a big table)",
+        )
+
+        parser.add_argument(
+            '--bench-producers',
+            type=int,
+            help="How many processes add tasks in --bench pipeline",
+        )
+
+        parser.add_argument(
+            '--bench-work-cost',
+            type=float,
+            help="Seconds every task takes in --bench pipeline",
+        )
+
+        parser.add_argument(
+            '--bench-set',
+            action='append',
+            default=[],
+            metavar='NAME=VALUE',
+            help="Sets an attribute of the benchmark's task class, e.g. task_limit_per_execution=50, can be repeated",
+        )
+
+        parser.add_argument(
+            '--bench-workers',
+            help="Comma separated worker counts to compare for --bench, e.g. 1,2,4,8",
+        )
+
     def handle(self, *args, **options):
 
         if 'migrate' in options and options['migrate']:
@@ -30,6 +86,12 @@ class Command(BaseCommand):
         if 'activate' in options and options['activate']:
             return self._activate()
 
+        if 'supervise' in options and options['supervise']:
+            return self._supervise()
+
+        if 'bench' in options and options['bench']:
+            return self._bench(options)
+
         self.stdout.write(self.style.WARNING(self.help))
 
     # --------------------------------------------------
@@ -48,44 +110,58 @@ class Command(BaseCommand):
             # --------------------------------------------------
             # queue table
             # --------------------------------------------------
-            db_model = handler.get_task_class_db_model(task_class_instance.__module__, task_class_instance.db_app_label, task_class_instance.table_name)
-
-            # checking if a table for the model exists
-            try:
-                exists = self._if_table_exists(db_model)
-            except AttributeError:
-                self.stdout.write(self.style.ERROR(
-                    "ERROR: ") + task_class_str + ": table structure was changed. Please delete the table and run again.")
-                return
-
-            if not exists:
-                # creating the table
-                if self._create_table(task_class_instance.db_app_label, db_model):
-                    self.stdout.write(self.style.SUCCESS("OK: ") + task_class_str + ": [queue] table created")
+            if task_class_instance.queue_backend == 'django':
+                db_model = handler.get_task_class_db_model(task_class_instance.__module__, task_class_instance.db_app_label, task_class_instance.table_name)
+                self._migrate_table(task_class_str, 'queue', task_class_instance.db_app_label, db_model)
 
             # --------------------------------------------------
             # logs table
             # --------------------------------------------------
 
+            if task_class_instance.logs_on and task_class_instance.logs_partition_by is not None:
+                self._migrate_log_partitions(task_class_str, task_class_instance.logger())
 
-            if task_class_instance.logs_on:
+            elif task_class_instance.logs_on:
 
                 logs_db_model = logger.get_logs_class_db_model(task_class_instance.__module__, task_class_instance.logs_db_app_name, task_class_instance.logs_table_name)
+                self._migrate_table(task_class_str, 'logs', task_class_instance.logs_db_app_name, logs_db_model)
 
-                # checking if a table exists
-                try:
-                    logs_exists = self._if_table_exists(logs_db_model)
-                except AttributeError:
-                    self.stdout.write(self.style.ERROR(
-                        "ERROR: ") + task_class_str + ": table structure was changed. Please delete the table and run again.")
-                    return
+        self.stdout.write(self.style.SUCCESS("[Migration is done]"))
 
-                if not logs_exists:
-                    # creating the table for logs
-                    if self._create_table(task_class_instance.logs_db_app_name, logs_db_model):
-                        self.stdout.write(self.style.SUCCESS("OK: ") + task_class_str + ": [logs] table created")
+    # creates the table, or brings an existing one up to date with the model
+    def _migrate_table(self, task_class_str, table_kind, db_app_label, model):
 
-        self.stdout.write(self.style.SUCCESS("[Migration is done]"))
+        if not self._if_table_exists(db_app_label, model):
+            if self._create_table(db_app_label, model):
+                self.stdout.write(self.style.SUCCESS("OK: ") + task_class_str + ": [%s] table created" % table_kind)
+            return
+
+        try:
+            change_list = self._update_table(db_app_label, model)
+        except DatabaseError as e:
+            self.stdout.write(self.style.ERROR(
+                "ERROR: ") + task_class_str + ": [%s] table could not be updated (%s). Please delete the table and run again." % (table_kind, e))
+            return
+
+        for change in change_list:
+            self.stdout.write(self.style.SUCCESS("OK: ") + task_class_str + ": [%s] table updated, %s" % (table_kind, change))
+
+    # creates the partitioned table, or the partitions of the next periods
+    def _migrate_log_partitions(self, task_class_str, task_logger):
+
+        partitions = task_logger.get_partitions()
+        try:
+            change_list = partitions.migrate()
+
+            # columns and indexes added to the model since, partitions of native tables get them from the table
+            for model in partitions.get_read_model_list():
+                change_list.extend(["[%s] %s" % (model._meta.db_table, change) for change in self._update_table(partitions.alias, model)])
+        except (DatabaseError, ValueError) as e:
+            self.stdout.write(self.style.ERROR("ERROR: ") + task_class_str + ": [logs] table could not be partitioned (%s)." % e)
+            return
+
+        for change in change_list:
+            self.stdout.write(self.style.SUCCESS("OK: ") + task_class_str + ": [logs] %s" % change)
 
     def _activate(self):
 
@@ -120,6 +196,38 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.SUCCESS("Activated!"))
 
+    def _supervise(self):
+
+        self.stdout.write(self.style.WARNING("PROGRESS: ") + "Starting the supervisor..")
+        BackgroundTaskSupervisor().run()
+
+    # bench.py is only loaded here, it's big and pulls in django.test
+    def _bench(self, options):
+        from BackgroundTask import bench
+
+        if options['bench'] not in bench.BackgroundTaskBench.scenarios:
+            raise CommandError("Unknown benchmark [%s], use one of: %s" % (options['bench'], ', '.join(bench.BackgroundTaskBench.scenarios)))
+
+        worker_counts = None
+        if options['bench_workers'] is not None:
+            worker_counts = [int(count) for count in options['bench_workers'].split(',') if count.strip()]
+
+        self.stdout.write(self.style.WARNING("PROGRESS: ") + "Running [%s] benchmark.." % options['bench'])
+        # values are JSON (numbers, true/false), anything else is a string
+        task_settings = {}
+        for setting in options['bench_set']:
+            name, value = setting.split('=', 1)
+            try:
+                task_settings[name] = json.loads(value)
+            except ValueError:
+                task_settings[name] = value
+
+        runner = bench.BackgroundTaskBench(
+            options['bench_db'], options['bench_tasks'], worker_counts, options['bench_log_rows'],
+            options['bench_producers'], options['bench_work_cost'], task_settings
+        )
+        self.stdout.write(runner.run(options['bench']))
+
     # --------------------------------------------------
     # UTILS
     # --------------------------------------------------
@@ -132,17 +240,78 @@ class Command(BaseCommand):
 
         return True
 
-    def _if_table_exists(self, model):
-        try:
-            model.objects.filter(pk=1)[0:1].get()
-        except ProgrammingError:
-            return False
-        except OperationalError:
-            raise AttributeError
-        except model.DoesNotExist:
-            return True
+    def _if_table_exists(self, db_app_label, model):
+        from django.db import connections
 
-        return True
+        return model._meta.db_table in connections[db_app_label].introspection.table_names()
+
+    # adds columns and indexes that the model has, but the existing table doesn't,
+    # and lets columns that became nullable in the model take NULL-s
+    # nothing is ever dropped, so it's safe to run on a table that is in use
+    # sqlite rebuilds the whole table on a column change, copying the columns of the model it's given
+    # and creating its indexes, so columns are added to a model of what the table has at the moment,
+    # and the table is read again after each change instead of once
+    def _update_table(self, db_app_label, model):
+        from django.db import connections
+
+        connection = connections[db_app_label]
+        table_name = model._meta.db_table
+
+        change_list = []
+        with connection.schema_editor() as schema_editor:
+            for field in model._meta.local_fields:
+                column_list = self._get_column_description(connection, table_name).keys()
+                if field.column in column_list:
+                    continue
+                schema_editor.add_field(self._get_table_model(model, column_list), self._clone_field(field))
+                change_list.append("added column [%s]" % field.column)
+
+            for field in model._meta.local_fields:
+                if not field.null or self._get_column_description(connection, table_name)[field.column].null_ok:
+                    continue
+                old_field = self._clone_field(field)
+                old_field.null = False
+                old_field.model = model
+                schema_editor.alter_field(model, old_field, field)
+                change_list.append("allowed NULL in column [%s]" % field.column)
+
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, table_name)
+            index_column_list = [constraint['columns'] for constraint in constraints.values() if constraint['index']]
+
+            for index in model._meta.indexes:
+                if index.name in constraints or list(index.fields) in index_column_list:
+                    continue
+                schema_editor.add_index(model, index)
+                change_list.append("added index [%s]" % index.name)
+
+        return change_list
+
+    # the model's fields that the table has, without indexes, in a registry of its own
+    def _get_table_model(self, model, column_list):
+        from django.apps.registry import Apps
+        from django.db import models
+
+        meta = type('Meta', (), {'apps': Apps(), 'app_label': model._meta.app_label, 'db_table': model._meta.db_table})
+        attrs = {'__module__': model.__module__, 'Meta': meta}
+        for field in model._meta.local_fields:
+            if field.column in column_list:
+                attrs[field.name] = self._clone_field(field)
+
+        return type(model.__name__, (models.Model,), attrs)
+
+    # a field that isn't bound to the model, schema editors attach fields to the models they build
+    def _clone_field(self, field):
+
+        new_field = field.clone()
+        new_field.set_attributes_from_name(field.name)
+
+        return new_field
+
+    def _get_column_description(self, connection, table_name) -> dict:
+
+        with connection.cursor() as cursor:
+            return {column.name: column for column in connection.introspection.get_table_description(cursor, table_name)}
 
     def _check_and_update_crontab(self):
 
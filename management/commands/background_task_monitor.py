@@ -46,9 +46,16 @@ class Command(BaseCommand):
                 del task_class_instance
                 continue
 
-            queue_size = task_class_instance.get_queue_size()
+            queue_stats = task_class_instance.get_queue_stats()
+            queue_size = queue_stats['size']
 
-            self.stdout.write("For [%s] queue is [%s]." % (task_class_str, str(queue_size)))
+            self.stdout.write("For [%s] queue is [%s] (ready: %s, scheduled: %s, in flight: %s)." % (
+                task_class_str,
+                self._format_size(queue_stats, task_class_instance),
+                self._format_count(queue_stats['ready'], task_class_instance),
+                self._format_count(queue_stats['scheduled'], task_class_instance),
+                self._format_count(queue_stats['in_flight'], task_class_instance),
+            ))
 
             if queue_size > task_class_instance.overflow_alarm:
                 self.stdout.write(self.style.WARNING("QUEUE IS OVERFLOWN: ") + "Running alarm function..")
@@ -58,6 +65,24 @@ class Command(BaseCommand):
 
         self.stdout.write("[END]")
 
+    # estimates and counters are approximate, a bounded count reaching the limit means "at least"
+    def _format_size(self, queue_stats, task_class_instance):
+
+        if queue_stats['size_exact']:
+            return str(queue_stats['size'])
+
+        if queue_stats['size'] == task_class_instance.get_queue_count_limit():
+            return '%d+' % queue_stats['size']
+
+        return '~%d' % queue_stats['size']
+
+    def _format_count(self, count, task_class_instance):
+
+        if task_class_instance.queue_size_method != 'count' and count >= task_class_instance.get_queue_count_limit():
+            return '%d+' % count
+
+        return str(count)
+
     def _logrotate(self):
 
         # getting all user's task classes
@@ -76,5 +101,10 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING("DELETING LOGS: ") + "[%s] older than: " % task_class_str + self.style.ERROR(time.strftime("%d %b %Y", time.localtime(older_than))))
             task_class_instance.logger().delete_logs_older_than(older_than)
 
+            # partitions of the next periods, the cron runs daily
+            if task_class_instance.logs_partition_by is not None:
+                for change in task_class_instance.logger().get_partitions().migrate():
+                    self.stdout.write(self.style.SUCCESS("OK: ") + "[%s] %s" % (task_class_str, change))
+
         self.stdout.write("[END]")
 
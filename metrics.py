@@ -0,0 +1,221 @@
+import os
+import time
+import tempfile
+import bisect
+import threading
+from contextlib import contextmanager, nullcontext
+from django.db import connections, router
+
+"""
+Metrics of the workers in the Prometheus text format, for `metrics_on`.
+Every worker process keeps its own counters and histograms and writes them every `metrics_interval` seconds
+to <metrics_dir>/<table_name>_<worker_number>.prom, which node_exporter's textfile collector reads as they are.
+The supervisor also serves all the files of its workers at http://<host>:<BACKGROUND_TASK_METRICS_PORT>/metrics
+claim_seconds - get_new_task_list(), claim_batch_size - tasks it returned,
+work_seconds - from the start of a task to its result (in process_pool, of work() in the pool process), queue_wait_seconds - now - date_added, of first attempts of one-off tasks,
+tasks_total - by result: ok, fail (given up), retry, db_statements_total - statements of the worker loop's thread
+(claims, completions, logs, and work() in the serial mode), divided by the tasks it's the statements per task.
+Turned off, the workers get NULL_METRICS, whose methods do nothing
+"""
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def get_metrics(task_class, worker_number):
+
+    if not task_class.metrics_on:
+        return NULL_METRICS
+
+    return WorkerMetrics(task_class, worker_number)
+
+
+# the package folder may be read-only (site-packages), the default is in the temp folder of the system
+def get_metrics_dir(task_class) -> str:
+
+    if task_class.metrics_dir is not None:
+        return task_class.metrics_dir
+
+    return os.path.join(tempfile.gettempdir(), 'background_task_metrics', '')
+
+
+# files of many workers as one text, every family keeps a single HELP and TYPE
+def merge_metrics_text(text_list) -> str:
+
+    family_list = {}
+    for text in text_list:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                family = line.split(' ')[2]
+                family_list.setdefault(family, {'header': [], 'samples': []})
+                if len(family_list[family]['header']) < 2:
+                    family_list[family]['header'].append(line)
+            elif line.startswith('# TYPE '):
+                if len(family_list[family]['header']) < 2:
+                    family_list[family]['header'].append(line)
+            elif line and family is not None:
+                family_list[family]['samples'].append(line)
+
+    line_list = []
+    for family in family_list.values():
+        line_list.extend(family['header'] + family['samples'])
+
+    return '\n'.join(line_list) + '\n'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels) -> list:
+
+        line_list = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            line_list.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bucket, cumulative))
+        line_list.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        line_list.append('%s_sum{%s} %s' % (name, labels, repr(float(self.sum))))
+        line_list.append('%s_count{%s} %d' % (name, labels, self.count))
+
+        return line_list
+
+
+class WorkerMetrics:
+
+    def __init__(self, task_class, worker_number):
+        self.path = '%s%s_%d.prom' % (get_metrics_dir(task_class), task_class.table_name, worker_number)
+        self.interval = task_class.metrics_interval
+        self.labels = 'queue="%s",worker="%d"' % (task_class.table_name, worker_number)
+        self.aliases = {task_class._get_db_alias()}
+        if task_class.logs_on:
+            self.aliases.add(router.db_for_write(task_class.logger()._get_db_model()))
+
+        # tasks of the threads and asyncio modes are observed from many threads
+        self._lock = threading.Lock()
+        self._claim_seconds = Histogram(SECONDS_BUCKETS)
+        self._claim_batch_size = Histogram(SIZE_BUCKETS)
+        self._work_seconds = Histogram(SECONDS_BUCKETS)
+        self._queue_wait_seconds = Histogram(SECONDS_BUCKETS)
+        self._task_counts = {'ok': 0, 'fail': 0, 'retry': 0}
+        self._statement_count = 0
+        self._written_at = 0
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def observe_claim(self, seconds, task_count):
+        with self._lock:
+            self._claim_seconds.observe(seconds)
+            self._claim_batch_size.observe(task_count)
+
+    def observe_work(self, seconds):
+        with self._lock:
+            self._work_seconds.observe(seconds)
+
+    # retries have waited for their retry_delay, not in the queue, recurring tasks for their next run
+    def observe_wait(self, task_row):
+
+        if task_row.errors > 0 or task_row.date_added is None or task_row.schedule is not None:
+            return
+
+        with self._lock:
+            self._queue_wait_seconds.observe(max(0, time.time() - task_row.date_added))
+
+    def count_task(self, result):
+        with self._lock:
+            self._task_counts[result] += 1
+
+    # counts the statements of this thread's connections within the block
+    @contextmanager
+    def count_statements(self):
+
+        def count_statement(execute, sql, params, many, context):
+            self._statement_count += 1
+            return execute(sql, params, many, context)
+
+        connection_list = [connections[alias] for alias in self.aliases]
+        for connection in connection_list:
+            connection.execute_wrappers.append(count_statement)
+        try:
+            yield
+        finally:
+            for connection in connection_list:
+                connection.execute_wrappers.remove(count_statement)
+
+    def render(self) -> str:
+
+        with self._lock:
+            line_list = []
+            for name, help_text, histogram in (
+                ('background_task_claim_seconds', 'Time of claiming a batch of tasks', self._claim_seconds),
+                ('background_task_claim_batch_size', 'Tasks in a claimed batch', self._claim_batch_size),
+                ('background_task_work_seconds', 'Time from the start of a task to its result', self._work_seconds),
+                ('background_task_queue_wait_seconds', 'Time from adding a task to its first attempt', self._queue_wait_seconds),
+            ):
+                line_list.extend(['# HELP %s %s' % (name, help_text), '# TYPE %s histogram' % name])
+                line_list.extend(histogram.render(name, self.labels))
+
+            line_list.extend(['# HELP background_task_tasks_total Finished attempts by result', '# TYPE background_task_tasks_total counter'])
+            for result, count in self._task_counts.items():
+                line_list.append('background_task_tasks_total{%s,result="%s"} %d' % (self.labels, result, count))
+
+            line_list.extend([
+                '# HELP background_task_db_statements_total Database statements of the worker loop',
+                '# TYPE background_task_db_statements_total counter',
+                'background_task_db_statements_total{%s} %d' % (self.labels, self._statement_count),
+            ])
+
+        return '\n'.join(line_list) + '\n'
+
+    # the file is replaced at once, readers never see half of it
+    def write(self):
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(self.path + '.tmp', self.path)
+
+        self._written_at = time.time()
+
+    def write_due(self):
+        if time.time() - self._written_at >= self.interval:
+            self.write()
+
+
+class NullMetrics:
+
+    def observe_claim(self, seconds, task_count):
+        pass
+
+    def observe_work(self, seconds):
+        pass
+
+    def observe_wait(self, task_row):
+        pass
+
+    def count_task(self, result):
+        pass
+
+    def count_statements(self):
+        return nullcontext()
+
+    def write(self):
+        pass
+
+    def write_due(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
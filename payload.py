@@ -0,0 +1,74 @@
+import json
+import zlib
+
+"""
+Codecs of task data, picked with `payload_codec` of the task class.
+json - the data_json column, as it always was (default)
+msgpack - msgpack in the data_blob column (needs the msgpack package), smaller and faster to decode
+json+zlib, msgpack+zlib - the same, compressed, for big payloads,
+    a payload that doesn't get smaller is stored uncompressed
+Every blob starts with the tag byte of its codec, so a task is decoded with the codec it was added with,
+and payload_codec can be changed while there are tasks in the queue
+"""
+
+TAG_JSON = b'\x01'
+TAG_MSGPACK = b'\x02'
+TAG_JSON_ZLIB = b'\x03'
+TAG_MSGPACK_ZLIB = b'\x04'
+
+PAYLOAD_CODECS = ('json', 'msgpack', 'json+zlib', 'msgpack+zlib')
+
+
+# returns the blob, or None for the json codec, which keeps the data in data_json
+def encode_payload(codec, data):
+
+    if codec == 'json':
+        return None
+
+    if codec == 'msgpack':
+        return TAG_MSGPACK + _msgpack().packb(data, use_bin_type=True)
+
+    if codec == 'json+zlib':
+        return _compress(TAG_JSON, TAG_JSON_ZLIB, json.dumps(data, separators=(',', ':')).encode())
+
+    if codec == 'msgpack+zlib':
+        return _compress(TAG_MSGPACK, TAG_MSGPACK_ZLIB, _msgpack().packb(data, use_bin_type=True))
+
+    raise ValueError("Unknown payload_codec [%s], use %s" % (codec, ', '.join(PAYLOAD_CODECS)))
+
+
+def decode_payload(blob):
+
+    # PostgreSQL returns memoryview
+    blob = bytes(blob)
+    tag, body = blob[:1], blob[1:]
+
+    if tag == TAG_JSON_ZLIB or tag == TAG_MSGPACK_ZLIB:
+        body = zlib.decompress(body)
+
+    if tag == TAG_JSON or tag == TAG_JSON_ZLIB:
+        return json.loads(body)
+
+    if tag == TAG_MSGPACK or tag == TAG_MSGPACK_ZLIB:
+        return _msgpack().unpackb(body, raw=False)
+
+    raise ValueError("Unknown payload tag [%r]" % tag)
+
+
+def is_payload_blob(value) -> bool:
+    return value[:1] in (TAG_JSON, TAG_MSGPACK, TAG_JSON_ZLIB, TAG_MSGPACK_ZLIB)
+
+
+def _compress(tag, compressed_tag, body):
+
+    compressed = zlib.compress(body)
+    if len(compressed) < len(body):
+        return compressed_tag + compressed
+
+    return tag + body
+
+
+def _msgpack():
+    import msgpack
+
+    return msgpack
@@ -0,0 +1,57 @@
+import random
+
+"""
+Polling policies of the worker loop: how long to sleep after a get_new_task_list() call.
+The adaptive one is the default, the fixed one keeps the old busy_interval / empty_interval behaviour
+"""
+
+
+def get_polling_policy(task_class):
+
+    if task_class.adaptive_polling_on:
+        return AdaptivePolling(task_class.get_batch_limit(), task_class.empty_interval_min, task_class.max_latency)
+
+    return FixedPolling(task_class.busy_interval, task_class.empty_interval)
+
+
+class FixedPolling:
+
+    def __init__(self, busy_interval, empty_interval):
+        self.busy_interval = busy_interval
+        self.empty_interval = empty_interval
+
+    def next_delay(self, task_count) -> float:
+
+        if task_count < 1:
+            return self.empty_interval
+
+        return self.busy_interval
+
+
+class AdaptivePolling:
+    """
+    Full batch - the queue is deep, polling again right away.
+    Partial or empty batch - the queue is drained, sleeping with exponential backoff and jitter,
+    starting from `interval_min` and never longer than `max_latency`
+    """
+
+    def __init__(self, batch_limit, interval_min, max_latency):
+        self.batch_limit = batch_limit
+        self.interval_min = interval_min
+        self.max_latency = max_latency
+        self._interval = interval_min
+
+    def next_delay(self, task_count) -> float:
+
+        if task_count >= self.batch_limit:
+            self._interval = self.interval_min
+            return 0
+
+        # a partial batch means the queue has just been drained, new tasks are likely to come soon
+        if task_count > 0:
+            self._interval = self.interval_min
+        else:
+            self._interval = min(self.max_latency, self._interval * 2)
+
+        # jitter keeps workers of the same class from polling in lockstep
+        return random.uniform(self._interval / 2, self._interval)
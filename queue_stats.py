@@ -0,0 +1,145 @@
+from django.core.cache import caches
+from django.db import connections
+
+"""
+Queue size providers of the django queue backend, picked with `queue_size_method` of the task class.
+count - exact COUNT(*), a full scan of the table on most backends
+bounded - COUNT(*) over at most `limit` rows, exact below the limit, which is all the overflow check needs (default)
+estimate - table statistics: pg_class.reltuples on PostgreSQL, information_schema.TABLES on MySQL,
+    bounded count elsewhere or while the table has no statistics yet
+counter - a counter in the Django cache, changed by add_task() and by deleting finished tasks,
+    the cache has to be shared by all processes (redis, memcached, database)
+Every provider returns (size, is_exact)
+"""
+
+
+def get_queue_stats(task_class):
+
+    objects = task_class._get_db_model().objects.using(task_class._get_db_alias())
+    limit = task_class.get_queue_count_limit()
+
+    if task_class.queue_size_method == 'count':
+        return CountQueueStats(objects)
+
+    if task_class.queue_size_method == 'bounded':
+        return BoundedQueueStats(objects, limit)
+
+    if task_class.queue_size_method == 'estimate':
+        return EstimateQueueStats(objects, limit)
+
+    if task_class.queue_size_method == 'counter':
+        return CounterQueueStats(objects, task_class.queue_counter_cache, task_class.queue_counter_ttl)
+
+    raise ValueError("Unknown queue_size_method [%s], use count, bounded, estimate or counter" % task_class.queue_size_method)
+
+
+class CountQueueStats:
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def size(self):
+        return self.objects.count(), True
+
+    def on_added(self, task_count):
+        pass
+
+    def on_deleted(self, task_count):
+        pass
+
+
+class BoundedQueueStats:
+
+    def __init__(self, objects, limit):
+        self.objects = objects
+        self.limit = limit
+
+    def size(self):
+
+        # SELECT COUNT(*) FROM (SELECT .. LIMIT n), stops reading after `limit` rows
+        size = self.objects.all()[:self.limit].count()
+
+        return size, size < self.limit
+
+    def on_added(self, task_count):
+        pass
+
+    def on_deleted(self, task_count):
+        pass
+
+
+class EstimateQueueStats:
+
+    def __init__(self, objects, limit):
+        self.objects = objects
+        self.limit = limit
+
+    def size(self):
+
+        connection = connections[self.objects.db]
+        table_name = self.objects.model._meta.db_table
+        estimate = None
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", [table_name])
+                row = cursor.fetchone()
+                # -1 - never vacuumed or analyzed
+                if row is not None and row[0] >= 0:
+                    estimate = int(row[0])
+
+            elif connection.vendor == 'mysql':
+                cursor.execute(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                    [table_name]
+                )
+                row = cursor.fetchone()
+                if row is not None and row[0] is not None:
+                    estimate = int(row[0])
+
+        if estimate is None:
+            return BoundedQueueStats(self.objects, self.limit).size()
+
+        return estimate, False
+
+    def on_added(self, task_count):
+        pass
+
+    def on_deleted(self, task_count):
+        pass
+
+
+class CounterQueueStats:
+    """
+    The counter is dropped every `ttl` seconds and recounted exactly on the next read,
+    this bounds the drift from tasks deleted outside of the workers and from
+    concurrent add_task(dedupe_refresh=True) calls of the same new dedupe_key, which are all counted (but on PostgreSQL)
+    """
+
+    def __init__(self, objects, cache_alias, ttl):
+        self.objects = objects
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+        self.key = 'background_task_size_%s' % self.objects.model._meta.db_table
+
+    def size(self):
+
+        size = self.cache.get(self.key)
+        if size is None:
+            size = self.objects.count()
+            self.cache.add(self.key, size, self.ttl)
+
+        return max(0, size), False
+
+    # a missing counter is left missing, it's recounted on the next read
+    def on_added(self, task_count):
+        try:
+            self.cache.incr(self.key, task_count)
+        except ValueError:
+            pass
+
+    def on_deleted(self, task_count):
+        try:
+            self.cache.decr(self.key, task_count)
+        except ValueError:
+            pass
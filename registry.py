@@ -0,0 +1,45 @@
+import hashlib
+import threading
+from django.utils.module_loading import import_string
+
+"""
+Process-wide caches of what is expensive to build again and again.
+Queue and logs models are generated with type(), and Django registers every generated model in its app registry,
+so building one again is a warning and a leak in long-running processes: every model is built once per process.
+Task classes are imported once, their instances stay cheap to create (QueueSendEmail().add_task(...))
+"""
+
+_model_registry = {}
+_task_class_registry = {}
+_registry_lock = threading.RLock()
+
+
+# create_model(module, db_app_label, table_name) is called only for the first request of a model
+def get_registered_model(model_kind, module, db_app_label, table_name, create_model):
+
+    key = (model_kind, module, db_app_label, table_name)
+
+    with _registry_lock:
+        if key not in _model_registry:
+            _model_registry[key] = create_model(module, db_app_label, table_name)
+
+        return _model_registry[key]
+
+
+# generated models of different tables must not share a name within an app, Django would take them for one model
+def get_model_name(prefix, module, table_name) -> str:
+    return '%s_%s' % (prefix, hashlib.md5((module + ':' + table_name).encode()).hexdigest()[:10])
+
+
+# index names have to be unique within a database and short enough for every backend
+def get_index_name(table_name, suffix) -> str:
+    return 'bt_%s_%s' % (hashlib.md5(table_name.encode()).hexdigest()[:10], suffix)
+
+
+def get_task_class(task_class_string):
+
+    with _registry_lock:
+        if task_class_string not in _task_class_registry:
+            _task_class_registry[task_class_string] = import_string(task_class_string)
+
+        return _task_class_registry[task_class_string]
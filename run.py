@@ -1,7 +1,13 @@
 import re, os, time
 import hashlib
+import threading
 from BackgroundTask.handler import get_task_class_list, get_task_class_instance
 from BackgroundTask.interface import BackgroundTaskInterface
+from BackgroundTask.polling import get_polling_policy
+from BackgroundTask.execution import get_execution
+from BackgroundTask.wakeup import get_wakeup
+from BackgroundTask.metrics import get_metrics
+from BackgroundTask.heartbeat import get_heartbeat
 import logging
 
 """ 
@@ -36,6 +42,8 @@ class BackgroundTaskRunner:
         self.worker_number = worker_number
         self.worker_id = hashlib.md5((self.task_class_string + str(self.worker_number)).encode()).hexdigest()
         self.worker_lock_file = self.lock_files_path + self.worker_id + '.lock'
+        self._stop_event = threading.Event()
+        self._wakeup = None
 
     # --------------------------------------------------
     # MAIN
@@ -54,28 +62,72 @@ class BackgroundTaskRunner:
         # creating lock file
         self._start_worker()
 
-        task_class = get_task_class_instance(self.task_class_string)
-        assert isinstance(task_class, BackgroundTaskInterface)
-
-        while True:
+        self.run_loop()
 
-            # get new task
-            task_list = task_class.get_new_task_list(self.worker_number)
+    # the worker loop itself, works until shutdown() is called
+    # used directly by the supervisor, which keeps track of its children without lock files
+    # task_class can be passed as an instance for classes that are not in settings (benchmarks)
+    def run_loop(self, task_class=None):
 
-            # empty sleep
-            if len(task_list) < 1:
-                self._log("Sleep empty interval.. %d sec.." % task_class.empty_interval, 'debug')
-                time.sleep(task_class.empty_interval)
-                continue
+        if task_class is None:
+            task_class = get_task_class_instance(self.task_class_string)
+        assert isinstance(task_class, BackgroundTaskInterface)
 
-            # do the tasks
-            for task in task_list:
-                task_class.do_work(task)
-                self.task_count = self.task_count + 1
+        polling = get_polling_policy(task_class)
+        execution = get_execution(task_class)
+        self._wakeup = get_wakeup(task_class)
+        metrics = get_metrics(task_class, self.worker_number)
+        task_class._metrics_instance = metrics
+        heartbeat = get_heartbeat(task_class)
 
-            # busy sleep
-            self._log("Going for a busy interval, tasks done in total: %d" % self.task_count, 'debug')
-            time.sleep(task_class.busy_interval)
+        try:
+            while not self._stop_event.is_set():
+
+                with metrics.count_statements():
+
+                    # get new task
+                    time_start = time.perf_counter()
+                    task_list = task_class.get_new_task_list(self.worker_number)
+                    metrics.observe_claim(time.perf_counter() - time_start, len(task_list))
+
+                    # do the tasks, a claimed batch is always finished, otherwise its tasks would wait for `task_execution_time`
+                    # the leases are extended while the tasks are worked on, the batch is completed after that
+                    with task_class.completion_batch():
+                        with heartbeat.leasing(task_list):
+                            execution.run_batch(task_list)
+                self.task_count = self.task_count + len(task_list)
+                metrics.write_due()
+
+                delay = polling.next_delay(len(task_list))
+                if delay <= 0:
+                    continue
+
+                # empty sleep
+                if len(task_list) < 1:
+                    self._log("Sleep empty interval.. %.2f sec.." % delay, 'debug')
+                    self._sleep(delay)
+                    continue
+
+                # busy sleep
+                self._log("Going for a busy interval, tasks done in total: %d" % self.task_count, 'debug')
+                self._sleep(delay)
+        finally:
+            heartbeat.stop()
+            execution.close()
+            task_class.flush_logs()
+            metrics.write()
+
+            if self._wakeup is not None:
+                self._wakeup.close()
+
+        self._log("Stopped gracefully, tasks done in total: %d" % self.task_count)
+
+    # graceful stop: the current batch is finished and the loop exits, safe to call from a signal handler
+    def shutdown(self):
+        self._stop_event.set()
+
+        if self._wakeup is not None:
+            self._wakeup.interrupt()
 
     def stop(self):
 
@@ -147,6 +199,16 @@ class BackgroundTaskRunner:
     # PROTECTED UTILS
     # --------------------------------------------------
 
+    # sleeps, but wakes up right away on shutdown() or when new tasks are added (with `wakeup_on`)
+    def _sleep(self, seconds):
+
+        if self._wakeup is None or self._stop_event.is_set():
+            self._stop_event.wait(seconds)
+            return
+
+        if self._wakeup.wait(seconds):
+            self._log("Woken up by a new task", 'debug')
+
     def _log(self, message, level='info'):
 
         message = "%s (%s): " % (self.task_class_string, str(self.worker_number)) + message
@@ -0,0 +1,185 @@
+import datetime
+from functools import lru_cache
+from django.utils import timezone
+
+"""
+Schedules of recurring tasks, add_task(every=...) or add_task(cron=...).
+A recurring task is one row that stays in the queue, when a run is finished (or given up after its retries)
+the row gets need_work of the next run instead of being deleted, so the need_work index finds the next due one.
+The schedule is kept in the `schedule` column as text: 'every 3600' or 'cron 0 3 * * *'.
+every - seconds from the start of a run to the start of the next one,
+    a run that takes longer is followed by the next one right away
+cron - minute, hour, day of month, month, day of week, with *, lists, ranges, steps and names (*/15, 1-5, mon-fri),
+    in the TIME_ZONE of the settings. When both days are restricted, a day matching either one is run, as in crontab.
+    @hourly, @daily, @weekly, @monthly and @yearly are fine too
+"""
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+
+# (min, max, names from min) of the five fields, sunday is both 0 and 7
+CRON_FIELDS = (
+    (0, 59, None),
+    (0, 23, None),
+    (1, 31, None),
+    (1, 12, ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')),
+    (0, 7, ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')),
+)
+
+# a february 29th comes at least once in 8 years, an expression without a day in them never runs
+CRON_SEARCH_DAYS = 8 * 366
+
+
+# the text of the schedule column, None for a one-off task
+def get_schedule(every=None, cron=None):
+
+    if every is not None and cron is not None:
+        raise ValueError("A task runs either every N seconds or by cron, not both")
+
+    if every is not None:
+        if int(every) < 1:
+            raise ValueError("every must be at least 1 second, got [%s]" % every)
+        return 'every %d' % int(every)
+
+    if cron is not None:
+        expression = ' '.join(cron.split())
+        get_cron_expression(expression).get_next_run(0)
+        return 'cron ' + expression
+
+    return None
+
+
+# need_work of the first run: every - right away, cron - its next minute
+def get_first_run(schedule, now) -> int:
+
+    kind, expression = schedule.split(' ', 1)
+    if kind == 'every':
+        return now
+
+    return get_cron_expression(expression).get_next_run(now)
+
+
+# need_work of the run after the one started at `started`
+def get_next_run(schedule, started, now) -> int:
+
+    kind, expression = schedule.split(' ', 1)
+    if kind == 'every':
+        return max(started + int(expression), now)
+
+    if kind == 'cron':
+        return get_cron_expression(expression).get_next_run(max(started, now))
+
+    raise ValueError("Unknown schedule [%s]" % schedule)
+
+
+@lru_cache(maxsize=256)
+def get_cron_expression(expression):
+    return CronExpression(expression)
+
+
+class CronExpression:
+
+    def __init__(self, expression):
+        self.expression = expression
+
+        field_list = CRON_ALIASES.get(expression, expression).split()
+        if len(field_list) != 5:
+            raise ValueError("Cron expression [%s] must have 5 fields: minute hour day month weekday" % expression)
+
+        self.minutes, self.hours, days, months, weekdays = [
+            self._parse_field(text, *CRON_FIELDS[i]) for i, text in enumerate(field_list)
+        ]
+        self.days = set(days)
+        self.months = set(months)
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+
+        # as in crontab, a restricted day of month and day of week are either-or
+        self.days_either = not field_list[2].startswith('*') and not field_list[4].startswith('*')
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    # the first matching minute after `after`, as a timestamp
+    def get_next_run(self, after) -> int:
+
+        time_zone = timezone.get_default_timezone()
+        start = datetime.datetime.fromtimestamp(after, time_zone).replace(tzinfo=None, second=0, microsecond=0)
+        start = start + datetime.timedelta(minutes=1)
+
+        day = start.date()
+        for _ in range(CRON_SEARCH_DAYS):
+            if self._is_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        local_time = datetime.datetime.combine(day, datetime.time(hour, minute))
+                        if local_time < start:
+                            continue
+
+                        # a local time skipped or repeated by DST resolves to its first occurrence
+                        timestamp = int(local_time.replace(tzinfo=time_zone).timestamp())
+                        if timestamp > after:
+                            return timestamp
+
+            day = day + datetime.timedelta(days=1)
+
+        raise ValueError("Cron expression [%s] never runs" % self.expression)
+
+    # --------------------------------------------------
+    # PROTECTED
+    # --------------------------------------------------
+
+    def _is_day(self, day) -> bool:
+
+        if day.month not in self.months:
+            return False
+
+        is_day = day.day in self.days
+        is_weekday = day.isoweekday() % 7 in self.weekdays
+        if self.days_either:
+            return is_day or is_weekday
+
+        return is_day and is_weekday
+
+    # sorted values of a field
+    def _parse_field(self, text, minimum, maximum, names) -> list:
+
+        value_set = set()
+        for part in text.lower().split(','):
+            range_text, has_step, step_text = part.partition('/')
+
+            if range_text == '*':
+                start, end = minimum, maximum
+            else:
+                start_text, has_end, end_text = range_text.partition('-')
+                start = self._parse_value(start_text, minimum, maximum, names)
+                # 5/15 is 5-59/15
+                if has_end:
+                    end = self._parse_value(end_text, minimum, maximum, names)
+                else:
+                    end = maximum if has_step else start
+
+            step = self._parse_value(step_text, 1, maximum, None) if has_step else 1
+            if start > end:
+                raise ValueError("Cron expression [%s]: range [%s] is backwards" % (self.expression, part))
+
+            value_set.update(range(start, end + 1, step))
+
+        return sorted(value_set)
+
+    def _parse_value(self, text, minimum, maximum, names) -> int:
+
+        if names is not None and text in names:
+            return minimum + names.index(text)
+
+        if not text.isdigit() or not minimum <= int(text) <= maximum:
+            raise ValueError("Cron expression [%s]: [%s] is not in %d-%d" % (self.expression, text, minimum, maximum))
+
+        return int(text)
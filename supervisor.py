@@ -0,0 +1,257 @@
+import os
+import sys
+import glob
+import time
+import signal
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.conf import settings
+from django.db import connections
+from BackgroundTask.handler import get_task_class_list, get_task_class_instance
+from BackgroundTask.run import BackgroundTaskRunner
+from BackgroundTask.metrics import get_metrics_dir, merge_metrics_text
+
+"""
+Long-lived alternative to the cron launched workers.
+Django is booted once, then every worker of every class from
+settings.BACKGROUND_TASK_CLASSES is forked from this process,
+dead workers are restarted right away (with a backoff if they keep crashing).
+SIGTERM / SIGINT - graceful stop: workers finish their current batch and exit
+SIGHUP - graceful reload: workers are drained and the supervisor re-executes itself with fresh code
+With BACKGROUND_TASK_METRICS_PORT in settings the metrics files of the workers (see metrics.py)
+are served at http://<BACKGROUND_TASK_METRICS_HOST, 127.0.0.1 by default>:<port>/metrics
+"""
+
+
+class BackgroundTaskSupervisor:
+
+    # how often children are reaped and restarted (seconds)
+    check_interval = 0.5
+
+    # restart delay grows twice with every crash in a row, up to the max (seconds)
+    restart_delay_min = 1
+    restart_delay_max = 60
+
+    # a worker that lived this long is considered healthy, its crash counter is reset (seconds)
+    stable_time = 60
+
+    # how long to wait for workers to finish their batches before killing them (seconds)
+    drain_timeout = 60
+
+    def __init__(self):
+        self._slot_list = []
+        self._wake_event = threading.Event()
+        self._stop_signal = None
+        self._metrics_server = None
+
+    # --------------------------------------------------
+    # MAIN
+    # --------------------------------------------------
+
+    def run(self):
+
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGHUP, self._on_signal)
+
+        for task_class_string in get_task_class_list():
+            task_class_inst = get_task_class_instance(task_class_string)
+            self._log("%s: %d workers" % (task_class_string, task_class_inst.worker_count))
+
+            for worker_number in range(task_class_inst.worker_count):
+                self._slot_list.append({
+                    'task_class_string': task_class_string,
+                    'worker_number': worker_number,
+                    'pid': None,
+                    'started_at': 0,
+                    'crash_count': 0,
+                    'restart_at': 0,
+                })
+
+        self._start_metrics_server()
+
+        # children must not share the parent's connections
+        connections.close_all()
+
+        while self._stop_signal is None:
+            self._reap()
+            self._spawn_due()
+            self._wake_event.wait(self.check_interval)
+
+        self._drain()
+
+        if self._stop_signal == signal.SIGHUP:
+            self._log("Reloading..")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        self._log("Stopped.")
+
+    # --------------------------------------------------
+    # PROTECTED MAIN
+    # --------------------------------------------------
+
+    def _spawn_due(self):
+
+        now = time.time()
+        for slot in self._slot_list:
+            if slot['pid'] is None and slot['restart_at'] <= now:
+                self._spawn(slot)
+
+    def _spawn(self, slot):
+
+        pid = os.fork()
+
+        if pid != 0:
+            slot['pid'] = pid
+            slot['started_at'] = time.time()
+            return
+
+        # child
+        exit_code = 0
+        try:
+            if self._metrics_server is not None:
+                self._metrics_server.socket.close()
+
+            runner = BackgroundTaskRunner(slot['task_class_string'], slot['worker_number'])
+
+            signal.signal(signal.SIGTERM, lambda signum, frame: runner.shutdown())
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+            # the lock file keeps the cron launcher from starting a duplicate of this worker
+            runner._start_worker()
+            runner.run_loop()
+        except BaseException:
+            logging.getLogger('background_task').exception("Worker crashed")
+            exit_code = 1
+        finally:
+            connections.close_all()
+            sys.stdout.flush()
+            os._exit(exit_code)
+
+    # collecting exited children and scheduling their restart
+    def _reap(self):
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            for slot in self._slot_list:
+                if slot['pid'] != pid:
+                    continue
+
+                slot['pid'] = None
+
+                if self._stop_signal is not None:
+                    self._log("%s (%d): stopped" % (slot['task_class_string'], slot['worker_number']))
+                    continue
+
+                if time.time() - slot['started_at'] >= self.stable_time:
+                    slot['crash_count'] = 0
+
+                delay = min(self.restart_delay_max, self.restart_delay_min * (2 ** slot['crash_count']))
+                slot['crash_count'] = slot['crash_count'] + 1
+                slot['restart_at'] = time.time() + delay
+
+                self._log("%s (%d): exited with status %d, restarting in %d sec.." % (
+                    slot['task_class_string'], slot['worker_number'], os.waitstatus_to_exitcode(status), delay
+                ), 'error')
+
+    # asking every worker to finish its batch, killing the ones that don't make it in time
+    def _drain(self):
+
+        self._log("Draining workers..")
+        self._signal_children(signal.SIGTERM)
+
+        deadline = time.time() + self.drain_timeout
+        while self._has_children() and time.time() < deadline:
+            self._reap()
+            time.sleep(self.check_interval)
+
+        if self._has_children():
+            self._log("Workers did not stop in %d sec, killing them" % self.drain_timeout, 'error')
+            self._signal_children(signal.SIGKILL)
+            for slot in self._slot_list:
+                if slot['pid'] is not None:
+                    os.waitpid(slot['pid'], 0)
+                    slot['pid'] = None
+
+    def _start_metrics_server(self):
+
+        port = getattr(settings, 'BACKGROUND_TASK_METRICS_PORT', None)
+        if port is None:
+            return
+
+        metrics_dir_list = set()
+        for task_class_string in get_task_class_list():
+            task_class_inst = get_task_class_instance(task_class_string)
+            if task_class_inst.metrics_on:
+                metrics_dir_list.add(get_metrics_dir(task_class_inst))
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                text_list = []
+                for metrics_dir in metrics_dir_list:
+                    for path in glob.glob(os.path.join(metrics_dir, '*.prom')):
+                        with open(path) as metrics_file:
+                            text_list.append(metrics_file.read())
+
+                body = merge_metrics_text(text_list).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # scrapes are not worth a line of the supervisor's output
+            def log_message(self, format, *args):
+                pass
+
+        host = getattr(settings, 'BACKGROUND_TASK_METRICS_HOST', '127.0.0.1')
+        self._metrics_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        threading.Thread(target=self._metrics_server.serve_forever, daemon=True).start()
+
+        self._log("Serving metrics at http://%s:%d/metrics" % (host, port))
+
+    # --------------------------------------------------
+    # PROTECTED UTILS
+    # --------------------------------------------------
+
+    def _on_signal(self, signum, frame):
+        self._stop_signal = signum
+        self._wake_event.set()
+
+    def _signal_children(self, signum):
+        for slot in self._slot_list:
+            if slot['pid'] is None:
+                continue
+            try:
+                os.kill(slot['pid'], signum)
+            except OSError:
+                pass
+
+    def _has_children(self):
+        return any([slot['pid'] is not None for slot in self._slot_list])
+
+    def _log(self, message, level='info'):
+
+        message = "supervisor (%d): " % os.getpid() + message
+
+        if level == 'info':
+            print("INFO: %s" % message)
+            logging.getLogger('background_task').info(message)
+        elif level == 'error':
+            print("!!! ERROR !!!: %s" % message)
+            logging.getLogger('background_task').error(message)
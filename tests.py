@@ -0,0 +1,1236 @@
+import io
+import os
+import json
+import time
+import asyncio
+import datetime
+import tempfile
+import urllib.error
+import urllib.request
+import threading
+import contextlib
+import zoneinfo
+from django.conf import settings as django_settings
+from django.db import connection, models
+from unittest import skipIf
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from BackgroundTask.interface import BackgroundTaskInterface
+from BackgroundTask.logger import BackgroundTaskLogger
+from BackgroundTask.log_writer import BackgroundLogWriter
+from BackgroundTask.backends import MemoryQueueBackend, RedisQueueBackend
+from BackgroundTask.execution import BatchExecution, SerialExecution, get_execution
+from BackgroundTask.metrics import get_metrics, merge_metrics_text
+from BackgroundTask.heartbeat import NULL_HEARTBEAT, get_heartbeat
+from BackgroundTask.schedule import get_schedule, get_first_run, get_next_run
+from BackgroundTask.polling import AdaptivePolling, FixedPolling, get_polling_policy
+from BackgroundTask.wakeup import SocketWakeup, get_wakeup
+from BackgroundTask.management.commands.background_task import Command
+from BackgroundTask.run import BackgroundTaskRunner
+from BackgroundTask.supervisor import BackgroundTaskSupervisor
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+"""
+Run with ./manage.py test BackgroundTask
+Schema changes can't run inside a transaction on sqlite, hence TransactionTestCase
+The redis backend is tested against fakeredis (with lupa for the scripts), skipped without it
+"""
+
+
+class MigrateTask(BackgroundTaskInterface):
+    table_name = 'bt_test_migrate'
+    logs_on = False
+
+    def work(self, data):
+        return True
+
+
+# the default task_limit_per_execution, sqlite plans small LIMITs differently
+class PlanTask(MigrateTask):
+    table_name = 'bt_test_plan'
+
+
+class CounterTask(MigrateTask):
+    table_name = 'bt_test_counter'
+    queue_size_method = 'counter'
+
+
+# the same table, without the counter
+class DedupeTask(MigrateTask):
+    table_name = 'bt_test_counter'
+
+
+class ProcessPoolTask(MigrateTask):
+    table_name = 'bt_test_process_pool'
+    execution_mode = 'process_pool'
+    concurrency = 1
+    task_limit_per_execution = 3
+    metrics_on = True
+
+    def work(self, data):
+        time.sleep(data['sleep'])
+        return data['ok']
+
+
+# False is retried, an exception fails the task for good
+class ThreadsTask(MigrateTask):
+    table_name = 'bt_test_execution'
+    execution_mode = 'threads'
+    concurrency = 4
+    task_limit_per_execution = 4
+    retry_delay = 60
+
+    def work(self, data):
+        time.sleep(0.3)
+        return data['ok']
+
+
+class AsyncioTask(ThreadsTask):
+    execution_mode = 'asyncio'
+
+    async def work(self, data):
+        await asyncio.sleep(0.3)
+        return data['ok']
+
+
+class CompletionTask(MigrateTask):
+    table_name = 'bt_test_completion'
+    logs_on = True
+    logs_table_name = 'bt_test_completion_logs'
+    task_limit_per_execution = 10
+    retry_delay = 60
+
+    def work(self, data):
+        return data['ok']
+
+
+# gets the data of the whole batch, too many results fail it
+class WorkBatchTask(CompletionTask):
+
+    def work_batch(self, data_list):
+        self.logger().info("batch of %d" % len(data_list))
+        return [data['ok'] for data in data_list] + [True] * data_list[0].get('extra', 0)
+
+
+# the writer only writes when it's flushed
+class AsyncLogsTask(MigrateTask):
+    table_name = 'bt_test_async'
+    logs_on = True
+    logs_async_on = True
+    logs_table_name = 'bt_test_async_logs'
+    logs_flush_interval = 60
+    task_limit_per_execution = 10
+
+
+class MetricsTask(MigrateTask):
+    table_name = 'bt_test_metrics'
+    metrics_on = True
+
+
+class HeartbeatTask(MigrateTask):
+    table_name = 'bt_test_heartbeat'
+    lease_heartbeat_on = True
+    lease_heartbeat_interval = 0.05
+    task_execution_time = 60
+
+
+class RetryOrderTask(MigrateTask):
+    table_name = 'bt_test_retry_order'
+
+
+class WakeupTask(MigrateTask):
+    table_name = 'bt_test_wakeup'
+    wakeup_on = True
+    wakeup_transport = 'socket'
+
+
+class RedisTask(MigrateTask):
+    table_name = 'bt_test_redis'
+    queue_backend = 'redis'
+
+    def get_redis_client(self):
+        return self.redis_client
+
+
+# the queue table as the first release of the package created it
+def _create_baseline_model(table_name):
+
+    class Meta:
+        app_label = 'default'
+        db_table = table_name
+
+    return type('BaselineQueueModel', (models.Model,), {
+        '__module__': __name__,
+        'Meta': Meta,
+        'task_id': models.AutoField(primary_key=True),
+        'need_work': models.IntegerField(default=0),
+        'errors': models.IntegerField(default=0),
+        'date_added': models.IntegerField(default=0),
+        'data_json': models.JSONField(),
+    })
+
+
+BASELINE_MODEL = _create_baseline_model(MigrateTask.table_name)
+
+
+class MigrateTest(TransactionTestCase):
+
+    def setUp(self):
+        self.baseline_model = BASELINE_MODEL
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.baseline_model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.baseline_model)
+
+    def test_baseline_table_is_brought_up_to_date(self):
+
+        self.baseline_model.objects.create(need_work=0, date_added=0, data_json={'old': True})
+        task = MigrateTask()
+        model = task._get_db_model()
+
+        Command()._update_table('default', model)
+
+        # every column and index of the model, and a second run has nothing left to do
+        with connection.cursor() as cursor:
+            column_list = [column.name for column in connection.introspection.get_table_description(cursor, model._meta.db_table)]
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        self.assertEqual(sorted(column_list), sorted([field.column for field in model._meta.local_fields]))
+        for index in model._meta.indexes:
+            self.assertIn(index.name, constraints)
+        self.assertEqual(Command()._update_table('default', model), [])
+
+        # the old task keeps its data through the rebuilds of sqlite, and goes first as the oldest one
+        task.add_task({'new': True})
+        task_list = task.get_new_task_list()
+        self.assertEqual([task_row.data_json for task_row in task_list], [{'old': True}, {'new': True}])
+        for task_row in task_list:
+            task.do_work(task_row)
+        self.assertEqual(model.objects.count(), 0)
+
+
+class CounterTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = CounterTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        self.task._get_queue_backend().queue_stats.cache.clear()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_deduplicated_adds_are_not_counted(self):
+
+        self.assertEqual(self.task.get_queue_size(), 0)
+
+        for dedupe_refresh in (False, True, False):
+            self.task.add_task({'n': 1}, dedupe_key='one', dedupe_refresh=dedupe_refresh)
+            self.task.add_task({'every': 1}, dedupe_key='every', every=60, dedupe_refresh=dedupe_refresh)
+        self.task.add_tasks([{'n': 2}, {'n': 3}])
+
+        self.assertEqual(self.task.get_queue_size(), 4)
+        self.assertEqual(self.model.objects.count(), 4)
+
+    # the insert tells if it inserted, the key is looked up only to count a refresh, and not on postgres
+    def test_deduplicated_add_is_one_statement(self):
+
+        refresh_count = 1 if connection.vendor == 'postgresql' else 2
+        for task, dedupe_refresh, query_count in (
+            (DedupeTask(), False, 1), (DedupeTask(), True, 1), (self.task, False, 1), (self.task, True, refresh_count),
+        ):
+            for _ in range(2):
+                with self.assertNumQueries(query_count):
+                    task.add_task({'n': 1}, dedupe_key='one', dedupe_refresh=dedupe_refresh)
+
+
+class ProcessPoolMetricsTest(TransactionTestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        self.task = ProcessPoolTask()
+        self.task.metrics_dir = self.metrics_dir.name + '/'
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+        self.metrics_dir.cleanup()
+
+    # results are counted in the worker process, work() is timed in the pool process, without waiting for it
+    def test_results_and_work_time_are_observed(self):
+
+        self.task.add_tasks([{'sleep': 0.2, 'ok': True}, {'sleep': 0.2, 'ok': True}, {'sleep': 0.2, 'ok': False}])
+
+        metrics = get_metrics(self.task, 0)
+        self.task._metrics_instance = metrics
+        execution = get_execution(self.task)
+        try:
+            with self.task.completion_batch():
+                execution.run_batch(self.task.get_new_task_list())
+        finally:
+            execution.close()
+
+        self.assertEqual(metrics._task_counts, {'ok': 2, 'fail': 0, 'retry': 1})
+        self.assertEqual(metrics._work_seconds.count, 3)
+        self.assertLess(metrics._work_seconds.sum, 0.9)
+
+
+class ExecutionTest(TransactionTestCase):
+
+    def setUp(self):
+        self.model = ThreadsTask()._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def _run_batch(self, task):
+
+        task.add_tasks([{'ok': True}, {'ok': True}, {'ok': False}, {}])
+        task_list = task.get_new_task_list()
+        self.assertEqual(len(task_list), 4)
+
+        execution = get_execution(task)
+        started = time.monotonic()
+        try:
+            with task.completion_batch():
+                execution.run_batch(task_list)
+        finally:
+            execution.close()
+
+        # the tasks ran at once, and were all completed by the batch
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(list(self.model.objects.values_list('data_json', flat=True)), [{'ok': False}])
+        self.assertGreater(self.model.objects.get().need_work, time.time() + 30)
+
+    def test_threads(self):
+        self._run_batch(ThreadsTask())
+
+    def test_asyncio(self):
+        self._run_batch(AsyncioTask())
+
+    def test_batch_limit_covers_concurrency(self):
+
+        task = ThreadsTask()
+        task.task_limit_per_execution = 2
+        self.assertEqual(task.get_batch_limit(), 4)
+
+        task.execution_mode = 'serial'
+        self.assertEqual(task.get_batch_limit(), 2)
+
+        task.execution_mode = 'fibers'
+        with self.assertRaises(ValueError):
+            get_execution(task)
+
+
+class CompletionBatchTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = CompletionTask()
+        self.model = self.task._get_db_model()
+        self.logs_model = self.task._get_instance_logger()._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+            schema_editor.create_model(self.logs_model)
+
+        self.task.add_tasks([{'ok': True}, {'ok': False}, {'ok': True}])
+        self.task_list = self.task.get_new_task_list()
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+            schema_editor.delete_model(self.logs_model)
+
+    # one INSERT of the logs, one UPDATE of the retries, one DELETE, whatever the batch size
+    def test_batch_is_completed_at_once(self):
+
+        with CaptureQueriesContext(connection) as context:
+            with self.task.completion_batch():
+                SerialExecution(self.task).run_batch(self.task_list)
+
+        sql_list = [query['sql'].split()[0] for query in context.captured_queries]
+        self.assertEqual([sql for sql in sql_list if sql in ('INSERT', 'UPDATE', 'DELETE')], ['INSERT', 'UPDATE', 'DELETE'])
+        self.assertEqual(list(self.model.objects.values_list('data_json', flat=True)), [{'ok': False}])
+        self.assertEqual(self.logs_model.objects.count(), 3)
+
+    # nothing of the batch is committed, the tasks stay leased and are worked on again once the lease runs out
+    def test_flush_failing_midway_is_rolled_back(self):
+
+        backend = self.task._get_queue_backend()
+        need_work_list = list(self.model.objects.values_list('need_work', flat=True))
+
+        def delete(task_ids, lease_token=None):
+            raise RuntimeError("connection lost")
+
+        backend.delete = delete
+        with self.assertRaisesRegex(RuntimeError, 'connection lost'):
+            with self.task.completion_batch():
+                SerialExecution(self.task).run_batch(self.task_list)
+
+        self.assertEqual(list(self.model.objects.values_list('need_work', flat=True)), need_work_list)
+        self.assertEqual(self.logs_model.objects.count(), 0)
+
+    # the tasks finished before the batch broke are still completed
+    def test_broken_batch_is_flushed(self):
+
+        def on_retry():
+            raise RuntimeError("broken callback")
+
+        self.task.on_retry = on_retry
+        with self.assertRaisesRegex(RuntimeError, 'broken callback'):
+            with self.task.completion_batch():
+                SerialExecution(self.task).run_batch(self.task_list)
+
+        self.assertEqual(list(self.model.objects.values_list('data_json', flat=True)), [{'ok': False}, {'ok': True}])
+        self.assertEqual(self.logs_model.objects.count(), 1)
+
+
+class WorkBatchTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = WorkBatchTask()
+        self.model = self.task._get_db_model()
+        self.logs_model = self.task._get_instance_logger()._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+            schema_editor.create_model(self.logs_model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+            schema_editor.delete_model(self.logs_model)
+
+    # one call for the batch, results and its messages go to every task
+    def test_results_per_task(self):
+
+        self.task.add_tasks([{'ok': True}, {'ok': False}, {'ok': True}])
+        self._run_batch()
+
+        self.assertEqual(list(self.model.objects.values_list('data_json', flat=True)), [{'ok': False}])
+        for log in self.task.logger().get_last_logs():
+            self.assertIn('batch of 3', [message['message_text'] for message in log['message_json']])
+
+    # a task out of attempts isn't given to work_batch()
+    def test_retry_count_max(self):
+
+        self.task.add_tasks([{'ok': True}, {'ok': True}])
+        self.model.objects.filter(task_id=self.model.objects.order_by('task_id')[0].task_id).update(errors=4)
+        self._run_batch()
+
+        self.assertEqual(self.model.objects.count(), 0)
+        self.assertIn('batch of 1', json.dumps(self.task.logger().get_last_logs()))
+
+    def test_wrong_number_of_results_fails_the_batch(self):
+
+        self.task.add_tasks([{'ok': True, 'extra': 1}, {'ok': True}])
+        self._run_batch()
+
+        self.assertEqual(self.model.objects.count(), 0)
+        self.assertIn('returned 3 results for 2 tasks', json.dumps(self.task.logger().get_last_logs()))
+
+    def _run_batch(self):
+
+        execution = get_execution(self.task)
+        self.assertIsInstance(execution, BatchExecution)
+        with self.task.completion_batch():
+            execution.run_batch(self.task.get_new_task_list())
+
+
+class HeartbeatTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = HeartbeatTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+        self.task.add_tasks([{'n': 1}, {'n': 2}])
+        self.task_list = self.task.get_new_task_list()
+
+        # leases about to run out
+        self.model.objects.update(need_work=1)
+        self.heartbeat = get_heartbeat(self.task)
+
+    def tearDown(self):
+        self.heartbeat.stop()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_leases_are_extended(self):
+
+        self.assertIs(get_heartbeat(MigrateTask()), NULL_HEARTBEAT)
+
+        with self.heartbeat.leasing(self.task_list):
+            self._wait_for_beat()
+
+        self.assertEqual(self.heartbeat.lost_lease_count, 0)
+        self.assertGreater(self.model.objects.order_by('need_work')[0].need_work, time.time() + 30)
+
+    # a task claimed by another worker since is not extended, and is reported
+    def test_lost_lease_is_counted(self):
+
+        self.model.objects.filter(task_id=self.task_list[0].task_id).update(lease_token='another:1:worker')
+
+        with self.assertLogs('background_task', 'WARNING') as logs:
+            with self.heartbeat.leasing(self.task_list):
+                self._wait_for_beat()
+
+        self.assertEqual(self.heartbeat.lost_lease_count, 1)
+        self.assertIn('1 of 2 leases were lost', logs.output[0])
+        self.assertEqual(self.model.objects.get(task_id=self.task_list[0].task_id).need_work, 1)
+        self.assertGreater(self.model.objects.get(task_id=self.task_list[1].task_id).need_work, time.time() + 30)
+
+    # the table isn't read while the heartbeat thread runs, sqlite's shared cache would lock it
+    def _wait_for_beat(self):
+
+        beat_event = threading.Event()
+        extend_leases = self.task.extend_leases
+
+        def extend_leases_once(task_ids):
+            self.heartbeat._stop_event.set()
+            extended_count = extend_leases(task_ids)
+            beat_event.set()
+            return extended_count
+
+        self.task.extend_leases = extend_leases_once
+        self.assertTrue(beat_event.wait(5))
+        self.heartbeat.stop()
+
+
+class ClaimOrderTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = RetryOrderTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_scheduled_task_waits_from_need_work(self):
+
+        now = int(time.time())
+        self.assertEqual(self.task._new_task_row({}, 0, 1, now)['claim_order'], now - self.task.priority_aging)
+        self.assertEqual(self.task._new_task_row({}, now + 3600, 1, now)['claim_order'], now + 3600 - self.task.priority_aging)
+
+    # the batch comes in claim_order, not in the order the tasks were added, in every backend
+    def test_batch_is_claimed_in_claim_order(self):
+
+        for backend in (self.task._get_queue_backend(), MemoryQueueBackend(self.task.table_name)):
+            now = int(time.time())
+            for name, priority, date_added in (('new', 0, now - 10), ('urgent', 1, now), ('old', 0, now - 100)):
+                backend.add([self.task._new_task_row({'n': name}, 0, priority, date_added)])
+
+            task_list = backend.claim(now, now + 60, 3, 'token')
+            self.assertEqual([task_row.data_json['n'] for task_row in task_list], ['old', 'urgent', 'new'])
+            backend.delete([task_row.task_id for task_row in task_list], 'token')
+
+    # a retried task goes behind the tasks added before its retry, in every backend
+    def test_retried_task_waits_from_retry(self):
+
+        for backend in (self.task._get_queue_backend(), MemoryQueueBackend(self.task.table_name)):
+            now = int(time.time())
+            backend.add([self.task._new_task_row({'n': 'old'}, 0, 0, now - 100)])
+            backend.add([self.task._new_task_row({'n': 'new'}, 0, 0, now - 50)])
+
+            old_row = backend.claim(now, now + 60, 1, 'token')[0]
+            backend.retry([old_row.task_id], now, self.task.priority_aging, 'token')
+
+            task_list = backend.claim(now, now + 60, 2, 'token')
+            self.assertEqual([task_row.data_json['n'] for task_row in task_list], ['new', 'old'])
+            backend.delete([task_row.task_id for task_row in task_list], 'token')
+
+
+class AddTasksTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = RetryOrderTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_batches_and_ids(self):
+
+        task_ids = self.task.add_tasks(({'n': i} for i in range(7)), batch_size=3, return_ids=True)
+
+        self.assertEqual(self.task.add_tasks([{'n': 7}], batch_size=3), 1)
+        self.assertEqual(self.model.objects.count(), 8)
+        if connection.features.can_return_rows_from_bulk_insert:
+            rows = dict(self.model.objects.values_list('task_id', 'data_json'))
+            self.assertEqual([rows[task_id] for task_id in task_ids], [{'n': i} for i in range(7)])
+        else:
+            self.assertEqual(task_ids, [None] * 7)
+
+    # a failing generator after the first batch: atomic keeps nothing, otherwise the inserted batches stay
+    def test_atomic_rollback(self):
+
+        def data_iterable():
+            yield from ({'n': i} for i in range(4))
+            raise RuntimeError("the source broke")
+
+        for atomic, task_count in ((True, 0), (False, 3)):
+            with self.assertRaises(RuntimeError):
+                self.task.add_tasks(data_iterable(), batch_size=3, atomic=atomic)
+            self.assertEqual(self.model.objects.count(), task_count)
+
+    def test_invalid_batch_size(self):
+
+        for batch_size in (0, -1):
+            with self.assertRaises(ValueError):
+                self.task.add_tasks([{'n': 1}], batch_size=batch_size)
+        self.assertEqual(self.model.objects.count(), 0)
+
+
+class QueryPlanTest(TransactionTestCase):
+    """ The queries of the workers must stay on the indexes of the queue table, whatever the backlog """
+
+    task_count = 5000
+
+    def setUp(self):
+        self.task = PlanTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+        # a few due tasks, the rest scheduled for later
+        now = int(time.time())
+        self.model.objects.bulk_create([
+            self.model(**self.task._new_task_row({'n': i}, 0 if i % 100 == 0 else now + i, i % 3, now - i))
+            for i in range(self.task_count)
+        ])
+
+        # with statistics, as a database that has been running for a while has them
+        with connection.cursor() as cursor:
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            cursor.execute(('ANALYZE TABLE %s' if connection.vendor == 'mysql' else 'ANALYZE %s') % table)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_claim_uses_claim_order_index(self):
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(len(self.task.get_new_task_list()), self.task.task_limit_per_execution)
+
+        self.assertIn(self._get_index_name('claim_order'), self._explain(context.captured_queries[0]['sql']))
+
+    # ready, scheduled and in_flight, in this order
+    def test_split_counts_use_indexes(self):
+
+        self.task.get_new_task_list()
+        backend = self.task._get_queue_backend()
+        with CaptureQueriesContext(connection) as context:
+            backend.get_split_counts(int(time.time()), 1000)
+
+        for query, field_name in zip(context.captured_queries, ('need_work', 'claimed_at', 'claimed_at')):
+            self.assertIn(self._get_index_name(field_name), self._explain(query['sql']))
+
+    def _get_index_name(self, field_name) -> str:
+        return [index.name for index in self.model._meta.indexes if index.fields[0] == field_name][0]
+
+    def _explain(self, sql) -> str:
+
+        with connection.cursor() as cursor:
+            cursor.execute(connection.ops.explain_query_prefix() + ' ' + sql)
+            return ' '.join([' '.join([str(value) for value in row]) for row in cursor.fetchall()])
+
+
+class LoggerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.logger = BackgroundTaskLogger('bt_test_logs')
+        self.logger.extra_data_max_length = 100
+
+    def test_extra_data_that_fits_is_kept(self):
+
+        for data in ({}, {'a': [1, 2.5, None, True]}, [1, 2], 'text', 42, 1.5, None):
+            self.assertEqual(self.logger._format_data(data), data)
+
+    def test_extra_data_too_big_is_cut(self):
+
+        for data in (
+            {'a': 'x' * 1000}, ['x'] * 1000, 'x' * 1000, {'a': {'b': list(range(1000))}}, {'"' * 1000: 1},
+            {'a': '"\\\n' * 1000}, {1: [None, True, 1.5, 'é' * 1000]}, [{'a': 'x' * 30}] * 1000, {'n': 10 ** 200},
+            [[]] * 1000, {str(i): i for i in range(1000)}, {'a': [{'b': {'c': [None, True, 1.5, 'x' * 7]}}] * 100},
+        ):
+            formatted = self.logger._format_data(data)
+            self.assertTrue(formatted['truncated'])
+            self.assertEqual(len(formatted['start']), 100)
+            self.assertTrue(json.dumps(data).startswith(formatted['start']))
+
+
+class LogWriterTest(TransactionTestCase):
+
+    def setUp(self):
+        self.logger = BackgroundTaskLogger(AsyncLogsTask.logs_table_name)
+        self.model = self.logger._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_rows_are_written_on_flush(self):
+
+        writer = BackgroundLogWriter(self.model, 1000, 60, 100)
+        for i in range(5):
+            writer.put(self._row(info='%d' % i))
+
+        self.assertEqual(self.model.objects.count(), 0)
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.model.objects.count(), 5)
+
+    # with a full buffer rows of only info messages are dropped, the others wait for room without their info messages
+    def test_backpressure(self):
+
+        writer = BackgroundLogWriter(self.model, 1000, 60, 2)
+        writer.put(self._row(info='a'))
+        writer.put(self._row(info='b'))
+        writer.put(self._row(info='c'))
+
+        thread = threading.Thread(target=writer.put, args=[self._row(info='d', error='e')])
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        self.assertTrue(writer.flush(5))
+        thread.join(5)
+        self.assertTrue(writer.flush(5))
+
+        message_list = [
+            [message['message_text'] for message in log['message_json']] for log in self.model.objects.order_by('id').values()
+        ]
+        self.assertEqual(message_list, [['a'], ['b'], ['e']])
+        self.assertEqual((writer.dropped_row_count, writer.dropped_message_count), (1, 2))
+
+    def test_failed_write_is_logged(self):
+
+        self.logger = BackgroundTaskLogger('bt_test_missing_logs')
+        writer = BackgroundLogWriter(self.logger._get_db_model(), 1000, 60, 100)
+        for _ in range(2):
+            with self.assertLogs('background_task', 'ERROR'):
+                writer.put(self._row(info='a'))
+                self.assertTrue(writer.flush(5))
+
+    # the worker loop drains the writer when it's shut down
+    def test_worker_drains_on_shutdown(self):
+
+        task = AsyncLogsTask()
+        queue_model = task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(queue_model)
+
+        # the queue table isn't read meanwhile, sqlite's shared cache locks it for the worker thread
+        done_list = []
+        done_event = threading.Event()
+
+        def on_ok():
+            done_list.append(True)
+            if len(done_list) == 5:
+                done_event.set()
+
+        task.on_ok = on_ok
+        try:
+            task.add_tasks([{'n': n} for n in range(5)])
+            runner = BackgroundTaskRunner('AsyncLogsTask', 0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                thread = threading.Thread(target=runner.run_loop, args=[task])
+                thread.start()
+                try:
+                    self.assertTrue(done_event.wait(5))
+                    self.assertEqual(self.model.objects.count(), 0)
+                finally:
+                    runner.shutdown()
+                    thread.join(5)
+
+            self.assertEqual(self.model.objects.count(), 5)
+            self.assertFalse(queue_model.objects.exists())
+        finally:
+            with connection.schema_editor() as schema_editor:
+                schema_editor.delete_model(queue_model)
+
+    def _row(self, info, error=None):
+
+        self.logger.info(info)
+        if error is not None:
+            self.logger.error(error)
+
+        return self.logger.pop_row()
+
+
+class LogRetrievalTest(TransactionTestCase):
+
+    def setUp(self):
+        self.logger = BackgroundTaskLogger('bt_test_read_logs')
+        self.model = self.logger._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+
+        self.model.objects.bulk_create([
+            self.model(date_added=1000 + i, task_id=i % 3, message_type=i % 2 * 2, message_json=[]) for i in range(25)
+        ])
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_pages(self):
+
+        page_list = []
+        cursor = None
+        while True:
+            logs_list, cursor = self.logger.get_logs(10, cursor)
+            page_list.append(logs_list)
+            if cursor is None:
+                break
+
+        self.assertEqual([len(logs_list) for logs_list in page_list], [10, 10, 5])
+        self.assertEqual(sum(page_list, []), self.logger.get_last_logs(25))
+        self.assertEqual(self.logger.get_logs(25), (self.logger.get_last_logs(25), None))
+
+    def test_filters(self):
+
+        for filters, expected in (
+            ({'task_id': 1}, lambda log: log['task_id'] == 1),
+            ({'message_type': 2}, lambda log: log['message_type'] == 2),
+            ({'date_from': 1005, 'date_to': 1010}, lambda log: 1005 <= log['date_added'] <= 1010),
+            ({'task_id': 0, 'message_type': 0}, lambda log: log['task_id'] == 0 and log['message_type'] == 0),
+        ):
+            expected_list = [log for log in self.logger.get_last_logs(25) if expected(log)]
+            self.assertEqual(list(self.logger.iter_logs(2, **filters)), expected_list)
+            self.assertEqual(self.logger.get_logs(2, **filters), (expected_list[:2], '%s:%d' % (
+                self.model._meta.db_table, expected_list[1]['id']
+            )))
+
+
+class TableLogPartitionsTest(TransactionTestCase):
+    """ Logs tables per period, as on sqlite """
+
+    def setUp(self):
+        self.logger = BackgroundTaskLogger('bt_test_partitioned_logs', logs_partition_by='day', logs_partition_ahead=1)
+        self.partitions = self.logger.get_partitions()
+
+    def tearDown(self):
+        with connection.schema_editor() as schema_editor:
+            for model in [self.logger._get_db_model()] + self._get_period_models():
+                if model._meta.db_table in connection.introspection.table_names():
+                    schema_editor.delete_model(model)
+
+    def test_periods_are_written_read_and_dropped(self):
+
+        now = int(time.time())
+        self.assertEqual(len(self.partitions.migrate(now)), 2)
+        self.assertEqual(self.partitions.migrate(now), [])
+
+        # a day back goes to a table the write creates
+        for timestamp in (now - 86400, now):
+            model = self.partitions.get_write_model(timestamp)
+            model(date_added=timestamp, message_json=[{'message_text': 'at %d' % timestamp}]).save()
+
+        message_list = [log['message_json'][0]['message_text'] for log in self.logger.get_last_logs()]
+        self.assertEqual(message_list, ['at %d' % now, 'at %d' % (now - 86400)])
+
+        # a page ends in one table, the next one goes on in the older table
+        logs_list, cursor = self.logger.get_logs(1)
+        self.assertEqual(logs_list, self.logger.get_last_logs(1))
+        self.assertEqual(self.logger.get_logs(1, cursor), (self.logger.get_last_logs(1, 1), None))
+
+        self.assertEqual(len(self.partitions.drop_older_than(now - 1)), 1)
+        self.assertEqual(len(self.logger.get_last_logs()), 1)
+
+    def test_table_from_before_partitioning_is_reported(self):
+
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.logger._get_db_model())
+
+        for call in (self.partitions.migrate, self.logger.get_last_logs, lambda: self.logger.delete_logs_older_than(0)):
+            with self.assertRaisesRegex(ValueError, 'is not partitioned'):
+                call()
+
+    def _get_period_models(self) -> list:
+
+        prefix = self.partitions.table_name + '_'
+        return [
+            self.logger._get_period_db_model(table_name) for table_name in connection.introspection.table_names()
+            if table_name.startswith(prefix)
+        ]
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.task = RedisTask()
+        self.task.redis_client = fakeredis.FakeRedis()
+        self.backend = self.task._get_queue_backend()
+        self.now = int(time.time())
+
+    def test_claim_in_claim_order(self):
+
+        self._add('new', date_added=self.now - 10)
+        self._add('urgent', priority=1)
+        self._add('old', date_added=self.now - 100)
+        self._add('later', need_work=self.now + 60)
+
+        task_list = self.backend.claim(self.now, self.now + 30, 10, 'a')
+        self.assertEqual([task_row.data_json['n'] for task_row in task_list], ['old', 'urgent', 'new'])
+        self.assertEqual([task_row.errors for task_row in task_list], [0, 0, 0])
+        self.assertEqual(self.backend.claim(self.now, self.now + 30, 10, 'a'), [])
+        self.assertEqual(self.backend.get_split_counts(self.now, None), {'ready': 0, 'scheduled': 1, 'in_flight': 3})
+
+    def test_expired_lease_is_claimed_again(self):
+
+        task_id = self._add('one')
+        self.backend.claim(self.now, self.now + 30, 1, 'a')
+
+        self.assertEqual(self.backend.claim(self.now + 29, self.now + 60, 1, 'b'), [])
+        task_list = self.backend.claim(self.now + 30, self.now + 60, 1, 'b')
+        self.assertEqual([(task_row.task_id, task_row.errors) for task_row in task_list], [(task_id, 1)])
+
+        # the first worker has lost the task, it can't extend, retry or delete it any more
+        self.assertEqual(self.backend.extend([task_id], self.now + 90, 'a'), 0)
+        self.backend.retry([task_id], self.now, self.task.priority_aging, 'a')
+        self.backend.delete([task_id], 'a')
+        self.assertEqual(self.backend.size(), (1, True))
+        self.assertEqual(self.backend.claim(self.now + 59, self.now + 90, 1, 'c'), [])
+
+        self.assertEqual(self.backend.extend([task_id], self.now + 90, 'b'), 1)
+        self.backend.delete([task_id], 'b')
+        self.assertEqual(self.backend.size(), (0, True))
+
+    def test_retry_waits_for_need_work_behind_older_tasks(self):
+
+        task_id = self._add('retried', date_added=self.now - 100)
+        self.backend.claim(self.now, self.now + 30, 1, 'a')
+        self._add('waiting', date_added=self.now - 50)
+        self.backend.retry([task_id], self.now + 10, self.task.priority_aging, 'a')
+
+        self.assertEqual([task_row.data_json['n'] for task_row in self.backend.claim(self.now, self.now + 30, 10, 'b')], ['waiting'])
+        task_list = self.backend.claim(self.now + 10, self.now + 40, 10, 'b')
+        self.assertEqual([(task_row.task_id, task_row.errors) for task_row in task_list], [(task_id, 1)])
+
+    def test_reschedule_keeps_recurring_task(self):
+
+        task_id = self._add('every', dedupe_key='job', schedule='every 60')
+        self.backend.claim(self.now, self.now + 30, 1, 'a')
+        self.assertIsNone(self._add('every', dedupe_key='job', schedule='every 60'))
+
+        self.backend.reschedule({task_id: self.now + 60}, self.task.priority_aging, 'a')
+        self.assertEqual(self.backend.claim(self.now + 59, self.now + 90, 1, 'b'), [])
+        task_list = self.backend.claim(self.now + 60, self.now + 90, 1, 'b')
+        self.assertEqual([(task_row.task_id, task_row.errors, task_row.schedule) for task_row in task_list], [(task_id, 0, 'every 60')])
+
+    def test_dedupe(self):
+
+        task_id = self._add('first', dedupe_key='key')
+        self.assertIsNone(self._add('second', dedupe_key='key'))
+        self.assertEqual(self.backend.size(), (1, True))
+
+        # refresh moves the waiting task, the claim lets the key go
+        self.assertIsNone(self._add('third', dedupe_key='key', need_work=self.now + 60, dedupe_refresh=True))
+        self.assertEqual(self.backend.claim(self.now, self.now + 30, 1, 'a'), [])
+        task_list = self.backend.claim(self.now + 60, self.now + 90, 1, 'a')
+        self.assertEqual([(task_row.task_id, task_row.data_json['n']) for task_row in task_list], [(task_id, 'first')])
+        self.assertIsNotNone(self._add('fourth', dedupe_key='key'))
+
+    def test_scripts_are_registered_once_per_client(self):
+
+        other_task = RedisTask()
+        other_task.redis_client = self.task.redis_client
+        self.assertIs(other_task._get_queue_backend()._claim_script, self.backend._claim_script)
+
+    def _add(self, name, need_work=0, priority=0, date_added=None, dedupe_key=None, schedule=None, dedupe_refresh=False):
+
+        date_added = self.now if date_added is None else date_added
+        task = self.task._new_task_row({'n': name}, need_work, priority, date_added, dedupe_key, schedule)
+
+        return self.backend.add([task], dedupe_refresh)[0]
+
+
+@override_settings(TIME_ZONE='UTC')
+class ScheduleTest(SimpleTestCase):
+
+    def test_fields(self):
+
+        # steps, ranges and names: every 15 minutes of the working hours, on weekdays of the first quarter
+        schedule = get_schedule(cron='*/15 9-17 * jan-mar mon-fri')
+        self.assertEqual(self._runs(schedule, '2026-03-27 17:40', 3), ['2026-03-27 17:45', '2026-03-30 09:00', '2026-03-30 09:15'])
+        self.assertEqual(self._runs(schedule, '2026-03-31 17:45', 1), ['2027-01-01 09:00'])
+
+        # lists, a step from a value, sunday as 7
+        self.assertEqual(self._runs(get_schedule(cron='5,50 */6 * * *'), '2026-01-01 06:05', 3), ['2026-01-01 06:50', '2026-01-01 12:05', '2026-01-01 12:50'])
+        self.assertEqual(self._runs(get_schedule(cron='10/20 0 * * 7'), '2026-01-01 00:00', 3), ['2026-01-04 00:10', '2026-01-04 00:30', '2026-01-04 00:50'])
+
+    # as in crontab, both days restricted: either one; one of them restricted: that one
+    def test_day_of_month_or_day_of_week(self):
+
+        self.assertEqual(self._runs(get_schedule(cron='0 0 13 * fri'), '2026-02-01 00:00', 4), [
+            '2026-02-06 00:00', '2026-02-13 00:00', '2026-02-20 00:00', '2026-02-27 00:00',
+        ])
+        self.assertEqual(self._runs(get_schedule(cron='0 0 13 * *'), '2026-02-01 00:00', 2), ['2026-02-13 00:00', '2026-03-13 00:00'])
+        self.assertEqual(self._runs(get_schedule(cron='0 0 * * fri'), '2026-02-01 00:00', 2), ['2026-02-06 00:00', '2026-02-13 00:00'])
+
+    def test_aliases(self):
+
+        for alias, run in (
+            ('@hourly', '2026-05-06 08:00'), ('@daily', '2026-05-07 00:00'), ('@midnight', '2026-05-07 00:00'),
+            ('@weekly', '2026-05-10 00:00'), ('@monthly', '2026-06-01 00:00'), ('@yearly', '2027-01-01 00:00'),
+        ):
+            self.assertEqual(self._runs(get_schedule(cron=alias), '2026-05-06 07:30', 1), [run])
+
+    def test_invalid_and_never_running(self):
+
+        self.assertEqual(self._runs(get_schedule(cron='0 0 29 2 *'), '2026-01-01 00:00', 1), ['2028-02-29 00:00'])
+        for cron in ('0 0 31 2 *', '0 0 30 2 *', '60 * * * *', '* * *', '5-1 * * * *', '* * * foo *', '*/0 * * * *'):
+            with self.assertRaises(ValueError, msg=cron):
+                get_schedule(cron=cron)
+
+        with self.assertRaises(ValueError):
+            get_schedule(every=0)
+        with self.assertRaises(ValueError):
+            get_schedule(every=60, cron='@daily')
+        self.assertIsNone(get_schedule())
+
+    # a local time skipped by DST is run at the instant it maps to (an hour later), a repeated one once
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_dst(self):
+
+        # the clocks go from 02:00 to 03:00
+        self.assertEqual(self._runs(get_schedule(cron='30 2 * * *'), '2026-03-29 00:00', 2), ['2026-03-29 03:30', '2026-03-30 02:30'])
+        self.assertEqual(self._runs(get_schedule(cron='0 * * * *'), '2026-03-29 00:30', 3), ['2026-03-29 01:00', '2026-03-29 03:00', '2026-03-29 04:00'])
+
+        # the clocks go from 03:00 back to 02:00, 02:00-02:59 is passed twice
+        self.assertEqual(self._runs(get_schedule(cron='30 2 * * *'), '2026-10-25 00:00', 2), ['2026-10-25 02:30', '2026-10-26 02:30'])
+        runs = self._runs(get_schedule(cron='0 * * * *'), '2026-10-25 01:30', 3, as_timestamps=True)
+        self.assertEqual([run - runs[0] for run in runs], [0, 7200, 10800])
+
+    def test_every(self):
+
+        schedule = get_schedule(every=60)
+        self.assertEqual(schedule, 'every 60')
+        self.assertEqual(get_first_run(schedule, 1000), 1000)
+
+        # counted from the start of a run, not from its end
+        self.assertEqual(get_next_run(schedule, 1000, 1030), 1060)
+        # a late start moves the following runs with it
+        self.assertEqual(get_next_run(schedule, 1005, 1010), 1065)
+        # a run longer than the interval is followed by the next one right away, the missed ones aren't made up
+        self.assertEqual(get_next_run(schedule, 1000, 1150), 1150)
+
+    # the next `count` runs of a cron schedule after the local time `after`, as local times
+    def _runs(self, schedule, after, count, as_timestamps=False) -> list:
+
+        time_zone = zoneinfo.ZoneInfo(django_settings.TIME_ZONE)
+        timestamp = int(datetime.datetime.fromisoformat(after).replace(tzinfo=time_zone).timestamp())
+
+        run_list = [get_first_run(schedule, timestamp)]
+        while len(run_list) < count:
+            run_list.append(get_next_run(schedule, run_list[-1], run_list[-1]))
+
+        if as_timestamps:
+            return run_list
+
+        return [datetime.datetime.fromtimestamp(run, time_zone).strftime('%Y-%m-%d %H:%M') for run in run_list]
+
+
+class PollingTest(SimpleTestCase):
+
+    def test_adaptive(self):
+
+        polling = AdaptivePolling(10, 0.1, 1)
+
+        # a full batch polls again right away
+        self.assertEqual(polling.next_delay(10), 0)
+
+        # empty polls back off, with jitter, up to max_latency
+        upper_list = [0.2, 0.4, 0.8, 1, 1]
+        for upper in upper_list:
+            delay = polling.next_delay(0)
+            self.assertTrue(upper / 2 <= delay <= upper, (delay, upper))
+
+        # a partial batch starts over from the minimum, so does a full one
+        self.assertTrue(0.05 <= polling.next_delay(3) <= 0.1)
+        for _ in range(5):
+            polling.next_delay(0)
+        self.assertEqual(polling.next_delay(10), 0)
+        self.assertTrue(0.1 <= polling.next_delay(0) <= 0.2)
+
+    def test_policy_of_task_class(self):
+
+        task = MigrateTask()
+        self.assertIsInstance(get_polling_policy(task), AdaptivePolling)
+
+        task.adaptive_polling_on = False
+        polling = get_polling_policy(task)
+        self.assertIsInstance(polling, FixedPolling)
+        self.assertEqual((polling.next_delay(0), polling.next_delay(1)), (task.empty_interval, task.busy_interval))
+
+
+class WakeupTest(TransactionTestCase):
+
+    def setUp(self):
+        self.task = WakeupTask()
+        self.model = self.task._get_db_model()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(self.model)
+        self.worker = get_wakeup(self.task)
+
+    def tearDown(self):
+        self.worker.close()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(self.model)
+
+    def test_add_task_wakes_the_worker_up(self):
+
+        self.assertIsInstance(self.worker, SocketWakeup)
+        self.assertIsNone(get_wakeup(MigrateTask()))
+        self.assertFalse(self.worker.wait(0.01))
+
+        # several notifications are drained by one wait()
+        self.task.add_task({'n': 1})
+        self.task.add_tasks([{'n': 2}, {'n': 3}])
+        self.assertTrue(self.worker.wait(1))
+        self.assertFalse(self.worker.wait(0.01))
+
+    def test_interrupt_is_not_a_wakeup(self):
+
+        self.worker.wait(0)
+        started = time.monotonic()
+        self.worker.interrupt()
+        self.assertFalse(self.worker.wait(5))
+        self.assertLess(time.monotonic() - started, 1)
+
+    # a dead worker's socket is removed by the next notification, a closed one right away
+    def test_stale_sockets_are_removed(self):
+
+        self.worker.wait(0)
+        socket_path = self.worker._socket_path
+        self.worker._socket.close()
+        self.worker._socket = None
+        self.assertTrue(os.path.exists(socket_path))
+
+        self.task.add_task({'n': 1})
+        self.assertFalse(os.path.exists(socket_path))
+
+        self.worker.wait(0)
+        self.worker.close()
+        self.assertFalse(os.path.exists(socket_path))
+
+
+class SupervisorTest(SimpleTestCase):
+
+    # a worker of a class that can't be imported crashes right away
+    crashing_class_string = 'BackgroundTask.tests.MissingTask'
+
+    def tearDown(self):
+        lock_file = BackgroundTaskRunner(self.crashing_class_string, 0).worker_lock_file
+        if os.path.exists(lock_file):
+            os.unlink(lock_file)
+
+    # 0.1, 0.2, 0.4, then no longer than the max, and from the min again once a worker lived `stable_time`
+    def test_crashing_worker_is_restarted_with_backoff(self):
+
+        supervisor = BackgroundTaskSupervisor()
+        supervisor.restart_delay_min = 0.1
+        supervisor.restart_delay_max = 0.4
+        slot = {
+            'task_class_string': self.crashing_class_string, 'worker_number': 0,
+            'pid': None, 'started_at': 0, 'crash_count': 0, 'restart_at': 0,
+        }
+        supervisor._slot_list = [slot]
+
+        spawn_time_list = []
+        spawn = supervisor._spawn
+
+        def spawn_timed(slot):
+            spawn_time_list.append(time.monotonic())
+            spawn(slot)
+
+        supervisor._spawn = spawn_timed
+
+        with contextlib.redirect_stdout(io.StringIO()), self.assertLogs('background_task', 'ERROR') as logs:
+            deadline = time.monotonic() + 10
+            while len(spawn_time_list) < 5 and time.monotonic() < deadline:
+                supervisor._reap()
+                supervisor._spawn_due()
+                time.sleep(0.01)
+
+            supervisor.stable_time = 0
+            while supervisor._has_children():
+                supervisor._reap()
+                time.sleep(0.01)
+
+        delay_list = [end - start for start, end in zip(spawn_time_list, spawn_time_list[1:])]
+        for delay, expected in zip(delay_list, [0.1, 0.2, 0.4, 0.4]):
+            self.assertTrue(expected <= delay < expected + 0.3, delay_list)
+        self.assertEqual(len(delay_list), 4)
+
+        self.assertEqual(slot['crash_count'], 1)
+        self.assertLess(slot['restart_at'] - time.time(), 0.2)
+        self.assertIn('exited with status 1', logs.output[-1])
+
+
+@override_settings(BACKGROUND_TASK_CLASSES=['BackgroundTask.tests.MetricsTask'], BACKGROUND_TASK_METRICS_PORT=0)
+class MetricsServerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        MetricsTask.metrics_dir = self.metrics_dir.name + '/'
+
+        self.supervisor = BackgroundTaskSupervisor()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.supervisor._start_metrics_server()
+        self.url = 'http://127.0.0.1:%d' % self.supervisor._metrics_server.server_address[1]
+
+    def tearDown(self):
+        self.supervisor._metrics_server.shutdown()
+        self.supervisor._metrics_server.server_close()
+        MetricsTask.metrics_dir = None
+        self.metrics_dir.cleanup()
+
+    # the files of all the workers as one text, a family is described once
+    def test_metrics_of_workers_are_merged(self):
+
+        text_list = []
+        for worker_number in (0, 1):
+            metrics = get_metrics(MetricsTask(), worker_number)
+            metrics.count_task('ok')
+            metrics.write()
+            with open(metrics.path) as metrics_file:
+                text_list.append(metrics_file.read())
+
+        with urllib.request.urlopen(self.url + '/metrics') as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            body = response.read().decode()
+
+        self.assertEqual(body, merge_metrics_text(text_list))
+        self.assertEqual(body.count('# TYPE '), text_list[0].count('# TYPE '))
+        for worker_number in (0, 1):
+            self.assertIn('worker="%d"' % worker_number, body)
+
+    def test_other_paths_are_not_found(self):
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(self.url + '/')
+        self.assertEqual(context.exception.code, 404)
+        context.exception.close()
@@ -0,0 +1,204 @@
+import os
+import glob
+import select
+import socket
+from django.db import connections
+
+"""
+Push wakeups for idle workers.
+add_task() notifies, and a sleeping worker wakes up right away instead of waiting for its next poll,
+the poll stays as a safety net (a lost notification costs at most `max_latency`).
+PostgreSQL - NOTIFY on a per-table channel, workers LISTEN on their own connection.
+Everything else - a unix datagram socket per worker in the lock files directory,
+add_task() sends a byte to every live worker socket of the queue.
+Web processes must be able to write to the lock files directory (same host, same permissions).
+"""
+
+WAKEUP_SOCKETS_PATH = os.path.dirname(os.path.abspath(__file__)) + '/lockfiles/'
+
+
+def get_wakeup(task_class):
+
+    if not task_class.wakeup_on:
+        return None
+
+    alias = task_class._get_db_alias()
+    channel = task_class.get_wakeup_channel()
+
+    transport = task_class.wakeup_transport
+    if transport == 'auto':
+        transport = 'postgres' if connections[alias].vendor == 'postgresql' else 'socket'
+
+    if transport == 'postgres':
+        return PostgresWakeup(alias, channel)
+
+    if transport == 'socket':
+        return SocketWakeup(channel)
+
+    raise ValueError("Unknown wakeup_transport [%s], use auto, postgres or socket" % transport)
+
+
+class PostgresWakeup:
+
+    def __init__(self, alias, channel):
+        self.alias = alias
+        self.channel = channel
+        self._listening_on = None
+
+        # the worker side only, producers (a handler per add_task() in web processes) just NOTIFY
+        self._interrupt_read = None
+        self._interrupt_write = None
+
+    # producer side, delivered when the inserting transaction commits
+    def notify(self):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, '')", [self.channel])
+
+    # worker side, returns True when woken up by a notification
+    def wait(self, timeout) -> bool:
+
+        raw_connection = self._listen()
+        if self._interrupt_read is None:
+            self._interrupt_read, self._interrupt_write = os.pipe()
+            os.set_blocking(self._interrupt_read, False)
+            os.set_blocking(self._interrupt_write, False)
+
+        readable, _, _ = select.select([raw_connection, self._interrupt_read], [], [], timeout)
+        self._drain_interrupt()
+
+        if raw_connection not in readable:
+            return False
+
+        # psycopg2
+        if hasattr(raw_connection, 'poll'):
+            raw_connection.poll()
+            woken = len(raw_connection.notifies) > 0
+            del raw_connection.notifies[:]
+            return woken
+
+        # psycopg 3
+        return len(list(raw_connection.notifies(timeout=0))) > 0
+
+    # wakes wait() up from a signal handler
+    def interrupt(self):
+
+        if self._interrupt_write is None:
+            return
+
+        try:
+            os.write(self._interrupt_write, b'1')
+        except BlockingIOError:
+            pass
+
+    def close(self):
+
+        if self._interrupt_read is None:
+            return
+
+        os.close(self._interrupt_read)
+        os.close(self._interrupt_write)
+        self._interrupt_read = None
+        self._interrupt_write = None
+
+    # LISTEN has to be repeated whenever Django opens a new connection
+    def _listen(self):
+
+        connection = connections[self.alias]
+        connection.ensure_connection()
+
+        if self._listening_on is not connection.connection:
+            with connection.cursor() as cursor:
+                cursor.execute("LISTEN " + connection.ops.quote_name(self.channel))
+            self._listening_on = connection.connection
+
+        return connection.connection
+
+    def _drain_interrupt(self):
+        try:
+            os.read(self._interrupt_read, 1024)
+        except BlockingIOError:
+            pass
+
+
+class SocketWakeup:
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._socket = None
+        self._socket_path = None
+
+    # producer side, a lost datagram is fine, the worker will poll anyway
+    def notify(self):
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+
+        try:
+            for socket_path in glob.glob(WAKEUP_SOCKETS_PATH + self.channel + '_*.sock'):
+                try:
+                    sender.sendto(b'1', socket_path)
+                except ConnectionRefusedError:
+                    # the worker is dead
+                    self._unlink(socket_path)
+                except (BlockingIOError, FileNotFoundError, PermissionError):
+                    pass
+        finally:
+            sender.close()
+
+    # worker side, returns True when woken up by a notification
+    def wait(self, timeout) -> bool:
+
+        listener = self._listen()
+        readable, _, _ = select.select([listener], [], [], timeout)
+
+        if listener not in readable:
+            return False
+
+        woken = False
+        while True:
+            try:
+                woken = listener.recv(1024) != b'interrupt' or woken
+            except BlockingIOError:
+                return woken
+
+    # wakes wait() up from a signal handler
+    def interrupt(self):
+
+        if self._socket is None:
+            return
+
+        try:
+            self._socket.sendto(b'interrupt', self._socket_path)
+        except OSError:
+            pass
+
+    def close(self):
+
+        if self._socket is None:
+            return
+
+        self._socket.close()
+        self._unlink(self._socket_path)
+        self._socket = None
+
+    def _listen(self):
+
+        # a forked child must not keep using its parent's socket
+        if self._socket is not None and self._socket_path.endswith('_%d.sock' % os.getpid()):
+            return self._socket
+
+        self._socket_path = WAKEUP_SOCKETS_PATH + self.channel + '_%d.sock' % os.getpid()
+        self._unlink(self._socket_path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._socket.bind(self._socket_path)
+
+        return self._socket
+
+    @staticmethod
+    def _unlink(socket_path):
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass